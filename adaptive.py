@@ -0,0 +1,293 @@
+"""
+Adaptive (one-pass) Huffman coding with Vitter's algorithm.
+
+Encoder and decoder start from a tree holding only the NYT (not yet
+transmitted) leaf and update it identically after every symbol, so no
+tree is stored and output is available as soon as input arrives.  A
+symbol's first occurrence is sent as the NYT code followed by the symbol
+in SYMBOL_BITS bits, and the stream ends with the symbol EOS.
+"""
+
+from nodes import AdaptiveNode
+
+EOS = 256
+SYMBOL_BITS = 9
+
+# Implicit number of the root: a tree over the 256 bytes and EOS has at
+# most 2 * 257 - 1 nodes.
+ROOT_NUMBER = 2 * 257 - 2
+
+
+class AdaptiveTree:
+    """ A dynamic Huffman tree kept in Vitter's implicit numbering: nodes
+    are numbered bottom-up and left to right in order of weight, with the
+    leaves of each weight numbered before the internal nodes of that
+    weight.
+
+    Attributes:
+    ===========
+    @param AdaptiveNode root: root of the tree
+    @param AdaptiveNode nyt: the leaf coding symbols not yet transmitted
+    @param list[AdaptiveNode|NoneType] leaves: leaf of each transmitted
+        symbol, by symbol
+    @param list[AdaptiveNode|NoneType] nodes: nodes by implicit number
+    """
+
+    def __init__(self):
+        """ Create a tree holding only the NYT leaf.
+
+        @param AdaptiveTree self: this tree
+        @rtype: NoneType
+        """
+        self.root = self.nyt = AdaptiveNode()
+        self.root.number = ROOT_NUMBER
+        self.nodes = [None] * ROOT_NUMBER + [self.root]
+        self.leaves = [None] * (EOS + 1)
+
+    def code(self, node):
+        """ Return (bits, length) of the code leading to node.
+
+        @param AdaptiveTree self: this tree
+        @param AdaptiveNode node: a leaf of this tree
+        @rtype: (int, int)
+
+        >>> tree = AdaptiveTree()
+        >>> for symbol in b"abb":
+        ...     tree.update(symbol)
+        >>> tree.code(tree.leaves[98]), tree.code(tree.leaves[97])
+        ((1, 1), (1, 2))
+        """
+        bits = length = 0
+        parent = node.parent
+        while parent is not None:
+            if parent.right is node:
+                bits |= 1 << length
+            length += 1
+            node, parent = parent, parent.parent
+        return bits, length
+
+    def swap(self, a, b):
+        """ Exchange the positions of the subtrees a and b, neither of
+        which contains the other, along with their implicit numbers.
+
+        @param AdaptiveTree self: this tree
+        @param AdaptiveNode a: a node other than the root
+        @param AdaptiveNode b: a node other than the root
+        @rtype: NoneType
+        """
+        pa, pb = a.parent, b.parent
+        if pa is pb:
+            pa.left, pa.right = pa.right, pa.left
+        else:
+            if pa.left is a:
+                pa.left = b
+            else:
+                pa.right = b
+            if pb.left is b:
+                pb.left = a
+            else:
+                pb.right = a
+            a.parent, b.parent = pb, pa
+        a.number, b.number = b.number, a.number
+        self.nodes[a.number], self.nodes[b.number] = a, b
+
+    def slide_and_increment(self, node):
+        """ Slide node past the following block it must now follow, add one
+        to its weight, and return the next node to update.
+
+        A leaf slides past the internal nodes of its weight, and an
+        internal node past the leaves of the weight it is about to take.
+
+        @param AdaptiveTree self: this tree
+        @param AdaptiveNode node: the leader of its block
+        @rtype: AdaptiveNode|NoneType
+        """
+        parent = node.parent
+        weight = node.weight
+        is_leaf = node.left is None
+        nodes = self.nodes
+        number = node.number + 1
+        while number <= ROOT_NUMBER:
+            other = nodes[number]
+            if is_leaf:
+                if other.left is None or other.weight != weight:
+                    break
+            elif other.left is not None or other.weight != weight + 1:
+                break
+            self.swap(node, other)
+            number += 1
+        node.weight = weight + 1
+        return node.parent if is_leaf else parent
+
+    def update(self, symbol):
+        """ Record one more occurrence of symbol.
+
+        @param AdaptiveTree self: this tree
+        @param int symbol: a byte or EOS
+        @rtype: NoneType
+
+        >>> tree = AdaptiveTree()
+        >>> for symbol in b"abracadabra":
+        ...     tree.update(symbol)
+        >>> tree.root.weight, tree.leaves[97].weight
+        (11, 5)
+        """
+        leaf_to_increment = None
+        node = self.leaves[symbol]
+        if node is None:
+            # the NYT leaf becomes the parent of a new NYT and a new leaf
+            node = self.nyt
+            number = node.number
+            self.nyt = AdaptiveNode()
+            leaf = AdaptiveNode(symbol)
+            node.left, node.right = self.nyt, leaf
+            self.nyt.parent = leaf.parent = node
+            self.nyt.number, leaf.number = number - 2, number - 1
+            self.nodes[number - 2], self.nodes[number - 1] = self.nyt, leaf
+            self.leaves[symbol] = leaf_to_increment = leaf
+        else:
+            leader = node.number
+            while (self.nodes[leader + 1].left is None and
+                   self.nodes[leader + 1].weight == node.weight):
+                leader += 1
+            if leader != node.number:
+                self.swap(node, self.nodes[leader])
+            if node.parent.left is self.nyt:
+                leaf_to_increment = node
+                node = node.parent
+        while node is not None:
+            node = self.slide_and_increment(node)
+        if leaf_to_increment is not None:
+            self.slide_and_increment(leaf_to_increment)
+
+
+class AdaptiveEncoder:
+    """ An incremental adaptive Huffman encoder.
+
+    >>> encoder = AdaptiveEncoder()
+    >>> data = encoder.encode(b"abracadabra") + encoder.finish()
+    >>> decoder = AdaptiveDecoder()
+    >>> decoder.decode(data), decoder.done
+    (b'abracadabra', True)
+    """
+
+    def __init__(self):
+        """ Start a new stream.
+
+        @param AdaptiveEncoder self: this encoder
+        @rtype: NoneType
+        """
+        self.tree = AdaptiveTree()
+        self._acc = self._nbits = 0
+
+    def _put(self, symbol, out):
+        """ Code symbol, appending the whole bytes produced to out.
+
+        @param AdaptiveEncoder self: this encoder
+        @param int symbol: a byte or EOS
+        @param bytearray out: output buffer
+        @rtype: NoneType
+        """
+        tree = self.tree
+        leaf = tree.leaves[symbol]
+        if leaf is None:
+            bits, length = tree.code(tree.nyt)
+            bits = bits << SYMBOL_BITS | symbol
+            length += SYMBOL_BITS
+        else:
+            bits, length = tree.code(leaf)
+        acc = self._acc << length | bits
+        nbits = self._nbits + length
+        while nbits >= 32:
+            nbits -= 32
+            out += (acc >> nbits).to_bytes(4, "big")
+            acc &= (1 << nbits) - 1
+        self._acc, self._nbits = acc, nbits
+        if symbol != EOS:
+            tree.update(symbol)
+
+    def encode(self, data):
+        """ Code the bytes of data, returning the output completed so far.
+
+        @param AdaptiveEncoder self: this encoder
+        @param bytes data: bytes to code
+        @rtype: bytes
+        """
+        out = bytearray()
+        for symbol in data:
+            self._put(symbol, out)
+        return bytes(out)
+
+    def finish(self):
+        """ End the stream, returning the rest of its output.
+
+        @param AdaptiveEncoder self: this encoder
+        @rtype: bytes
+        """
+        out = bytearray()
+        self._put(EOS, out)
+        nbytes = (self._nbits + 7) // 8
+        out += (self._acc << (8 * nbytes - self._nbits)).to_bytes(nbytes,
+                                                                  "big")
+        self._acc = self._nbits = 0
+        return bytes(out)
+
+
+class AdaptiveDecoder:
+    """ An incremental adaptive Huffman decoder.
+
+    Attributes:
+    ===========
+    @param bool done: whether the end of the stream has been decoded
+    """
+
+    def __init__(self):
+        """ Start decoding a new stream.
+
+        @param AdaptiveDecoder self: this decoder
+        @rtype: NoneType
+        """
+        self.tree = AdaptiveTree()
+        self.done = False
+        self._node = self.tree.root
+        # the first symbol is always new, coded by the empty NYT code
+        self._raw, self._raw_bits = 0, SYMBOL_BITS
+
+    def decode(self, data):
+        """ Decode the bytes of data, returning the symbols completed so
+        far.  Bytes after the end of the stream are ignored.
+
+        @param AdaptiveDecoder self: this decoder
+        @param bytes data: coded bytes
+        @rtype: bytes
+        """
+        out = bytearray()
+        tree = self.tree
+        node, raw, raw_bits = self._node, self._raw, self._raw_bits
+        for byte in data:
+            if self.done:
+                break
+            for shift in range(7, -1, -1):
+                bit = byte >> shift & 1
+                if raw_bits:
+                    raw = raw << 1 | bit
+                    raw_bits -= 1
+                    if raw_bits:
+                        continue
+                    symbol = raw
+                else:
+                    node = node.right if bit else node.left
+                    if node.left is not None:
+                        continue
+                    if node is tree.nyt:
+                        raw, raw_bits = 0, SYMBOL_BITS
+                        continue
+                    symbol = node.symbol
+                node = tree.root
+                if symbol == EOS:
+                    self.done = True
+                    break
+                out.append(symbol)
+                tree.update(symbol)
+        self._node, self._raw, self._raw_bits = node, raw, raw_bits
+        return bytes(out)
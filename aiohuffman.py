@@ -0,0 +1,82 @@
+"""
+asyncio streaming counterparts of compress and uncompress.
+
+Blocks are read from an asyncio.StreamReader, encoded or decoded in an
+executor so the event loop stays responsive, and written to an
+asyncio.StreamWriter, waiting on drain() after each block so a slow peer
+holds back the reader rather than filling memory.  The streams use the
+FORMAT_BLOCKS layout, so they interoperate with compress and uncompress.
+"""
+
+import asyncio
+
+from huffman import FORMAT_MAGIC, FORMAT_BLOCKS, BLOCK_SIZE
+from huffman import FrameReader, FrameWriter
+from huffman import compress_block, decompress_block
+
+
+async def read_block(reader, block_size):
+    """ Return the next block_size bytes of reader, or fewer at its end.
+
+    @param asyncio.StreamReader reader: stream to read
+    @param int block_size: number of bytes wanted
+    @rtype: bytes
+    """
+    try:
+        return await reader.readexactly(block_size)
+    except asyncio.IncompleteReadError as e:
+        return e.partial
+
+
+async def compress_stream(reader, writer, block_size=BLOCK_SIZE,
+                          executor=None, order=0, max_code_length=None):
+    """ Compress everything read from reader until EOF into writer.
+
+    The writer is drained but not closed.
+
+    @param asyncio.StreamReader reader: stream of bytes to compress
+    @param asyncio.StreamWriter writer: stream for the compressed bytes
+    @param int block_size: maximum number of bytes per block
+    @param concurrent.futures.Executor|NoneType executor: executor that
+        encodes blocks; the loop's default executor if None
+    @param int order: context order of the block codes, 0 or 1
+    @param int|NoneType max_code_length: maximum code length, if any
+    @rtype: NoneType
+    """
+    loop = asyncio.get_running_loop()
+    framer = FrameWriter()
+    writer.write(framer.header())
+    block = await read_block(reader, block_size)
+    while block:
+        frame = await loop.run_in_executor(executor, compress_block, block,
+                                           order, max_code_length)
+        writer.write(framer.frame(frame))
+        await writer.drain()
+        block = await read_block(reader, block_size)
+    writer.write(framer.trailer())
+    await writer.drain()
+
+
+async def uncompress_stream(reader, writer, executor=None):
+    """ Uncompress the FORMAT_BLOCKS stream read from reader into writer.
+
+    The writer is drained but not closed.
+
+    @param asyncio.StreamReader reader: stream of compressed bytes
+    @param asyncio.StreamWriter writer: stream for the uncompressed bytes
+    @param concurrent.futures.Executor|NoneType executor: executor that
+        decodes blocks; the loop's default executor if None
+    @rtype: NoneType
+    """
+    loop = asyncio.get_running_loop()
+    if await reader.readexactly(2) != bytes([FORMAT_MAGIC, FORMAT_BLOCKS]):
+        raise ValueError("uncompress_stream needs a FORMAT_BLOCKS stream")
+    parser = FrameReader()
+    while not parser.done:
+        frame = parser.feed(await reader.readexactly(parser.need))
+        if frame is None:
+            continue
+        block = await loop.run_in_executor(executor, decompress_block,
+                                           *frame)
+        writer.write(block)
+        await writer.drain()
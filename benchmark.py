@@ -0,0 +1,604 @@
+"""
+Benchmarks for compressing and decompressing using Huffman compression.
+
+Run from the repository root:
+
+    python benchmark.py                      time each pipeline stage
+    python benchmark.py --json out.json      ... and save the results
+    python benchmark.py --compare out.json   ... and fail on regressions
+    python benchmark.py --throughput         run the throughput benchmarks
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+from huffman import huffman_tree, get_codes, forget_codes, leaf_codes
+from huffman import generate_compressed, build_decode_table, table_decode
+from huffman import build_multi_table, multi_table_decode
+from huffman import code_table, pack_codes
+from huffman import compress, uncompress, make_freq_table, load_numpy
+from huffman import make_freq_dict, flat_huffman_tree, code_lengths
+from huffman import improve_tree, iter_blocks, BLOCK_SIZE
+from huffman import number_nodes, tree_to_bytes, bytes_to_nodes
+from huffman import generate_tree_general, generate_tree_postorder
+from huffman import generate_uncompressed
+from aiohuffman import compress_stream
+
+BENCH_FILES = ["book.txt", "music.wav", "music.mp3"]
+TABLE_BITS = [8, 10, 12, 14]
+WORKERS = [1, 2, 4, 8]
+
+# Inputs for the stage benchmarks: the bundled files, and synthetic
+# distributions at each size up to the --max-size limit.
+STAGE_FILES = ["book.txt", "music.wav", "music.mp3"]
+SYNTHETIC = ["uniform", "skewed", "single"]
+SIZES = [1 << 10, 1 << 16, 1 << 20, 1 << 24, 1 << 28]
+
+# Stages faster than this are too noisy to flag as regressions.
+NOISE_FLOOR = 1e-4
+
+
+def best_time(func, repeat=3):
+    """ Return the fastest wall-clock time of repeat calls to func.
+
+    @param callable func: a function taking no arguments
+    @param int repeat: number of timed calls
+    @rtype: float
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def synthetic(kind, size):
+    """ Return size bytes of the synthetic input kind: "uniform" bytes,
+    "skewed" bytes with geometrically falling frequencies, or a "single"
+    repeated byte.
+
+    A 1 MiB pattern is repeated to reach larger sizes, which leaves the
+    byte frequencies unchanged.
+
+    @param str kind: one of SYNTHETIC
+    @param int size: number of bytes
+    @rtype: bytes
+    """
+    rng = random.Random(0)
+    n = min(size, 1 << 20)
+    if kind == "uniform":
+        pattern = rng.randbytes(n)
+    elif kind == "skewed":
+        weights = [0.8 ** i for i in range(256)]
+        pattern = bytes(rng.choices(range(256), weights, k=n))
+    else:
+        pattern = b"a" * n
+    return (pattern * (size // n + 1))[:size]
+
+
+def stage_inputs(max_size):
+    """ Yield (name, text) for each stage benchmark input no larger than
+    max_size bytes.
+
+    @param int max_size: largest input size
+    @rtype: Generator[(str, bytes)]
+    """
+    for fname in STAGE_FILES:
+        with open(fname, "rb") as f:
+            text = f.read(max_size)
+        yield fname, text
+    for kind in SYNTHETIC:
+        for size in SIZES:
+            if size <= max_size:
+                yield "{}-{}".format(kind, size), synthetic(kind, size)
+
+
+def stage_times(text, repeat=3):
+    """ Return the best time in seconds of each stage of compressing and
+    uncompressing text, by stage name.
+
+    The tree-reading stages are skipped for a single-symbol text, whose
+    tree has no internal nodes to write.
+
+    @param bytes text: input to compress
+    @param int repeat: number of timed calls per stage
+    @rtype: dict(str,float)
+    """
+    times = {}
+
+    def timed(name, func):
+        times[name] = best_time(func, repeat)
+        return func()
+
+    freq = timed("make_freq_dict", lambda: make_freq_dict(text))
+    tree = timed("huffman_tree", lambda: huffman_tree(freq))
+
+    def uncached_codes():
+        # get_codes memoizes per tree, so time a fresh walk every call
+        forget_codes(tree)
+        return get_codes(tree)
+
+    codes = timed("get_codes", uncached_codes)
+    compressed = timed("generate_compressed",
+                       lambda: generate_compressed(text, codes))
+    number_nodes(tree)
+    tree_bytes = timed("tree_to_bytes", lambda: tree_to_bytes(tree))
+    nodes = bytes_to_nodes(tree_bytes)
+    if nodes:
+        timed("generate_tree_general",
+              lambda: generate_tree_general(nodes, len(nodes) - 1))
+        timed("generate_tree_postorder",
+              lambda: generate_tree_postorder(nodes, len(nodes) - 1))
+        timed("generate_uncompressed",
+              lambda: generate_uncompressed(tree, compressed, len(text)))
+    huf = io.BytesIO()
+    timed("compress", lambda: compress(io.BytesIO(text), io.BytesIO()))
+    compress(io.BytesIO(text), huf)
+    timed("uncompress", lambda: uncompress(io.BytesIO(huf.getvalue()),
+                                           io.BytesIO()))
+    return times
+
+
+def run_stages(max_size, repeat=3):
+    """ Return stage timings for every input up to max_size bytes, printing
+    each as it completes.
+
+    @param int max_size: largest input size
+    @param int repeat: number of timed calls per stage
+    @rtype: dict
+    """
+    results = {}
+    for name, text in stage_inputs(max_size):
+        times = stage_times(text, repeat)
+        results[name] = {"size": len(text), "stages": times}
+        for stage, elapsed in times.items():
+            print("{:<20} {:<24} {:10.3f} ms {:9.2f} MB/s".format(
+                name, stage, elapsed * 1e3,
+                len(text) / 1e6 / max(elapsed, 1e-9)))
+    return {"python": platform.python_version(),
+            "machine": platform.machine(), "results": results}
+
+
+def regressions(baseline, current, threshold):
+    """ Return a description of each stage in current that is more than
+    threshold (a fraction) slower than in baseline.
+
+    @param dict baseline: results of an earlier run_stages
+    @param dict current: results of this run_stages
+    @param float threshold: allowed fractional slowdown
+    @rtype: list[str]
+
+    >>> old = {"results": {"x": {"stages": {"a": 1.0, "b": 1.0}}}}
+    >>> new = {"results": {"x": {"stages": {"a": 1.1, "b": 1.5}}}}
+    >>> regressions(old, new, 0.2)
+    ['x b: 1000.000 ms -> 1500.000 ms (+50%)']
+    """
+    found = []
+    for name, result in current["results"].items():
+        old_stages = baseline["results"].get(name, {}).get("stages", {})
+        for stage, elapsed in result["stages"].items():
+            old = old_stages.get(stage)
+            if (old is not None and old >= NOISE_FLOOR and
+                    elapsed > old * (1 + threshold)):
+                found.append("{} {}: {:.3f} ms -> {:.3f} ms ({:+.0%})".format(
+                    name, stage, old * 1e3, elapsed * 1e3, elapsed / old - 1))
+    return found
+
+
+def bench_freq(fname):
+    """ Print frequency counting throughput on fname for each backend.
+
+    @param str fname: file to benchmark
+    @rtype: NoneType
+    """
+    with open(fname, "rb") as f:
+        text = f.read()
+    for backend in ["counter"] + (["numpy"] if load_numpy() else []):
+        elapsed = best_time(lambda: make_freq_table(text, backend))
+        print("count  {:<10} {:<7} {:8.2f} MB/s".format(
+            fname, backend, len(text) / 1e6 / elapsed))
+
+
+def bench_encode(fname):
+    """ Print encode throughput on fname for each packing backend.
+
+    @param str fname: file to benchmark
+    @rtype: NoneType
+    """
+    with open(fname, "rb") as f:
+        text = f.read()
+    values, lengths = code_table(get_codes(huffman_tree(make_freq_dict(
+        text))))
+    for backend in ["python"] + (["numpy"] if load_numpy() else []):
+        elapsed = best_time(lambda: pack_codes(text, values, lengths,
+                                               backend))
+        print("encode {:<10} {:<7} {:8.2f} MB/s".format(
+            fname, backend, len(text) / 1e6 / elapsed))
+
+
+def bench_decode(fname):
+    """ Print decode throughput on fname for each table width, with
+    single-symbol and multi-symbol tables.
+
+    @param str fname: file to benchmark
+    @rtype: NoneType
+    """
+    with open(fname, "rb") as f:
+        text = f.read()
+    tree = huffman_tree(make_freq_dict(text))
+    compressed = generate_compressed(text, get_codes(tree))
+    codes = leaf_codes(tree)
+    mb = len(text) / 1e6
+    for table_bits in TABLE_BITS:
+        table = build_decode_table(codes, table_bits)
+        elapsed = best_time(lambda: table_decode(table, compressed,
+                                                 len(text)))
+        multi = build_multi_table(codes, table_bits)
+        elapsed_multi = best_time(lambda: multi_table_decode(
+            multi, compressed, len(text)))
+        print("decode {:<10} k={:<2} {:8.2f} MB/s  multi {:8.2f} MB/s".format(
+            fname, table_bits, mb / elapsed, mb / elapsed_multi))
+
+
+def bench_workers(repeat=4, block_size=1 << 18):
+    """ Print compress and uncompress throughput for each worker count on
+    a corpus of book.txt and music.wav concatenated repeat times.
+
+    @param int repeat: number of copies of the corpus
+    @param int block_size: maximum number of bytes per block
+    @rtype: NoneType
+    """
+    corpus = b""
+    for name in BENCH_FILES:
+        with open(name, "rb") as f:
+            corpus += f.read()
+    corpus *= repeat
+    mb = len(corpus) / 1e6
+    for workers in WORKERS:
+        out = io.BytesIO()
+        elapsed = best_time(lambda: compress(io.BytesIO(corpus),
+                                             io.BytesIO(), block_size,
+                                             workers), 1)
+        compress(io.BytesIO(corpus), out, block_size)
+        data = out.getvalue()
+        elapsed_u = best_time(lambda: uncompress(io.BytesIO(data),
+                                                 io.BytesIO(), workers), 1)
+        print("corpus {:.1f} MB workers={:<2} compress {:8.2f} MB/s  "
+              "uncompress {:8.2f} MB/s".format(mb, workers, mb / elapsed,
+                                              mb / elapsed_u))
+
+
+def bench_streams(repeat=2, workers=4):
+    """ Print the size and uncompress throughput of book.txt repeated
+    repeat times as one block, coded as one stream and as four, decoded
+    serially and with workers processes.
+
+    @param int repeat: number of copies of book.txt
+    @param int workers: number of processes decoding streams
+    @rtype: NoneType
+    """
+    with open("book.txt", "rb") as f:
+        corpus = f.read() * repeat
+    mb = len(corpus) / 1e6
+    for streams in [1, 4]:
+        out = io.BytesIO()
+        compress(io.BytesIO(corpus), out, len(corpus), streams=streams)
+        data = out.getvalue()
+        for n in [1, workers]:
+            elapsed = best_time(lambda: uncompress(io.BytesIO(data),
+                                                   io.BytesIO(), n), 1)
+            print("streams={} {:.1f} MB one block {} bytes workers={} "
+                  "uncompress {:8.2f} MB/s".format(streams, mb, len(data), n,
+                                                   mb / elapsed))
+
+
+def bench_mmap(repeat=8):
+    """ Print compress and uncompress time and peak traced allocation with
+    and without memory mapping, on book.txt repeated repeat times.
+
+    @param int repeat: number of copies of book.txt
+    @rtype: NoneType
+    """
+    with open("book.txt", "rb") as f:
+        corpus = f.read() * repeat
+    mb = len(corpus) / 1e6
+    with tempfile.TemporaryDirectory() as tmp:
+        orig = os.path.join(tmp, "orig")
+        huf = os.path.join(tmp, "orig.huf")
+        out = os.path.join(tmp, "orig.huf.orig")
+        with open(orig, "wb") as f:
+            f.write(corpus)
+        del corpus
+        for use_mmap in [False, True]:
+            for name, func, args in [("compress", compress, (orig, huf)),
+                                     ("uncompress", uncompress, (huf, out))]:
+                elapsed = best_time(lambda: func(*args, use_mmap=use_mmap), 1)
+                tracemalloc.start()
+                func(*args, use_mmap=use_mmap)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                print("{:<10} {:.1f} MB mmap={!s:<5} {:8.2f} MB/s  "
+                      "peak {:6.1f} MB".format(name, mb, use_mmap,
+                                               mb / elapsed, peak / 1e6))
+
+
+def bench_order(fname):
+    """ Print compression ratio and throughput on fname for order-0 and
+    order-1 block codes.
+
+    @param str fname: file to benchmark
+    @rtype: NoneType
+    """
+    with open(fname, "rb") as f:
+        text = f.read()
+    mb = len(text) / 1e6
+    for order in [0, 1]:
+        out = io.BytesIO()
+        compress(io.BytesIO(text), out, order=order)
+        data = out.getvalue()
+        elapsed = best_time(lambda: compress(io.BytesIO(text), io.BytesIO(),
+                                             order=order), 1)
+        elapsed_u = best_time(lambda: uncompress(io.BytesIO(data),
+                                                 io.BytesIO()), 1)
+        print("order{} {:<10} ratio {:.3f}  compress {:8.2f} MB/s  "
+              "uncompress {:8.2f} MB/s".format(order, fname,
+                                              len(data) / len(text),
+                                              mb / elapsed, mb / elapsed_u))
+
+
+def bench_reuse(fname, block_size=BLOCK_SIZE // 16):
+    """ Print the per-block cost of rebuilding a tree against improving
+    the previous block's tree, then the time and ratio of a whole
+    compress call with and without tree reuse, on fname.
+
+    @param str fname: file to benchmark
+    @param int block_size: maximum number of bytes per block
+    @rtype: NoneType
+    """
+    with open(fname, "rb") as f:
+        text = f.read()
+    freqs = [make_freq_dict(block) for block in iter_blocks(
+        io.BytesIO(text), block_size)]
+    shape = flat_huffman_tree(freqs[0])
+
+    def rebuild():
+        for freq in freqs:
+            code_lengths(flat_huffman_tree(freq))
+
+    def improve():
+        for freq in freqs:
+            improve_tree(shape, freq)
+            code_lengths(shape)
+
+    for name, func in [("rebuild", rebuild), ("improve", improve)]:
+        elapsed = best_time(func)
+        print("tree   {:<10} {:<7} {:8.1f} us/block".format(
+            fname, name, elapsed / len(freqs) * 1e6))
+    for reuse_tree in [False, True]:
+        out = io.BytesIO()
+
+        def run():
+            out.seek(0)
+            out.truncate()
+            compress(io.BytesIO(text), out, block_size, reuse_tree=reuse_tree)
+
+        elapsed = best_time(run)
+        print("reuse={!s:<5} {:<10} {:8.3f} s  ratio {:.4f}".format(
+            reuse_tree, fname, elapsed, len(out.getvalue()) / len(text)))
+
+
+class FirstByteTimer(io.RawIOBase):
+    """ A writable sink recording when the first bytes after a two-byte
+    format header arrive, and how many bytes arrive in all.
+
+    Attributes:
+    ===========
+    @param float|NoneType first: perf_counter time of the first coded
+        bytes, if any
+    @param int written: number of bytes written
+    """
+
+    def __init__(self):
+        """ Create an empty sink.
+
+        @param FirstByteTimer self: this sink
+        @rtype: NoneType
+        """
+        super().__init__()
+        self.first = None
+        self.written = 0
+
+    def writable(self):
+        """ Return True: this is a writable sink.
+
+        @param FirstByteTimer self: this sink
+        @rtype: bool
+        """
+        return True
+
+    def write(self, b):
+        """ Count b, noting the time if it holds the first coded bytes.
+
+        @param FirstByteTimer self: this sink
+        @param bytes b: bytes written
+        @rtype: int
+        """
+        self.written += len(b)
+        if self.first is None and self.written > 2:
+            self.first = time.perf_counter()
+        return len(b)
+
+
+def bench_adaptive(fname):
+    """ Print latency to the first coded byte, throughput and ratio on
+    fname for static block coding and adaptive one-pass coding.
+
+    @param str fname: file to benchmark
+    @rtype: NoneType
+    """
+    with open(fname, "rb") as f:
+        text = f.read()
+    mb = len(text) / 1e6
+    for adaptive in [False, True]:
+        sink = FirstByteTimer()
+        start = time.perf_counter()
+        compress(io.BufferedReader(io.BytesIO(text)), sink,
+                 adaptive=adaptive)
+        elapsed = time.perf_counter() - start
+        print("{:<8} {:<10} first byte {:8.2f} ms  {:6.2f} MB/s  ratio "
+              "{:.3f}".format("adaptive" if adaptive else "static", fname,
+                              (sink.first - start) * 1e3, mb / elapsed,
+                              sink.written / len(text)))
+
+
+class NullWriter:
+    """ A stream writer that discards what is written to it. """
+
+    def write(self, data):
+        """ Discard data.
+
+        @param NullWriter self: this writer
+        @param bytes data: bytes written
+        @rtype: NoneType
+        """
+
+    async def drain(self):
+        """ Return at once: there is nothing to wait for.
+
+        @param NullWriter self: this writer
+        @rtype: NoneType
+        """
+
+
+async def loop_lag(streams, size, block_size, mode):
+    """ Return the total time and worst event-loop lag, in seconds, of
+    compressing streams streams of size bytes of book.txt at once.
+
+    @param int streams: number of concurrent streams
+    @param int size: bytes per stream
+    @param int block_size: maximum number of bytes per block
+    @param str mode: "inline" to compress on the loop, "threads" or
+        "processes" to use compress_stream with that kind of executor
+    @rtype: (float, float)
+    """
+    with open("book.txt", "rb") as f:
+        text = f.read(size)
+    worst = 0.0
+    done = False
+
+    async def ticker():
+        nonlocal worst
+        while not done:
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            worst = max(worst, time.perf_counter() - start - 0.001)
+
+    async def one(executor):
+        if mode == "inline":
+            await asyncio.sleep(0)
+            compress(io.BytesIO(text), io.BytesIO(), block_size)
+            return
+        source = asyncio.StreamReader()
+        source.feed_data(text)
+        source.feed_eof()
+        await compress_stream(source, NullWriter(), block_size, executor)
+
+    executor = ProcessPoolExecutor() if mode == "processes" else None
+    tick = asyncio.ensure_future(ticker())
+    start = time.perf_counter()
+    await asyncio.gather(*(one(executor) for _ in range(streams)))
+    elapsed = time.perf_counter() - start
+    done = True
+    await tick
+    if executor is not None:
+        executor.shutdown()
+    return elapsed, worst
+
+
+def bench_async(streams=16, size=1 << 18, block_size=1 << 15):
+    """ Print throughput and worst event-loop lag while many streams are
+    compressed at once, on the loop itself and through compress_stream.
+
+    @param int streams: number of concurrent streams
+    @param int size: bytes per stream
+    @param int block_size: maximum number of bytes per block
+    @rtype: NoneType
+    """
+    mb = streams * size / 1e6
+    for mode in ["inline", "threads", "processes"]:
+        elapsed, worst = asyncio.run(loop_lag(streams, size, block_size,
+                                              mode))
+        print("async  {} streams {:<9} {:8.2f} MB/s  worst lag "
+              "{:7.1f} ms".format(streams, mode, mb / elapsed, worst * 1e3))
+
+
+def run_throughput():
+    """ Run the throughput benchmarks.
+
+    @rtype: NoneType
+    """
+    for name in BENCH_FILES:
+        bench_freq(name)
+        bench_encode(name)
+        bench_decode(name)
+        bench_order(name)
+        bench_reuse(name)
+        bench_adaptive(name)
+    bench_workers()
+    bench_streams()
+    bench_mmap()
+    bench_async()
+
+
+def main(argv=None):
+    """ Run the benchmarks chosen by the command line argv, returning the
+    exit status: 1 if a comparison found regressions, otherwise 0.
+
+    @param list[str]|NoneType argv: arguments; sys.argv[1:] if None
+    @rtype: int
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--json", help="save stage timings to this file")
+    parser.add_argument("--compare",
+                        help="fail on regressions against this saved file")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed fractional slowdown (default 0.25)")
+    parser.add_argument("--max-size", type=int, default=1 << 20,
+                        help="largest input in bytes (default 1 MiB; "
+                             "up to {} for the full suite)".format(SIZES[-1]))
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="timed calls per stage (default 3)")
+    parser.add_argument("--throughput", action="store_true",
+                        help="run the throughput benchmarks instead")
+    args = parser.parse_args(argv)
+    if args.throughput:
+        run_throughput()
+        return 0
+    current = run_stages(args.max_size, args.repeat)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(current, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            found = regressions(json.load(f), current, args.threshold)
+        for line in found:
+            print("REGRESSION", line)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,7 +2,102 @@
 Code for compressing and decompressing using Huffman compression.
 """
 
-from nodes import HuffmanNode, ReadNode
+import bisect
+import heapq
+import io
+import math
+import mmap
+import os
+import sys
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+
+from adaptive import AdaptiveEncoder, AdaptiveDecoder
+from nodes import HuffmanNode, ReadNode, FlatTree
+
+# Number of bits indexed by each level of a decode table; codes longer
+# than this are resolved through second-level tables.
+DECODE_TABLE_BITS = 10
+
+# Multi-symbol decode tables index MULTI_TABLE_BITS bits and emit up to
+# MULTI_SYMBOLS symbols per lookup.  They cost more to build, so blocks
+# shorter than MULTI_MIN_SIZE bytes use single-symbol tables instead, as
+# do codes too long for two to fit in a lookup on average.
+MULTI_TABLE_BITS = 12
+MULTI_SYMBOLS = 4
+MULTI_MIN_SIZE = 1 << 16
+
+# pack_codes uses numpy, when installed, for texts of at least
+# NUMPY_PACK_MIN bytes, looking up NUMPY_PACK_CHUNK symbols at a time.
+NUMPY_PACK_MIN = 1 << 9
+NUMPY_PACK_CHUNK = 1 << 16
+
+# Number of trees whose code tables get_code_table keeps, evicting the least
+# recently used; entries keep their tree alive so ids cannot be reused.
+CODE_CACHE_SIZE = 64
+_code_cache = OrderedDict()
+_code_cache_lock = threading.Lock()
+
+# Versioned files start with FORMAT_MAGIC followed by a format byte.  Legacy
+# files start with their internal node count instead, which is never 0.
+FORMAT_MAGIC = 0
+FORMAT_CANONICAL = 1
+FORMAT_BLOCKS = 2
+FORMAT_TRAINED = 3
+FORMAT_ADAPTIVE = 4
+
+# FORMAT_BLOCKS files are a sequence of frames, each a block type byte,
+# the 64-bit uncompressed size and the 64-bit body size, then the body.
+# A BLOCK_END byte and the 64-bit total size close the stream.  Just
+# before it, a BLOCK_INDEX frame lists the 64-bit uncompressed offset and
+# file offset of each block frame, followed by the 64-bit entry count.
+BLOCK_SIZE = 1 << 20
+BLOCK_HUFFMAN = 0
+BLOCK_ORDER1 = 1
+BLOCK_STORED = 2
+BLOCK_STREAMS = 3
+BLOCK_INDEX = 254
+BLOCK_END = 255
+
+# In BLOCK_ORDER1 blocks, contexts (previous bytes) seen fewer than this
+# many times share one code instead of storing their own.
+ORDER1_MIN_CONTEXT = 512
+
+# BLOCK_STREAMS blocks split the block into contiguous parts, coded as
+# separate bitstreams with one canonical code so they can be decoded
+# independently: the lengths header, the stream count byte, the 64-bit
+# part size, the 64-bit payload size of every stream but the last, and
+# then the payloads.
+
+# Order-0 blocks whose sampled entropy, in bits per byte, is at least this
+# are stored as BLOCK_STORED without coding, as are blocks whose coded
+# body would be no smaller than the block.  The sample is SAMPLE_SLICES
+# evenly spaced slices of SAMPLE_SLICE_SIZE bytes.
+STORED_ENTROPY = 7.9
+SAMPLE_SLICES = 16
+SAMPLE_SLICE_SIZE = 1 << 12
+
+# With tree reuse, a block whose byte distribution is within this total
+# variation distance of the one that shaped the current tree keeps that
+# shape, with symbols reassigned by improve_tree.
+REUSE_TREE_DISTANCE = 0.05
+
+# FORMAT_ADAPTIVE input is read and coded this many bytes at a time at
+# most, so output follows input closely.
+ADAPTIVE_CHUNK_SIZE = 1 << 12
+
+# Files at least this large are memory-mapped rather than read.
+MMAP_THRESHOLD = 64 << 20
+
+# Trained trees are saved as TREE_FILE_MAGIC, the 32-bit tree id and the
+# code lengths, and are registered per process by id in _trained_trees,
+# each with its code lengths, code table and decode table.
+TREE_FILE_MAGIC = b"HUFT"
+_trained_trees = {}
 
 
 # ====================
@@ -56,31 +151,76 @@ def bits_to_byte(bits):
 # Functions for compression
 
 
-def make_freq_dict(text):
+@lru_cache(maxsize=None)
+def load_numpy():
+    """ Return the numpy module, or None if it is not installed.
+
+    NumPy is only imported the first time an accelerated path asks for it.
+
+    @rtype: module|NoneType
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def make_freq_table(text, backend=None):
+    """ Return a 256-entry list with the frequency of each byte in text.
+
+    text is read through a memoryview, so bytes, bytearray, memoryview
+    and mmap objects are counted without being copied.  The "numpy"
+    backend counts with numpy.bincount; the "counter" backend with
+    collections.Counter.  By default numpy is used when it is installed.
+
+    @param bytes|memoryview|mmap text: a bytes-like object
+    @param str|NoneType backend: "numpy", "counter" or None
+    @rtype: list[int]
+
+    >>> make_freq_table(bytes([65, 66, 67, 66]), "counter")[65:68]
+    [1, 2, 1]
+    """
+    buf = memoryview(text).cast("B")
+    if backend is None:
+        backend = "numpy" if load_numpy() else "counter"
+    if backend == "numpy":
+        np = load_numpy()
+        return np.bincount(np.frombuffer(buf, dtype=np.uint8),
+                           minlength=256).tolist()
+    if backend == "counter":
+        counts = Counter(buf)
+        return [counts[i] for i in range(256)]
+    raise ValueError("unknown frequency backend {}".format(backend))
+
+
+def make_freq_dict(text, backend=None):
     """ Return a dictionary that maps each byte in text to its frequency.
 
     @param bytes text: a bytes object
+    @param str|NoneType backend: counting backend for make_freq_table
     @rtype: dict(int,int)
 
     >>> d = make_freq_dict(bytes([65, 66, 67, 66]))
     >>> d == {65: 1, 66: 2, 67: 1}
     True
     """
-    d = {}
-    for i in text:
-        if i in d:
-            d[i] = d[i]+1
-        else:
-            d[i] = 1
-    return d
+    table = make_freq_table(text, backend)
+    return {i: table[i] for i in range(256) if table[i]}
 
 
-from nodes import HuffmanNode, ReadNode
-def huffman_tree(freq_dict):
+def huffman_tree(freq_dict, max_code_length=None):
     """ Return the root HuffmanNode of a Huffman tree corresponding
     to frequency dictionary freq_dict.
 
+    Nodes are merged through a heap keyed on (frequency, order), where
+    leaves are ordered by symbol and merged nodes follow in creation
+    order, so equal frequency tables always give identical trees.  With
+    max_code_length, a tree deeper than that is replaced by the optimal
+    tree of at most that depth.
+
     @param dict(int,int) freq_dict: a frequency dictionary
+    @param int|NoneType max_code_length: maximum code length, if any
     @rtype: HuffmanNode
 
     >>> freq = {2: 6, 3: 4}
@@ -89,38 +229,83 @@ def huffman_tree(freq_dict):
     >>> result2 = HuffmanNode(None, HuffmanNode(2), HuffmanNode(3))
     >>> t == result1 or t == result2
     True
+    >>> huffman_tree({1: 5, 2: 5, 3: 5}) == huffman_tree({3: 5, 2: 5, 1: 5})
+    True
+    >>> t = huffman_tree({1: 1, 2: 2, 3: 4, 4: 8}, 2)
+    >>> sorted(len(code) for code in get_codes(t).values())
+    [2, 2, 2, 2]
     """
-    freq = dict(freq_dict)
-    new = {}
-    if len(freq) == 1:
-        for i in freq:
-            return HuffmanNode(i)
-    while len(freq) > 1:
-        s1 = None
-        s2 = None
-        for i in freq:
-            if s1 == None or freq[i] < freq[s1]:
-                s2 = s1
-                s1 = i
-            elif s2 == None or freq[i] < freq[s2]:
-                s2 = i
-        h1 = s1
-        h2 = s2
-        if isinstance(s1, int):
-            s1 = HuffmanNode(h1)
-        else:
-            s1 = new[s1]
-        if isinstance(s2, int):
-            s2 = HuffmanNode(h2)
-        else:
-            s2 = new[s2]
-        freq[str(h1)+str(h2)]=freq[h1] + freq[h2]
-        new[str(h1)+str(h2)] = HuffmanNode(None,s1,s2)
-        freq.pop(h1)
-        freq.pop(h2)
-    for i in freq:
-        return new[i]
-                
+    flat = flat_huffman_tree(freq_dict)
+    if max_code_length is None:
+        return flat.to_node()
+    lengths = code_lengths(flat)
+    if max(lengths.values()) <= max_code_length:
+        return flat.to_node()
+    return tree_from_lengths(limited_code_lengths(freq_dict, max_code_length))
+
+
+def flat_huffman_tree(freq_dict):
+    """ Return the Huffman tree huffman_tree builds for freq_dict as a
+    FlatTree, without creating any HuffmanNode objects.
+
+    Leaves are added in symbol order and merged nodes in creation order,
+    so node indices double as the heap tie-breaker.
+
+    @param dict(int,int) freq_dict: a frequency dictionary
+    @rtype: FlatTree
+
+    >>> t = flat_huffman_tree({2: 6, 3: 4})
+    >>> list(t.symbol), list(t.left), t.root
+    ([2, 3, -1], [-1, -1, 1], 2)
+    """
+    flat = FlatTree()
+    heap = [(freq_dict[symbol], flat.add_leaf(symbol))
+            for symbol in sorted(freq_dict)]
+    heapq.heapify(heap)
+    while len(heap) > 1:
+        f1, left = heapq.heappop(heap)
+        f2, right = heapq.heappop(heap)
+        heapq.heappush(heap, (f1 + f2, flat.add_node(left, right)))
+    if heap:
+        flat.root = heap[0][1]
+    return flat
+
+
+def huffman_tree_sorted(freq_items):
+    """ Return the root HuffmanNode of a Huffman tree for freq_items,
+    using the linear-time two-queue construction.
+
+    The result is identical to huffman_tree(dict(freq_items)).
+
+    @param list[(int,int)] freq_items: (symbol, frequency) pairs
+    @rtype: HuffmanNode
+
+    Precondition: freq_items is sorted by (frequency, symbol).
+
+    >>> t = huffman_tree_sorted([(3, 4), (2, 6)])
+    >>> t == HuffmanNode(None, HuffmanNode(3), HuffmanNode(2))
+    True
+    >>> items = [(9, 1), (3, 2), (2, 7)]
+    >>> huffman_tree_sorted(items) == huffman_tree(dict(items))
+    True
+    """
+    if not freq_items:
+        return None
+    leaves = deque([(freq, HuffmanNode(symbol))
+                    for symbol, freq in freq_items])
+    merged = deque()
+
+    def pop_smallest():
+        """Pop the lighter queue front, preferring leaves on ties."""
+        if not merged or (leaves and leaves[0][0] <= merged[0][0]):
+            return leaves.popleft()
+        return merged.popleft()
+
+    while len(leaves) + len(merged) > 1:
+        f1, left = pop_smallest()
+        f2, right = pop_smallest()
+        merged.append((f1 + f2, HuffmanNode(None, left, right)))
+    return (leaves or merged)[0][1]
 
 
 def get_codes(tree):
@@ -134,18 +319,53 @@ def get_codes(tree):
     >>> d == {3: "0", 2: "1"}
     True
     """
-    return parse_tree(tree, "")
-        
-def parse_tree(node, code, codict={}):
-    dict1, dict2 = {}, {}
-    if node.is_leaf():
-        codict[node.symbol] = code
-        return codict
-    if node.left:
-        dict1 = parse_tree(node.left, code+"0", codict)
-    if node.right:
-        dict2 = parse_tree(node.right, code+"1", codict)
-    return {**dict1, **dict2}
+    return {symbol: format(pair[0], "0{}b".format(pair[1])) if pair[1] else ""
+            for symbol, pair in enumerate(get_code_table(tree)) if pair}
+
+
+def get_code_table(tree):
+    """ Return a 256-entry tuple holding the (code, length) pair of each
+    symbol in tree, or None for symbols not in tree.
+
+    Tables are memoized per tree object in a bounded LRU cache, so a tree
+    shared across many payloads is only walked once.  A tree must not be
+    reshaped after its codes are taken unless forget_codes is called.
+
+    @param HuffmanNode|FlatTree tree: a Huffman tree rooted at node 'tree'
+    @rtype: tuple[(int, int)|NoneType]
+
+    >>> left = HuffmanNode(None, HuffmanNode(3), HuffmanNode(2))
+    >>> table = get_code_table(HuffmanNode(None, left, HuffmanNode(9)))
+    >>> table[2], table[3], table[9], table[4]
+    ((1, 2), (0, 2), (1, 1), None)
+    """
+    with _code_cache_lock:
+        entry = _code_cache.get(id(tree))
+        if entry is not None and entry[0] is tree:
+            _code_cache.move_to_end(id(tree))
+            return entry[1]
+    table = [None] * 256
+    for symbol, code, length in leaf_codes(tree):
+        table[symbol] = (code, length)
+    table = tuple(table)
+    with _code_cache_lock:
+        _code_cache[id(tree)] = (tree, table)
+        while len(_code_cache) > CODE_CACHE_SIZE:
+            _code_cache.popitem(last=False)
+    return table
+
+
+def forget_codes(tree):
+    """ Drop any code table cached for tree by get_code_table.
+
+    @param HuffmanNode|FlatTree tree: a Huffman tree rooted at node 'tree'
+    @rtype: NoneType
+    """
+    with _code_cache_lock:
+        entry = _code_cache.get(id(tree))
+        if entry is not None and entry[0] is tree:
+            del _code_cache[id(tree)]
+
 
 def number_nodes(tree):
     """ Number internal nodes in tree according to postorder traversal;
@@ -165,16 +385,20 @@ def number_nodes(tree):
     >>> tree.number
     2
     """
-    parse_num(tree,0)
+    counter = 0
+    stack = [(tree, False)]
+    while stack:
+        node, visited = stack.pop()
+        if node.is_leaf():
+            continue
+        if visited:
+            node.number = counter
+            counter += 1
+        else:
+            stack.append((node, True))
+            stack.append((node.right, False))
+            stack.append((node.left, False))
 
-def parse_num(node,counter):
-    if node.symbol != None:
-        return counter
-    counter = parse_num(node.left,counter)
-    counter = parse_num(node.right,counter)
-    node.number = counter
-    counter = counter + 1
-    return counter
 
 def avg_length(tree, freq_dict):
     """ Return the number of bits per symbol required to compress text
@@ -191,14 +415,48 @@ def avg_length(tree, freq_dict):
     >>> avg_length(tree, freq)
     1.9
     """
-    newdict = get_codes(tree)
+    table = get_code_table(tree)
     totalbits = 0
     totalchar = 0
     for i in freq_dict:
-        totalbits = totalbits + len(str(newdict[i]))*freq_dict[i]
+        totalbits = totalbits + table[i][1]*freq_dict[i]
         totalchar = totalchar + freq_dict[i]
     return totalbits/totalchar
 
+def code_table(codes):
+    """ Return parallel 256-entry lists of integer codes and code lengths
+    for the string codes in codes; absent symbols have length 0.
+
+    @param dict(int,str) codes: mapping from symbols to codes
+    @rtype: (list[int], list[int])
+
+    >>> values, lengths = code_table({0: "0", 1: "10", 2: "11"})
+    >>> values[:3], lengths[:4]
+    ([0, 2, 3], [1, 2, 2, 0])
+    """
+    return triples_to_table([(symbol, int(code, 2) if code else 0, len(code))
+                             for symbol, code in codes.items()])
+
+
+def triples_to_table(triples):
+    """ Return parallel 256-entry lists of integer codes and code lengths
+    for the (symbol, code, length) triples in triples.
+
+    @param list[(int, int, int)] triples: (symbol, code, length) triples
+    @rtype: (list[int], list[int])
+
+    >>> values, lengths = triples_to_table([(1, 2, 2), (0, 0, 1)])
+    >>> values[:2], lengths[:3]
+    ([0, 2], [1, 2, 0])
+    """
+    values = [0] * 256
+    lengths = [0] * 256
+    for symbol, code, length in triples:
+        values[symbol] = code
+        lengths[symbol] = length
+    return values, lengths
+
+
 def generate_compressed(text, codes):
     """ Return compressed form of text, using mapping in codes for each symbol.
 
@@ -216,25 +474,114 @@ def generate_compressed(text, codes):
     >>> [byte_to_bits(byte) for byte in result]
     ['10111001', '10000000']
     """
-    convert = ""
+    values, lengths = code_table(codes)
+    return bytes(pack_codes(text, values, lengths))
+
+
+def pack_codes(text, values, lengths, backend=None):
+    """ Return text encoded with the integer codes in values and lengths,
+    packed MSB-first and padded with zero bits to a whole byte.
+
+    The "python" backend shifts codes into an integer accumulator which
+    is flushed into a preallocated bytearray 32 bits at a time; the
+    "numpy" backend is pack_codes_numpy.  By default numpy is used when
+    it is installed, text is at least NUMPY_PACK_MIN bytes and no code is
+    longer than 64 bits.
+
+    @param bytes text: a bytes object
+    @param list[int] values: integer code for each symbol
+    @param list[int] lengths: code length in bits for each symbol
+    @param str|NoneType backend: "numpy", "python" or None
+    @rtype: bytearray
+
+    >>> list(pack_codes(bytes([1, 2, 1, 0]), [0, 2, 3], [1, 2, 2]))
+    [184]
+    """
+    if backend is None:
+        backend = ("numpy" if len(text) >= NUMPY_PACK_MIN and
+                   max(lengths) <= 64 and load_numpy() else "python")
+    if backend == "numpy":
+        return pack_codes_numpy(text, values, lengths)
+    if backend != "python":
+        raise ValueError("unknown packing backend {}".format(backend))
+    total = sum(map(lengths.__getitem__, text))
+    out = bytearray((total + 7) // 8)
+    acc = 0
+    nbits = 0
+    pos = 0
     for i in text:
-        convert = convert + codes[i]
-    while len(convert)%8 != 0:
-        convert = convert + "0"
-    bytelist = []
-    while len(convert)>7:
-        bytelist.append(convert[:8])
-        convert = convert[8:]
-        symbollist = []
-    for i in bytelist:
-        symbollist.append(bits_to_byte(i))
-    return bytes(symbollist)
+        acc = (acc << lengths[i]) | values[i]
+        nbits += lengths[i]
+        if nbits >= 32:
+            while nbits >= 32:
+                nbits -= 32
+                out[pos:pos + 4] = ((acc >> nbits) & 0xFFFFFFFF).to_bytes(
+                    4, "big")
+                pos += 4
+            acc &= (1 << nbits) - 1
+    if nbits:
+        tail = (nbits + 7) // 8
+        out[pos:pos + tail] = (acc << (8 * tail - nbits)).to_bytes(tail, "big")
+    return out
+
+
+def pack_codes_numpy(text, values, lengths):
+    """ Return text encoded as by pack_codes, using numpy.
+
+    Codes and lengths are looked up for NUMPY_PACK_CHUNK symbols at a
+    time, their bit offsets found by a cumulative sum, and each code
+    added into the one or two 64-bit words it covers; the codes in a
+    word occupy disjoint bits, so adding them is the same as or-ing them.
+
+    @param bytes|memoryview text: a bytes-like object
+    @param list[int] values: integer code for each symbol
+    @param list[int] lengths: code length in bits for each symbol
+    @rtype: bytearray
+
+    Precondition: numpy is installed and no code is longer than 64 bits.
+
+    >>> list(pack_codes_numpy(bytes([1, 2, 1, 0]), [0, 2, 3], [1, 2, 2]))
+    [184]
+    """
+    np = load_numpy()
+    if max(lengths) > 64:
+        raise ValueError("the numpy backend needs codes of at most 64 bits")
+    symbols = np.frombuffer(memoryview(text).cast("B"), dtype=np.uint8)
+    value_table = np.array(values, dtype=np.uint64)
+    length_table = np.array(lengths, dtype=np.uint64)
+    parts = []
+    carry, carry_bits = np.uint64(0), 0
+    for start in range(0, len(symbols), NUMPY_PACK_CHUNK):
+        chunk = symbols[start:start + NUMPY_PACK_CHUNK]
+        codes, lens = value_table[chunk], length_table[chunk]
+        ends = np.cumsum(lens) + np.uint64(carry_bits)
+        starts = ends - lens
+        word = starts >> np.uint64(6)
+        room = np.uint64(64) - (starts & np.uint64(63))
+        fits = lens <= room
+        total = int(ends[-1])
+        words = np.zeros(total // 64 + 1, dtype=np.uint64)
+        words[0] = carry
+        # the part of each code in its first word, aligned to the left
+        high = ((codes >> np.where(fits, 0, lens - room)) <<
+                np.where(fits, room - lens, 0))
+        first = np.flatnonzero(np.concatenate(([True],
+                                               word[1:] != word[:-1])))
+        words[word[first]] += np.add.reduceat(high, first)
+        # the rest of each code that spills into the next word
+        spills = ~fits
+        words[word[spills] + np.uint64(1)] += (
+            codes[spills] << (np.uint64(64) - (lens[spills] - room[spills])))
+        parts.append(words[:total // 64].astype(">u8").tobytes())
+        carry, carry_bits = words[total // 64], total % 64
+    tail = int(carry).to_bytes(8, "big")[:(carry_bits + 7) // 8]
+    return bytearray(b"".join(parts) + tail)
 
 
 def tree_to_bytes(tree):
     """ Return a bytes representation of the Huffman tree rooted at tree.
 
-    @param HuffmanNode tree: a Huffman tree rooted at node 'tree'
+    @param HuffmanNode|FlatTree tree: a Huffman tree rooted at node 'tree'
     @rtype: bytes
 
     The representation should be based on the postorder traversal of tree
@@ -252,34 +599,18 @@ def tree_to_bytes(tree):
     >>> list(tree_to_bytes(tree))
     [0, 3, 0, 2, 1, 0, 0, 5]
     """
+    flat = as_flat_tree(tree)
+    internal = flat.postorder()
+    number = {index: i for i, index in enumerate(internal)}
     items = []
-    lleaf = False
-    rleaf = False
-    if not tree.is_leaf():
-        if not tree.left.is_leaf():
-            a = tree_to_bytes(tree.left)
-            for i in a:
-                items.append(i)
-        else:
-            lleaf = True
-        if not tree.right.is_leaf():
-            a = tree_to_bytes(tree.right)
-            for i in a:
-                items.append(i)
-        else:
-            rleaf = True
-    if lleaf:
-        items.append(0)
-        items.append(tree.left.symbol)
-    else:
-        items.append(1)
-        items.append(tree.left.number)
-    if rleaf:
-        items.append(0)
-        items.append(tree.right.symbol)
-    else:
-        items.append(1)
-        items.append(tree.right.number)
+    for index in internal:
+        for child in (flat.left[index], flat.right[index]):
+            if flat.is_leaf(child):
+                items.append(0)
+                items.append(flat.symbol[child])
+            else:
+                items.append(1)
+                items.append(number[child])
     return bytes(items)
 
 
@@ -287,47 +618,1151 @@ def num_nodes_to_bytes(tree):
     """ Return number of nodes required to represent tree (the root of a
     numbered Huffman tree).
 
-    @param HuffmanNode tree: a Huffman tree rooted at node 'tree'
+    @param HuffmanNode|FlatTree tree: a Huffman tree rooted at node 'tree'
     @rtype: bytes
     """
+    if isinstance(tree, FlatTree):
+        return bytes([len(tree.postorder())])
     return bytes([tree.number + 1])
 
 
-def size_to_bytes(size):
+def as_flat_tree(tree):
+    """ Return tree as a FlatTree, converting it if it is a HuffmanNode.
+
+    @param HuffmanNode|FlatTree tree: a Huffman tree
+    @rtype: FlatTree
+    """
+    if isinstance(tree, FlatTree):
+        return tree
+    return FlatTree.from_node(tree)
+
+
+def size_to_bytes(size, nbytes=4):
     """ Return the size as a bytes object.
 
     @param int size: a 32-bit integer to convert to bytes
+    @param int nbytes: number of bytes to use, 8 for 64-bit sizes
     @rtype: bytes
 
     >>> list(size_to_bytes(300))
     [44, 1, 0, 0]
+    >>> len(size_to_bytes(1 << 40, 8))
+    8
     """
     # little-endian representation of 32-bit (4-byte)
     # int size
-    return size.to_bytes(4, "little")
+    return size.to_bytes(nbytes, "little")
 
 
-def compress(in_file, out_file):
-    """ Compress contents of in_file and store results in out_file.
+# ====================
+# Canonical codes
 
-    @param str in_file: input file to compress
-    @param str out_file: output file to store compressed result
-    @rtype: NoneType
+
+def code_lengths(tree):
+    """ Return a dict mapping each symbol in tree to its code length.
+
+    @param HuffmanNode|FlatTree tree: a Huffman tree rooted at node 'tree'
+    @rtype: dict(int,int)
+
+    >>> left = HuffmanNode(None, HuffmanNode(3), HuffmanNode(2))
+    >>> code_lengths(HuffmanNode(None, left, HuffmanNode(9))) == \
+    {3: 2, 2: 2, 9: 1}
+    True
+    """
+    return {symbol: length for symbol, _, length in leaf_codes(tree)}
+
+
+def canonical_codes(lengths):
+    """ Return the canonical code for the code lengths in lengths as
+    (symbol, code, length) triples.
+
+    Symbols are ordered by (length, symbol) and each takes the next
+    integer code, shifted left whenever the length grows, so the code
+    depends only on lengths.
+
+    @param dict(int,int) lengths: mapping from symbols to code lengths
+    @rtype: list[(int, int, int)]
+
+    >>> canonical_codes({3: 2, 2: 2, 9: 1})
+    [(9, 0, 1), (2, 2, 2), (3, 3, 2)]
+    """
+    triples = []
+    code = 0
+    prev = 0
+    for length, symbol in sorted((length, symbol)
+                                 for symbol, length in lengths.items()):
+        code <<= length - prev
+        triples.append((symbol, code, length))
+        code += 1
+        prev = length
+    return triples
+
+
+def limited_code_lengths(freq_dict, max_code_length):
+    """ Return optimal code lengths for freq_dict with no code longer than
+    max_code_length, using the package-merge algorithm.
+
+    Symbols sorted by frequency are repeatedly paired into packages,
+    which are merged back among the symbols; the 2n - 2 lightest items
+    of the last list give each symbol's code length as the number of
+    times it occurs in them.
+
+    @param dict(int,int) freq_dict: a frequency dictionary
+    @param int max_code_length: maximum code length
+    @rtype: dict(int,int)
+
+    Precondition: 2 ** max_code_length >= len(freq_dict)
+
+    >>> limited_code_lengths({1: 1, 2: 2, 3: 4, 4: 8}, 2) == \
+    {1: 2, 2: 2, 3: 2, 4: 2}
+    True
+    >>> limited_code_lengths({1: 1, 2: 2, 3: 4, 4: 8}, 3) == \
+    {1: 3, 2: 3, 3: 2, 4: 1}
+    True
+    """
+    if len(freq_dict) < 2:
+        return {symbol: 0 for symbol in freq_dict}
+    if 1 << max_code_length < len(freq_dict):
+        raise ValueError("{} symbols cannot be coded in {} bits".format(
+            len(freq_dict), max_code_length))
+    leaves = [(freq_dict[symbol], (symbol,)) for symbol in
+              sorted(freq_dict, key=lambda symbol: (freq_dict[symbol],
+                                                    symbol))]
+    items = leaves
+    for _ in range(max_code_length - 1):
+        packages = [(items[i][0] + items[i + 1][0],
+                     items[i][1] + items[i + 1][1])
+                    for i in range(0, len(items) - 1, 2)]
+        items = list(heapq.merge(leaves, packages, key=lambda item: item[0]))
+    lengths = dict.fromkeys(freq_dict, 0)
+    for _, symbols in items[:2 * len(freq_dict) - 2]:
+        for symbol in symbols:
+            lengths[symbol] += 1
+    return lengths
+
+
+def block_code_lengths(freq_dict, max_code_length=None):
+    """ Return the Huffman code lengths for freq_dict, limited to
+    max_code_length if given.
+
+    @param dict(int,int) freq_dict: a frequency dictionary
+    @param int|NoneType max_code_length: maximum code length, if any
+    @rtype: dict(int,int)
+
+    >>> block_code_lengths({1: 1, 2: 2, 3: 4, 4: 8}, 2) == \
+    {1: 2, 2: 2, 3: 2, 4: 2}
+    True
+    """
+    lengths = code_lengths(flat_huffman_tree(freq_dict))
+    if max_code_length is not None and max(lengths.values()) > max_code_length:
+        return limited_code_lengths(freq_dict, max_code_length)
+    return lengths
+
+
+def tree_from_lengths(lengths):
+    """ Return the root HuffmanNode of the canonical code for lengths.
+
+    @param dict(int,int) lengths: mapping from symbols to code lengths
+    @rtype: HuffmanNode
+
+    Precondition: lengths describes a complete prefix code.
+
+    >>> tree_from_lengths({3: 2, 2: 2, 9: 1})
+    HuffmanNode(None, HuffmanNode(9, None, None), \
+HuffmanNode(None, HuffmanNode(2, None, None), HuffmanNode(3, None, None)))
+    """
+    if len(lengths) == 1:
+        return HuffmanNode(next(iter(lengths)))
+    root = HuffmanNode()
+    for symbol, code, length in canonical_codes(lengths):
+        node = root
+        for shift in range(length - 1, 0, -1):
+            if (code >> shift) & 1:
+                node.right = node.right or HuffmanNode()
+                node = node.right
+            else:
+                node.left = node.left or HuffmanNode()
+                node = node.left
+        if code & 1:
+            node.right = HuffmanNode(symbol)
+        else:
+            node.left = HuffmanNode(symbol)
+    return root
+
+
+def length_limit_cost(freq_dict, max_code_length):
+    """ Return how many more bits per symbol freq_dict costs with codes
+    limited to max_code_length than with unlimited Huffman codes.
+
+    @param dict(int,int) freq_dict: a frequency dictionary
+    @param int max_code_length: maximum code length
+    @rtype: float
+
+    >>> round(length_limit_cost({1: 1, 2: 2, 3: 4, 4: 8}, 2), 3)
+    0.333
+    """
+    return (avg_length(huffman_tree(freq_dict, max_code_length), freq_dict) -
+            avg_length(huffman_tree(freq_dict), freq_dict))
+
+
+def lengths_to_bytes(lengths):
+    """ Return a bytes representation of the code lengths in lengths.
+
+    The first byte is the number of symbols minus one.  Up to 128
+    symbols are stored as (symbol, length) pairs; larger alphabets as
+    one length byte for each of the 256 symbols, 0 meaning absent.
+
+    @param dict(int,int) lengths: mapping from symbols to code lengths
+    @rtype: bytes
+
+    >>> list(lengths_to_bytes({3: 2, 2: 2, 9: 1}))
+    [2, 2, 2, 3, 2, 9, 1]
+    """
+    if len(lengths) <= 128:
+        items = [len(lengths) - 1]
+        for symbol in sorted(lengths):
+            items.append(symbol)
+            items.append(lengths[symbol])
+        return bytes(items)
+    return bytes([len(lengths) - 1] + [lengths.get(symbol, 0)
+                                       for symbol in range(256)])
+
+
+def read_lengths(f):
+    """ Return the code lengths read from the representation written by
+    lengths_to_bytes at the current position of file f.
+
+    @param file f: a binary file open for reading
+    @rtype: dict(int,int)
+
+    >>> read_lengths(io.BytesIO(bytes([2, 2, 2, 3, 2, 9, 1]))) == \
+    {3: 2, 2: 2, 9: 1}
+    True
+    """
+    count = read_exact(f, 1)[0] + 1
+    if count <= 128:
+        buf = read_exact(f, 2 * count)
+        lengths = {buf[i]: buf[i + 1] for i in range(0, len(buf), 2)}
+    else:
+        buf = read_exact(f, 256)
+        lengths = {symbol: buf[symbol] for symbol in range(256)
+                   if buf[symbol]}
+    if len(lengths) != count or not is_complete_code(lengths):
+        raise ValueError("corrupt compressed file: bad code lengths")
+    return lengths
+
+
+def is_complete_code(lengths):
+    """ Return True iff lengths are the code lengths of a complete prefix
+    code, one whose codes exactly fill the code space, or of a single
+    symbol coded in zero bits.
+
+    @param dict(int,int) lengths: a non-empty mapping from symbols to
+        code lengths
+    @rtype: bool
+
+    >>> is_complete_code({97: 1, 98: 1}), is_complete_code({97: 0})
+    (True, True)
+    >>> is_complete_code({97: 1, 98: 2}), is_complete_code({97: 1, 98: 1, \
+99: 1})
+    (False, False)
+    """
+    if len(lengths) == 1:
+        return next(iter(lengths.values())) == 0
+    longest = max(lengths.values())
+    return (min(lengths.values()) > 0 and
+            sum(1 << (longest - length) for length in lengths.values()) ==
+            1 << longest)
+
+
+def encode_canonical(text, max_code_length=None, lengths=None):
+    """ Return the code lengths header for text followed by text encoded
+    with the canonical code for those lengths.
+
+    @param bytes text: a non-empty bytes object
+    @param int|NoneType max_code_length: maximum code length, if any
+    @param dict(int,int)|NoneType lengths: code lengths to use in place of
+        building a tree for text; they must cover every byte of text
+    @rtype: bytes
+
+    >>> list(encode_canonical(bytes([1, 2, 1, 0])))
+    [2, 0, 2, 1, 1, 2, 2, 104]
+    """
+    if lengths is None:
+        lengths = block_code_lengths(make_freq_dict(text), max_code_length)
+    values, lens = triples_to_table(canonical_codes(lengths))
+    return lengths_to_bytes(lengths) + pack_codes(text, values, lens)
+
+
+def split_streams(text, streams):
+    """ Return text split into streams contiguous parts of equal size,
+    except that the last parts may be shorter or empty.
+
+    @param bytes text: a bytes object
+    @param int streams: number of parts
+    @rtype: list[bytes]
+
+    >>> split_streams(b"abcdefghij", 4)
+    [b'abc', b'def', b'ghi', b'j']
+    """
+    part = -(-len(text) // streams)
+    return [text[i * part:(i + 1) * part] for i in range(streams)]
+
+
+def encode_streams(text, streams, max_code_length=None, lengths=None):
+    """ Return the BLOCK_STREAMS body coding text as streams separate
+    bitstreams with one canonical code.
+
+    @param bytes text: a non-empty bytes object
+    @param int streams: number of bitstreams, from 1 to 255
+    @param int|NoneType max_code_length: maximum code length, if any
+    @param dict(int,int)|NoneType lengths: code lengths to use in place of
+        building a tree for text; they must cover every byte of text
+    @rtype: bytes
+
+    >>> body = encode_streams(bytes([1, 2, 1, 0, 1]), 2)
+    >>> list(body[7:8]), bytes_to_size(body[8:16]), len(body)
+    ([2], 3, 26)
     """
-    with open(in_file, "rb") as f1:
-        text = f1.read()
-    freq = make_freq_dict(text)
-    tree = huffman_tree(freq)
-    codes = get_codes(tree)
-    print(tree)
-    number_nodes(tree)
-    print("Bits per symbol:", avg_length(tree, freq))
-    result = (num_nodes_to_bytes(tree) + tree_to_bytes(tree) +
-              size_to_bytes(len(text)))
-    result += generate_compressed(text, codes)
-    print(result)
-    with open(out_file, "wb") as f2:
-        f2.write(result)
+    if lengths is None:
+        lengths = block_code_lengths(make_freq_dict(text), max_code_length)
+    values, lens = triples_to_table(canonical_codes(lengths))
+    parts = split_streams(text, streams)
+    payloads = [pack_codes(part, values, lens) for part in parts]
+    return (lengths_to_bytes(lengths) + bytes([streams]) +
+            size_to_bytes(len(parts[0]), 8) +
+            b"".join(size_to_bytes(len(payload), 8)
+                     for payload in payloads[:-1]) +
+            b"".join(payloads))
+
+
+def compress_canonical(text):
+    """ Return text compressed with a canonical Huffman code, preceded by
+    the FORMAT_CANONICAL header.
+
+    @param bytes text: a bytes object
+    @rtype: bytes
+
+    >>> list(compress_canonical(bytes([1, 2, 1, 0])))
+    [0, 1, 4, 0, 0, 0, 2, 0, 2, 1, 1, 2, 2, 104]
+    """
+    result = bytes([FORMAT_MAGIC, FORMAT_CANONICAL]) + size_to_bytes(len(text))
+    if not text:
+        return result
+    return result + encode_canonical(text)
+
+
+# ====================
+# Trained trees
+
+
+def train_tree(sample):
+    """ Return code lengths for all 256 byte values, trained on sample.
+
+    Every byte value is counted once more than it occurs in sample, so
+    the code can encode any input.
+
+    @param bytes sample: a sample of the data to be compressed
+    @rtype: dict(int,int)
+
+    >>> lengths = train_tree(b"aaaa")
+    >>> len(lengths), lengths[ord("a")] < lengths[ord("b")]
+    (256, True)
+    """
+    table = make_freq_table(sample)
+    return code_lengths(flat_huffman_tree(
+        {symbol: table[symbol] + 1 for symbol in range(256)}))
+
+
+def trained_tree_id(lengths):
+    """ Return the 32-bit id of the trained code lengths in lengths.
+
+    @param dict(int,int) lengths: code lengths for all 256 byte values
+    @rtype: int
+    """
+    return zlib.crc32(bytes([lengths[symbol] for symbol in range(256)]))
+
+
+def register_tree(lengths):
+    """ Register the trained code lengths in lengths for this process and
+    return their id.
+
+    The canonical code and its decode table are built once here and
+    shared by every later compress_trained and decompress_trained call.
+    Different lengths whose ids collide raise ValueError rather than
+    silently sharing the first table.
+
+    @param dict(int,int) lengths: code lengths for all 256 byte values
+    @rtype: int
+
+    >>> lengths = train_tree(b"abc")
+    >>> register_tree(lengths) == trained_tree_id(lengths)
+    True
+    """
+    if len(lengths) != 256:
+        raise ValueError("a trained tree must code all 256 byte values")
+    key = trained_tree_id(lengths)
+    if key in _trained_trees:
+        if _trained_trees[key][0] != lengths:
+            raise ValueError("trained tree id {:08x} is already registered "
+                             "for other code lengths".format(key))
+        return key
+    triples = canonical_codes(lengths)
+    _trained_trees[key] = (dict(lengths), triples_to_table(triples),
+                           build_multi_table(triples, MULTI_TABLE_BITS))
+    return key
+
+
+def trained_tree(key):
+    """ Return the (code table, multi-symbol decode table) pair registered
+    for key.
+
+    @param int key: a trained tree id
+    @rtype: ((list[int], list[int]), (int, list, list[int]))
+    """
+    try:
+        return _trained_trees[key][1:]
+    except KeyError:
+        raise ValueError("unknown trained tree id {:08x}".format(key))
+
+
+def save_tree(lengths, path):
+    """ Save the trained code lengths in lengths to path, register them
+    and return their id.
+
+    @param dict(int,int) lengths: code lengths for all 256 byte values
+    @param str path: file to write
+    @rtype: int
+    """
+    key = register_tree(lengths)
+    with open(path, "wb") as f:
+        f.write(TREE_FILE_MAGIC + size_to_bytes(key) +
+                lengths_to_bytes(lengths))
+    return key
+
+
+def load_tree(path):
+    """ Load and register the trained tree saved at path and return its
+    id.
+
+    @param str path: a file written by save_tree
+    @rtype: int
+    """
+    with open(path, "rb") as f:
+        if f.read(len(TREE_FILE_MAGIC)) != TREE_FILE_MAGIC:
+            raise ValueError("{} is not a trained tree file".format(path))
+        key = bytes_to_size(read_exact(f, 4))
+        lengths = read_lengths(f)
+    if register_tree(lengths) != key:
+        raise ValueError("corrupt trained tree file {}".format(path))
+    return key
+
+
+def compress_trained(text, key):
+    """ Return text compressed with the registered trained tree key,
+    preceded by the FORMAT_TRAINED header.
+
+    The header holds only the tree id and size, which suits small
+    messages that would not repay a tree of their own.
+
+    @param bytes text: a bytes object
+    @param int key: a registered trained tree id
+    @rtype: bytes
+    """
+    (values, lengths), _ = trained_tree(key)
+    return (bytes([FORMAT_MAGIC, FORMAT_TRAINED]) + size_to_bytes(key) +
+            size_to_bytes(len(text)) + pack_codes(text, values, lengths))
+
+
+# ====================
+# Adaptive coding
+
+
+def compress_adaptive(f, stats=None):
+    """ Yield the FORMAT_ADAPTIVE compressed form of the contents of f.
+
+    The input is coded in one pass as it is read, without a stored tree,
+    so each chunk's output is yielded as soon as the chunk arrives.
+
+    @param file f: a binary file open for reading
+    @param Stats|NoneType stats: statistics to record the read and encode
+        times in, if any
+    @rtype: Generator[bytes]
+
+    >>> data = b"".join(compress_adaptive(io.BytesIO(b"abracadabra")))
+    >>> list(data[:2]), len(data)
+    ([0, 4], 12)
+    """
+    yield bytes([FORMAT_MAGIC, FORMAT_ADAPTIVE])
+    read = getattr(f, "read1", f.read)
+    encoder = AdaptiveEncoder()
+    for chunk in timed_iter(iter(lambda: read(ADAPTIVE_CHUNK_SIZE), b""),
+                            stats, "read"):
+        if stats is not None:
+            stats.uncompressed_size += len(chunk)
+            stats.peak_buffer = max(stats.peak_buffer, len(chunk))
+        with stats.timed("encode") if stats is not None else nullcontext():
+            data = encoder.encode(chunk)
+        if data:
+            yield data
+    yield encoder.finish()
+
+
+# ====================
+# Order-1 context modelling
+
+
+def order1_lengths(block, max_code_length=None):
+    """ Return (own, shared) code lengths for coding block with a code per
+    previous byte.
+
+    own maps each context seen at least ORDER1_MIN_CONTEXT times to the
+    code lengths for the bytes following it; the remaining contexts
+    share the lengths in shared, which is empty if there are none.  The
+    first byte of a block has context 0.
+
+    @param bytes block: a non-empty bytes object
+    @param int|NoneType max_code_length: maximum code length, if any
+    @rtype: (dict(int,dict(int,int)), dict(int,int))
+
+    >>> own, shared = order1_lengths(b"ab" * 600)
+    >>> own == {97: {98: 0}, 98: {97: 0}}, shared
+    (True, {97: 0})
+    """
+    counts = {}
+    for (prev, symbol), n in Counter(zip(b"\0" + bytes(block[:-1]),
+                                         block)).items():
+        counts.setdefault(prev, {})[symbol] = n
+    own = {}
+    pooled = {}
+    for prev, freq in counts.items():
+        if sum(freq.values()) >= ORDER1_MIN_CONTEXT:
+            own[prev] = block_code_lengths(freq, max_code_length)
+        else:
+            for symbol, n in freq.items():
+                pooled[symbol] = pooled.get(symbol, 0) + n
+    shared = block_code_lengths(pooled, max_code_length) if pooled else {}
+    return own, shared
+
+
+def pack_codes_order1(text, values, lengths):
+    """ Return text encoded with a code per previous byte, packed like
+    pack_codes; values[p] and lengths[p] are the code for context p.
+
+    @param bytes text: a bytes object
+    @param list[list[int]] values: integer codes for each context
+    @param list[list[int]] lengths: code lengths for each context
+    @rtype: bytearray
+
+    >>> ctx0 = ([0, 0, 0], [0, 1, 1])
+    >>> ctx1 = ([0, 0, 1], [0, 1, 1])
+    >>> ctx2 = ([0, 0, 0], [0, 1, 0])
+    >>> values, lengths = zip(ctx0, ctx1, ctx2)
+    >>> list(pack_codes_order1(bytes([2, 1, 2, 1]), values, lengths))
+    [32]
+    """
+    total = sum(map(lambda p, c: lengths[p][c], b"\0" + bytes(text[:-1]),
+                    text))
+    out = bytearray((total + 7) // 8)
+    acc = 0
+    nbits = 0
+    pos = 0
+    prev = 0
+    for i in text:
+        length = lengths[prev][i]
+        acc = (acc << length) | values[prev][i]
+        nbits += length
+        prev = i
+        if nbits >= 32:
+            while nbits >= 32:
+                nbits -= 32
+                out[pos:pos + 4] = ((acc >> nbits) & 0xFFFFFFFF).to_bytes(
+                    4, "big")
+                pos += 4
+            acc &= (1 << nbits) - 1
+    if nbits:
+        tail = (nbits + 7) // 8
+        out[pos:pos + tail] = (acc << (8 * tail - nbits)).to_bytes(tail, "big")
+    return out
+
+
+def encode_order1(block, max_code_length=None):
+    """ Return block encoded with a code per previous byte.
+
+    The body is a flag byte saying whether a shared code is stored, a
+    32-byte bitmap of the contexts with their own code, the shared code
+    lengths if present, the own code lengths in context order, and then
+    the packed codes.
+
+    @param bytes block: a non-empty bytes object
+    @param int|NoneType max_code_length: maximum code length, if any
+    @rtype: bytes
+    """
+    own, shared = order1_lengths(block, max_code_length)
+    bitmap = bytearray(32)
+    for prev in own:
+        bitmap[prev >> 3] |= 1 << (prev & 7)
+    header = bytes([1 if shared else 0]) + bytes(bitmap)
+    if shared:
+        header += lengths_to_bytes(shared)
+    shared_table = triples_to_table(canonical_codes(shared))
+    values = [shared_table[0]] * 256
+    lengths = [shared_table[1]] * 256
+    for prev in sorted(own):
+        header += lengths_to_bytes(own[prev])
+        values[prev], lengths[prev] = triples_to_table(
+            canonical_codes(own[prev]))
+    return header + pack_codes_order1(block, values, lengths)
+
+
+# ====================
+# Statistics
+
+
+class Stats:
+    """ Sizes, counts and stage timings of one compress or uncompress call.
+
+    Attributes:
+    ===========
+    @param dict(str,float) stages: seconds spent in each stage
+    @param float total_time: seconds spent in the whole call
+    @param int uncompressed_size: number of uncompressed bytes
+    @param int|NoneType compressed_size: number of compressed bytes, if
+        the input could report its position
+    @param int blocks: number of blocks
+    @param int tree_nodes: number of nodes in the order-0 block trees
+    @param int peak_buffer: size of the largest block or frame held
+    @param int|NoneType peak_traced: peak traced allocation, in bytes, if
+        tracemalloc was tracing
+
+    >>> stats = compress(io.BytesIO(b"abracadabra" * 10), io.BytesIO())
+    >>> stats.uncompressed_size, stats.blocks, stats.tree_nodes
+    (110, 1, 9)
+    """
+
+    def __init__(self):
+        """ Create empty statistics.
+
+        @param Stats self: these statistics
+        @rtype: NoneType
+        """
+        self.stages = {}
+        self.total_time = 0.0
+        self.uncompressed_size = 0
+        self.compressed_size = 0
+        self.blocks = 0
+        self.tree_nodes = 0
+        self.peak_buffer = 0
+        self.peak_traced = None
+
+    @contextmanager
+    def timed(self, stage):
+        """ Return a context manager adding the time spent inside it to
+        stage.
+
+        @param Stats self: these statistics
+        @param str stage: name of the stage
+        @rtype: ContextManager
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def add_time(self, stage, seconds):
+        """ Add seconds to the time spent in stage.
+
+        @param Stats self: these statistics
+        @param str stage: name of the stage
+        @param float seconds: time to add
+        @rtype: NoneType
+        """
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_block(self, block_type, size, body):
+        """ Count a block of block_type holding size bytes encoded as body.
+
+        @param Stats self: these statistics
+        @param int block_type: one of the BLOCK_* constants
+        @param int size: uncompressed size of the block
+        @param bytes|memoryview body: the encoded block
+        @rtype: NoneType
+        """
+        self.blocks += 1
+        if block_type in (BLOCK_HUFFMAN, BLOCK_STREAMS):
+            # the lengths header starts with the symbol count less one
+            self.tree_nodes += 2 * body[0] + 1
+        self.peak_buffer = max(self.peak_buffer, size, len(body))
+
+    @property
+    def bits_per_symbol(self):
+        """ Return the compressed bits per uncompressed byte, or None if
+        either size is unknown or zero.
+
+        @param Stats self: these statistics
+        @rtype: float|NoneType
+        """
+        if not self.compressed_size or not self.uncompressed_size:
+            return None
+        return 8 * self.compressed_size / self.uncompressed_size
+
+    def as_dict(self):
+        """ Return these statistics as a dict of plain values, for export.
+
+        @param Stats self: these statistics
+        @rtype: dict
+        """
+        result = dict(vars(self), stages=dict(self.stages))
+        result["bits_per_symbol"] = self.bits_per_symbol
+        return result
+
+
+@contextmanager
+def instrumented(stats, profile=None):
+    """ Return a context manager recording the total time of its body in
+    stats, with profile entered around it if given, and the peak traced
+    allocation if tracemalloc is tracing.
+
+    @param Stats stats: statistics to record into
+    @param ContextManager|NoneType profile: a profiler to run, such as a
+        cProfile.Profile
+    @rtype: ContextManager[Stats]
+    """
+    import tracemalloc
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    with profile if profile is not None else nullcontext():
+        yield stats
+    stats.total_time = time.perf_counter() - start
+    if tracing:
+        stats.peak_traced = tracemalloc.get_traced_memory()[1]
+
+
+def timed_iter(iterable, stats, stage):
+    """ Yield the items of iterable, adding the time spent producing them
+    to stage in stats, if stats is given.
+
+    @param Iterable iterable: items to yield
+    @param Stats|NoneType stats: statistics to record into
+    @param str stage: name of the stage
+    @rtype: Generator
+    """
+    if stats is None:
+        yield from iterable
+        return
+    items = iter(iterable)
+    while True:
+        with stats.timed(stage):
+            item = next(items, StopIteration)
+        if item is StopIteration:
+            return
+        yield item
+
+
+# ====================
+# Block container
+
+
+def frame_block(block_type, size, body):
+    """ Return body framed as a block of type block_type that decodes to
+    size bytes.
+
+    @param int block_type: one of the BLOCK_* constants
+    @param int size: uncompressed size of the block
+    @param bytes body: the encoded block
+    @rtype: bytes
+
+    >>> list(frame_block(BLOCK_HUFFMAN, 3, bytes([7])))
+    [0, 3, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 7]
+    """
+    return (bytes([block_type]) + size_to_bytes(size, 8) +
+            size_to_bytes(len(body), 8) + body)
+
+
+def freq_entropy(freq_dict):
+    """ Return the entropy in bits per byte of the byte distribution with
+    frequencies freq_dict.
+
+    @param dict(int,int) freq_dict: a non-empty frequency dictionary
+    @rtype: float
+
+    >>> freq_entropy({97: 2, 98: 2})
+    1.0
+    """
+    total = sum(freq_dict.values())
+    return -sum(count / total * math.log2(count / total)
+                for count in freq_dict.values())
+
+
+def sample_entropy(block):
+    """ Return the entropy in bits per byte of the byte distribution of a
+    sample of block.
+
+    @param bytes|memoryview block: a non-empty block
+    @rtype: float
+
+    >>> sample_entropy(b"abab"), sample_entropy(bytes(range(256)))
+    (1.0, 8.0)
+    """
+    if len(block) <= SAMPLE_SLICES * SAMPLE_SLICE_SIZE:
+        sample = block
+    else:
+        step = (len(block) - SAMPLE_SLICE_SIZE) // (SAMPLE_SLICES - 1)
+        sample = b"".join(block[start:start + SAMPLE_SLICE_SIZE]
+                          for start in range(0, step * SAMPLE_SLICES, step))
+    return freq_entropy(make_freq_dict(sample))
+
+
+def compress_block(block, order=0, max_code_length=None, lengths=None,
+                   streams=1, freq_dict=None):
+    """ Return block compressed as a framed block with its own canonical
+    code: a BLOCK_HUFFMAN block for order 0, a BLOCK_STREAMS block for
+    order 0 split into several streams, or a BLOCK_ORDER1 block with a
+    code per previous byte for order 1.
+
+    A block that coding would not shrink is framed as a BLOCK_STORED
+    block of the bytes themselves; for order 0 this is judged from the
+    sample_entropy of the block, or the entropy of freq_dict if the block
+    was already counted, before coding it.
+
+    @param bytes block: a non-empty bytes object
+    @param int order: context order, 0 or 1
+    @param int|NoneType max_code_length: maximum code length, if any
+    @param dict(int,int)|NoneType lengths: order-0 code lengths already
+        chosen for block, if any
+    @param int streams: number of independent order-0 bitstreams
+    @param dict(int,int)|NoneType freq_dict: frequency dictionary of
+        block, if already counted
+    @rtype: bytes
+    """
+    if order == 1:
+        block_type, body = BLOCK_ORDER1, encode_order1(block,
+                                                       max_code_length)
+    elif (sample_entropy(block) if freq_dict is None
+          else freq_entropy(freq_dict)) >= STORED_ENTROPY:
+        block_type, body = BLOCK_STORED, block
+    elif streams > 1:
+        block_type, body = BLOCK_STREAMS, encode_streams(
+            block, streams, max_code_length, lengths)
+    else:
+        block_type, body = BLOCK_HUFFMAN, encode_canonical(
+            block, max_code_length, lengths)
+    if len(body) >= len(block):
+        block_type, body = BLOCK_STORED, block
+    return frame_block(block_type, len(block), bytes(body))
+
+
+def map_blocks(func, jobs, workers=1):
+    """ Yield func(*job) for each job in jobs, in order.
+
+    With more than one worker the calls run in a process pool, with at
+    most 2 * workers jobs in flight so memory stays bounded.
+
+    @param callable func: a picklable module-level function
+    @param Iterable[tuple] jobs: argument tuples for func
+    @param int workers: number of worker processes
+    @rtype: Generator
+
+    >>> list(map_blocks(pow, [(2, 3), (3, 2)]))
+    [8, 9]
+    """
+    if workers <= 1:
+        for job in jobs:
+            yield func(*job)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for job in jobs:
+            pending.append(pool.submit(func, *job))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def iter_blocks(source, block_size):
+    """ Yield consecutive blocks of at most block_size bytes from source.
+
+    A memoryview source is sliced in place; anything else is read as a
+    file.
+
+    @param file|memoryview source: a binary file or a memoryview
+    @param int block_size: maximum number of bytes per block
+    @rtype: Generator[bytes|memoryview]
+
+    >>> list(iter_blocks(io.BytesIO(b"abcde"), 2))
+    [b'ab', b'cd', b'e']
+    >>> [bytes(b) for b in iter_blocks(memoryview(b"abcde"), 2)]
+    [b'ab', b'cd', b'e']
+    """
+    if isinstance(source, memoryview):
+        for start in range(0, len(source), block_size):
+            yield source[start:start + block_size]
+        return
+    block = source.read(block_size)
+    while block:
+        yield block
+        block = source.read(block_size)
+
+
+def compress_blocks(f, block_size=BLOCK_SIZE, workers=1, order=0,
+                    max_code_length=None, reuse_tree=False, stats=None,
+                    streams=1):
+    """ Yield the FORMAT_BLOCKS compressed form of the contents of f,
+    taking at most block_size bytes at a time.
+
+    With reuse_tree, order-0 block codes are chosen here rather than in
+    the workers: a block close to the one that shaped the current tree
+    (see REUSE_TREE_DISTANCE) reuses that shape through improve_tree
+    instead of building a new tree.
+
+    @param file|memoryview f: a binary file open for reading, or a
+        memoryview over the whole input
+    @param int block_size: maximum number of bytes per block
+    @param int workers: number of processes compressing blocks
+    @param int order: context order of the block codes, 0 or 1
+    @param int|NoneType max_code_length: maximum code length, if any
+    @param bool reuse_tree: reuse tree shapes across similar blocks
+    @param Stats|NoneType stats: statistics to record the blocks and the
+        read and encode times in, if any
+    @param int streams: number of independent bitstreams per order-0 block
+    @rtype: Generator[bytes]
+    """
+    framer = FrameWriter()
+    shape = shape_freq = None
+
+    def reused_lengths(freq):
+        """Return the code lengths chosen by tree reuse for a block with
+        frequencies freq."""
+        nonlocal shape, shape_freq
+        if (shape is None or not set(freq) <= set(shape.symbol) or
+                freq_distance(freq, shape_freq) > REUSE_TREE_DISTANCE):
+            # the new tree is the shape, as block_code_lengths would build it
+            shape, shape_freq = flat_huffman_tree(freq), freq
+            lengths = code_lengths(shape)
+            if (max_code_length is not None and
+                    max(lengths.values()) > max_code_length):
+                lengths = limited_code_lengths(freq, max_code_length)
+                shape = FlatTree.from_node(tree_from_lengths(lengths))
+            return lengths
+        improve_tree(shape, freq)
+        return code_lengths(shape)
+
+    def blocks():
+        """Yield each block of f as a job for compress_block."""
+        for block in timed_iter(iter_blocks(f, block_size), stats, "read"):
+            freq = lengths = None
+            if reuse_tree and order == 0:
+                # counted once here, so compress_block need not count again
+                freq = make_freq_dict(block)
+                if freq_entropy(freq) < STORED_ENTROPY:
+                    lengths = reused_lengths(freq)
+            # memoryviews cannot be pickled to a worker process
+            yield (bytes(block) if workers > 1 else block, order,
+                   max_code_length, lengths, streams, freq)
+
+    yield framer.header()
+    for frame in timed_iter(map_blocks(compress_block, blocks(), workers),
+                            stats, "encode"):
+        if stats is not None:
+            stats.add_block(frame[0], bytes_to_size(frame[1:9]),
+                            memoryview(frame)[17:])
+        yield framer.frame(frame)
+    if stats is not None:
+        stats.uncompressed_size += framer.total
+        # encoding pulls the blocks it encodes, so its time includes theirs
+        stats.add_time("encode", -stats.stages.get("read", 0.0))
+    yield framer.trailer()
+
+
+def index_frame(index):
+    """ Return the BLOCK_INDEX frame listing index.
+
+    @param list[(int, int)] index: (uncompressed offset, file offset) of
+        each block frame, in order
+    @rtype: bytes
+
+    >>> list(index_frame([(0, 2)]))[17:]
+    [0, 0, 0, 0, 0, 0, 0, 0, 2, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0]
+    """
+    body = b"".join(size_to_bytes(position, 8) + size_to_bytes(offset, 8)
+                    for position, offset in index)
+    return frame_block(BLOCK_INDEX, 0, body + size_to_bytes(len(index), 8))
+
+
+class FrameWriter:
+    """ The bookkeeping of writing the FORMAT_BLOCKS layout: the format
+    header, the block frames with an index entry for each, and the
+    closing BLOCK_INDEX and BLOCK_END frames.
+
+    Each method returns the bytes to write rather than writing them, so
+    generators, file objects and asyncio streams all lay out their
+    streams through it.
+
+    Attributes:
+    ===========
+    @param list[(int, int)] index: (uncompressed offset, file offset) of
+        each block frame so far
+    @param int total: uncompressed size of the block frames so far
+    @param int offset: file offset of the next frame
+
+    >>> framer = FrameWriter()
+    >>> data = (framer.header() + framer.frame(compress_block(b"abra")) +
+    ...         framer.trailer())
+    >>> framer.index, framer.total
+    ([(0, 2)], 4)
+    >>> b"".join(decompress_blocks(io.BytesIO(data[2:])))
+    b'abra'
+    """
+
+    def __init__(self):
+        """ Start an empty stream.
+
+        @param FrameWriter self: this writer
+        @rtype: NoneType
+        """
+        self.index = []
+        self.total, self.offset = 0, 0
+
+    def header(self):
+        """ Return the format header that starts the stream.
+
+        @param FrameWriter self: this writer
+        @rtype: bytes
+        """
+        header = bytes([FORMAT_MAGIC, FORMAT_BLOCKS])
+        self.offset += len(header)
+        return header
+
+    def frame(self, frame):
+        """ Record the block frame frame in the index and return it.
+
+        @param FrameWriter self: this writer
+        @param bytes frame: a block frame from compress_block
+        @rtype: bytes
+        """
+        self.index.append((self.total, self.offset))
+        self.total += bytes_to_size(frame[1:9])
+        self.offset += len(frame)
+        return frame
+
+    def trailer(self):
+        """ Return the BLOCK_INDEX and BLOCK_END frames that end the
+        stream.
+
+        @param FrameWriter self: this writer
+        @rtype: bytes
+        """
+        return (index_frame(self.index) + bytes([BLOCK_END]) +
+                size_to_bytes(self.total, 8))
+
+
+def open_file(file, mode):
+    """ Return a context manager for file, opening it in mode if it is a
+    path and leaving it open on exit if it is already a file object.
+
+    @param str|file file: a path or a file object
+    @param str mode: mode to open a path with
+    @rtype: ContextManager[file]
+    """
+    if isinstance(file, (str, bytes, os.PathLike)):
+        return open(file, mode)
+    return nullcontext(file)
+
+
+def is_path(file):
+    """ Return True iff file is a path rather than a file object.
+
+    @param str|file file: a path or a file object
+    @rtype: bool
+
+    >>> is_path("book.txt"), is_path(io.BytesIO())
+    (True, False)
+    """
+    return isinstance(file, (str, bytes, os.PathLike))
+
+
+def wants_mmap(*files):
+    """ Return True iff every file is a path and the first names a file of
+    at least MMAP_THRESHOLD bytes.
+
+    @param str|file files: paths or file objects
+    @rtype: bool
+    """
+    return (all(is_path(file) for file in files) and
+            os.path.getsize(files[0]) >= MMAP_THRESHOLD)
+
+
+def compress(in_file, out_file, block_size=BLOCK_SIZE, workers=1,
+             use_mmap=None, tree_id=None, order=0, max_code_length=None,
+             reuse_tree=False, profile=None, adaptive=False, streams=1):
+    """ Compress contents of in_file and store results in out_file,
+    returning statistics of the run.
+
+    The input is read and compressed one block at a time, so memory use
+    is bounded by a few blocks regardless of the input size.  A mapped
+    input is counted and encoded through a memoryview, without copying.
+
+    @param str|file in_file: input file to compress
+    @param str|file out_file: output file to store compressed result
+    @param int block_size: maximum number of bytes per block
+    @param int workers: number of processes compressing blocks
+    @param bool|NoneType use_mmap: memory-map in_file; by default only
+        when it is at least MMAP_THRESHOLD bytes
+    @param int|NoneType tree_id: id of a registered trained tree to code
+        the whole input with, in place of per-block trees
+    @param int order: context order of the block codes; 1 codes each
+        byte with a tree chosen by the byte before it
+    @param int|NoneType max_code_length: maximum code length of the block
+        codes, which bounds decode table depth at some cost in ratio
+    @param bool reuse_tree: let similar consecutive blocks reuse one tree
+        shape instead of each building their own
+    @param ContextManager|NoneType profile: a profiler to run around the
+        call, such as a cProfile.Profile
+    @param bool adaptive: code the input in one pass with an adaptive
+        tree, flushing out_file as output is produced
+    @param int streams: split each order-0 block into this many
+        bitstreams, which uncompress can decode in parallel
+    @rtype: Stats
+    """
+    if use_mmap is None:
+        use_mmap = wants_mmap(in_file)
+    stats = Stats()
+
+    def write_all(f, chunks):
+        """Write chunks to f, counting and timing them."""
+        for chunk in chunks:
+            with stats.timed("write"):
+                f.write(chunk)
+                if adaptive:
+                    f.flush()
+            stats.compressed_size += len(chunk)
+
+    with instrumented(stats, profile), open_file(in_file, "rb") as f1, \
+            open_file(out_file, "wb") as f2:
+        if tree_id is not None:
+            with stats.timed("read"):
+                text = f1.read()
+            with stats.timed("encode"):
+                data = compress_trained(text, tree_id)
+            stats.uncompressed_size = stats.peak_buffer = len(text)
+            write_all(f2, [data])
+        elif adaptive:
+            write_all(f2, compress_adaptive(f1, stats))
+        elif use_mmap and os.fstat(f1.fileno()).st_size:
+            with mmap.mmap(f1.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                write_all(f2, compress_blocks(memoryview(m), block_size,
+                                              workers, order, max_code_length,
+                                              reuse_tree, stats, streams))
+        else:
+            write_all(f2, compress_blocks(f1, block_size, workers, order,
+                                          max_code_length, reuse_tree, stats,
+                                          streams))
+    return stats
 
 
 # ====================
@@ -351,19 +1786,53 @@ def generate_tree_general(node_lst, root_index):
 HuffmanNode(12, None, None)), \
 HuffmanNode(None, HuffmanNode(5, None, None), HuffmanNode(7, None, None)))
     """
-    node = node_lst[root_index]
-    hufftree = HuffmanNode()
-    if node.l_type:
-        hufftree.left = generate_tree_general(node_lst, node.l_data)
-    else:
-        hufftree.left = HuffmanNode(node.l_data)
-    if node.r_type:
-        hufftree.right = generate_tree_general(node_lst, node.r_data)
-    else:
-        hufftree.right = HuffmanNode(node.r_data)
+    return flat_tree_general(node_lst, root_index).to_node()
+
+
+def flat_tree_general(node_lst, root_index):
+    """ Return the tree generate_tree_general builds as a FlatTree,
+    walking node_lst with an explicit stack instead of recursion.
+
+    Each node of a tree is reached once, so a node reached again means
+    node_lst holds a cycle or a shared subtree, and ValueError is raised.
+
+    @param list[ReadNode] node_lst: a list of ReadNode objects
+    @param int root_index: index in 'node_lst'
+    @rtype: FlatTree
+
+    >>> flat_tree_general([ReadNode(1, 0, 0, 7)], 0)
+    Traceback (most recent call last):
+    ...
+    ValueError: corrupt compressed file: node 0 reached twice
+    """
+    flat = FlatTree()
+    stack = [(root_index, False)]
+    done = []
+    seen = set()
+    while stack:
+        index, visited = stack.pop()
+        node = node_lst[index]
+        if visited:
+            # the right subtree was pushed first, so it completes first
+            left = (done.pop() if node.l_type
+                    else flat.add_leaf(node.l_data))
+            right = (done.pop() if node.r_type
+                     else flat.add_leaf(node.r_data))
+            done.append(flat.add_node(left, right))
+        else:
+            if index in seen:
+                raise ValueError(
+                    "corrupt compressed file: node {} reached twice".format(
+                        index))
+            seen.add(index)
+            stack.append((index, True))
+            if node.l_type:
+                stack.append((node.l_data, False))
+            if node.r_type:
+                stack.append((node.r_data, False))
+    flat.root = done.pop()
+    return flat
 
-    return hufftree
-    
 
 def generate_tree_postorder(node_lst, root_index):
     """ Return the root of the Huffman tree corresponding
@@ -382,52 +1851,330 @@ def generate_tree_postorder(node_lst, root_index):
 HuffmanNode(7, None, None)), \
 HuffmanNode(None, HuffmanNode(10, None, None), HuffmanNode(12, None, None)))
     """
-    node = node_lst[root_index]
-    hufftree = HuffmanNode(None, None, None)
-    lenright = 1
-    if node.r_type:
-        hufftree.right, lenright = helper_postorder(node_lst, root_index-1, lenright)
-    else:
-        hufftree.right = HuffmanNode(node.r_data, None, None)
-    if node.l_type:
-        hufftree.left = generate_tree_postorder(node_lst, root_index-lenright)
-    else:
-        hufftree.left = HuffmanNode(node.l_data, None, None)
+    return flat_tree_postorder(node_lst, root_index).to_node()
 
-    return hufftree
 
-def helper_postorder(node_lst, root_index, lenright):
-    node = node_lst[root_index]
-    hufftree = HuffmanNode(None, None, None)
-    lenright+=1
-    if node.r_type:
-        hufftree.right, lenright = helper_postorder(node_lst, root_index-1, lenright)
-    else:
-        hufftree.right = HuffmanNode(node.r_data, None, None)
-    if node.l_type:
-        hufftree.left = generate_tree_postorder(node_lst, root_index-lenright)
-    else:
-        hufftree.left = HuffmanNode(node.l_data, None, None)
-    return hufftree, lenright
-  
-def generate_uncompressed(tree, text, size):
+def flat_tree_postorder(node_lst, root_index):
+    """ Return the tree generate_tree_postorder builds as a FlatTree.
+
+    The nodes up to root_index are read in order, and each internal
+    child is the most recently completed subtree, so a stack replaces
+    the recursion.
+
+    @param list[ReadNode] node_lst: a list of ReadNode objects
+    @param int root_index: index in 'node_lst'
+    @rtype: FlatTree
+    """
+    flat = FlatTree()
+    done = []
+    for node in node_lst[:root_index + 1]:
+        right = done.pop() if node.r_type else flat.add_leaf(node.r_data)
+        left = done.pop() if node.l_type else flat.add_leaf(node.l_data)
+        done.append(flat.add_node(left, right))
+    flat.root = done.pop()
+    return flat
+
+
+def leaf_codes(tree):
+    """ Return a list of (symbol, code, length) triples for the leaves of
+    tree, where code is the integer value of the leaf's bit path.
+
+    @param HuffmanNode|FlatTree tree: a Huffman tree rooted at node 'tree'
+    @rtype: list[(int, int, int)]
+
+    >>> left = HuffmanNode(None, HuffmanNode(3), HuffmanNode(2))
+    >>> tree = HuffmanNode(None, left, HuffmanNode(9))
+    >>> sorted(leaf_codes(tree))
+    [(2, 1, 2), (3, 0, 2), (9, 1, 1)]
+    """
+    flat = as_flat_tree(tree)
+    left, right, symbol = flat.left, flat.right, flat.symbol
+    codes = []
+    stack = [(flat.root, 0, 0)]
+    while stack:
+        index, code, length = stack.pop()
+        if left[index] < 0:
+            codes.append((symbol[index], code, length))
+        else:
+            stack.append((right[index], (code << 1) | 1, length + 1))
+            stack.append((left[index], code << 1, length + 1))
+    return codes
+
+
+def build_decode_table(codes, table_bits=DECODE_TABLE_BITS):
+    """ Return a lookup table for decoding the prefix code in codes.
+
+    The table is a tuple (bits, symbols, lengths) indexed by the next
+    bits bits of input.  When lengths[i] is non-zero, symbols[i] is the
+    decoded symbol and lengths[i] the number of bits it consumes.
+    Otherwise the code is longer than bits, and symbols[i] is a
+    second-level table of the same form for the remaining bits.
+
+    @param list[(int, int, int)] codes: (symbol, code, length) triples
+    @param int table_bits: maximum number of bits indexed per level
+    @rtype: (int, list, list[int])
+
+    Precondition: codes is a complete prefix code with every length > 0,
+    and 1 <= table_bits <= 16.
+
+    >>> bits, symbols, lengths = build_decode_table([(3, 0, 1), (2, 1, 1)])
+    >>> bits, symbols, lengths
+    (1, [3, 2], [1, 1])
+    >>> codes = [(7, 0, 1), (8, 2, 2), (9, 6, 3), (10, 7, 3)]
+    >>> bits, symbols, lengths = build_decode_table(codes, 2)
+    >>> lengths
+    [1, 1, 2, 0]
+    >>> symbols[3]
+    (1, [9, 10], [1, 1])
+    """
+    bits = min(table_bits, max(length for _, _, length in codes))
+    symbols = [0] * (1 << bits)
+    lengths = [0] * (1 << bits)
+    long_codes = {}
+    for symbol, code, length in codes:
+        if length <= bits:
+            span = 1 << (bits - length)
+            start = code << (bits - length)
+            symbols[start:start + span] = [symbol] * span
+            lengths[start:start + span] = [length] * span
+        else:
+            rest = length - bits
+            long_codes.setdefault(code >> rest, []).append(
+                (symbol, code & ((1 << rest) - 1), rest))
+    for prefix, group in long_codes.items():
+        symbols[prefix] = build_decode_table(group, table_bits)
+    return bits, symbols, lengths
+
+
+def check_size(text, size):
+    """ Raise ValueError if size bytes cannot be encoded in text by a code
+    whose every length is at least one bit.
+
+    @param bytes text: encoded text
+    @param int size: number of bytes said to be encoded in text
+    @rtype: NoneType
+
+    >>> check_size(b"ab", 16)
+    >>> check_size(b"ab", 17)
+    Traceback (most recent call last):
+    ...
+    ValueError: corrupt compressed file: size exceeds the data
+    """
+    if size > 8 * len(text):
+        raise ValueError("corrupt compressed file: size exceeds the data")
+
+
+def table_decode(table, text, size):
+    """ Use the decode table built by build_decode_table to decompress
+    size bytes from text.
+
+    Bits are read MSB-first into an integer accumulator 56 bits at a
+    time; running off the end of text reads zero bits, matching the
+    padding written by generate_compressed.  Every code is at least one
+    bit long, so a size needing more bits than text holds, or codes that
+    still need bits after a whole refill of padding, raise ValueError.
+
+    @param (int, list, list[int]) table: a decode table
+    @param bytes text: text to decompress
+    @param int size: number of bytes to decompress from text
+    @rtype: bytearray
+
+    >>> table = build_decode_table([(0, 0, 1), (1, 2, 2), (2, 3, 2)])
+    >>> list(table_decode(table, bytes([0b10111001, 0b10000000]), 5))
+    [1, 2, 1, 0, 2]
+    >>> table_decode(table, bytes([0b10111001]), 9)
+    Traceback (most recent call last):
+    ...
+    ValueError: corrupt compressed file: size exceeds the data
+    """
+    check_size(text, size)
+    out = bytearray(size)
+    bits, symbols, lengths = table
+    mask = (1 << bits) - 1
+    acc = 0
+    nbits = 0
+    pos = 0
+    # one refill past the end is the padding of the last code
+    end = len(text) + 7
+    for i in range(size):
+        if nbits < bits:
+            if pos >= end:
+                raise ValueError("corrupt compressed file: codes run past "
+                                 "the data")
+            chunk = text[pos:pos + 7]
+            pos += 7
+            acc = (((acc & ((1 << nbits) - 1)) << 56) |
+                   (int.from_bytes(chunk, "big") << (56 - 8 * len(chunk))))
+            nbits += 56
+        index = (acc >> (nbits - bits)) & mask
+        length = lengths[index]
+        if length:
+            out[i] = symbols[index]
+            nbits -= length
+            continue
+        # code longer than the first-level table: walk the subtables
+        sub_bits, sub_symbols, sub_lengths = symbols[index]
+        nbits -= bits
+        while True:
+            if nbits < sub_bits:
+                if pos >= end:
+                    raise ValueError("corrupt compressed file: codes run "
+                                     "past the data")
+                chunk = text[pos:pos + 7]
+                pos += 7
+                acc = (((acc & ((1 << nbits) - 1)) << 56) |
+                       (int.from_bytes(chunk, "big") <<
+                        (56 - 8 * len(chunk))))
+                nbits += 56
+            index = (acc >> (nbits - sub_bits)) & ((1 << sub_bits) - 1)
+            length = sub_lengths[index]
+            if length:
+                out[i] = sub_symbols[index]
+                nbits -= length
+                break
+            nbits -= sub_bits
+            sub_bits, sub_symbols, sub_lengths = sub_symbols[index]
+    return out
+
+
+def build_multi_table(codes, table_bits=DECODE_TABLE_BITS):
+    """ Return a lookup table decoding up to MULTI_SYMBOLS symbols of the
+    prefix code in codes at a time.
+
+    The table is a tuple (bits, strings, lengths) indexed by the next
+    bits bits of input.  When lengths[i] is non-zero, strings[i] holds
+    the symbols whose codes fit entirely in those bits and lengths[i]
+    the number of bits they consume.  Otherwise the first code is longer
+    than bits, and strings[i] is a second-level table as built by
+    build_decode_table for the remaining bits.
+
+    @param list[(int, int, int)] codes: (symbol, code, length) triples
+    @param int table_bits: number of bits indexed by the table
+    @rtype: (int, list, list[int])
+
+    Precondition: codes is a complete prefix code with every length > 0,
+    and 1 <= table_bits <= 16.
+
+    >>> codes = [(97, 0, 1), (98, 2, 2), (99, 3, 2)]
+    >>> bits, strings, lengths = build_multi_table(codes, 4)
+    >>> strings[0b0100], lengths[0b0100]
+    (b'aba', 4)
+    >>> strings[0b1011], lengths[0b1011]
+    (b'bc', 4)
+    >>> strings[0b1101], lengths[0b1101]
+    (b'ca', 3)
+    """
+    sub_bits, symbols, sub_lengths = build_decode_table(codes, table_bits)
+    # sub_bits < table_bits only when every code fits in sub_bits
+    shift = table_bits - sub_bits
+    mask = (1 << table_bits) - 1
+    strings = [b""] * (1 << table_bits)
+    lengths = [0] * (1 << table_bits)
+    for index in range(1 << table_bits):
+        if not sub_lengths[index >> shift]:
+            strings[index] = symbols[index >> shift]
+            continue
+        decoded = []
+        used = 0
+        while len(decoded) < MULTI_SYMBOLS and used < table_bits:
+            top = ((index << used) & mask) >> shift
+            length = sub_lengths[top]
+            if not length or used + length > table_bits:
+                break
+            decoded.append(symbols[top])
+            used += length
+        strings[index] = bytes(decoded)
+        lengths[index] = used
+    return table_bits, strings, lengths
+
+
+def multi_table_decode(table, text, size):
+    """ Use the decode table built by build_multi_table to decompress size
+    bytes from text.
+
+    Each lookup appends all the symbols of an entry at once; symbols
+    decoded from the zero padding past the last code are cut off.  Corrupt
+    sizes and codes raise ValueError as in table_decode.
+
+    @param (int, list, list[int]) table: a multi-symbol decode table
+    @param bytes text: text to decompress
+    @param int size: number of bytes to decompress from text
+    @rtype: bytearray
+
+    >>> table = build_multi_table([(0, 0, 1), (1, 2, 2), (2, 3, 2)])
+    >>> list(multi_table_decode(table, bytes([0b10111001, 0b10000000]), 5))
+    [1, 2, 1, 0, 2]
+    """
+    check_size(text, size)
+    out = bytearray()
+    bits, strings, lengths = table
+    mask = (1 << bits) - 1
+    acc = 0
+    nbits = 0
+    pos = 0
+    # one refill past the end is the padding of the last code
+    end = len(text) + 7
+    while len(out) < size:
+        if nbits < bits:
+            if pos >= end:
+                raise ValueError("corrupt compressed file: codes run past "
+                                 "the data")
+            chunk = text[pos:pos + 7]
+            pos += 7
+            acc = (((acc & ((1 << nbits) - 1)) << 56) |
+                   (int.from_bytes(chunk, "big") << (56 - 8 * len(chunk))))
+            nbits += 56
+        index = (acc >> (nbits - bits)) & mask
+        length = lengths[index]
+        if length:
+            out += strings[index]
+            nbits -= length
+            continue
+        # code longer than the first-level table: walk the subtables
+        sub_bits, sub_symbols, sub_lengths = strings[index]
+        nbits -= bits
+        while True:
+            if nbits < sub_bits:
+                if pos >= end:
+                    raise ValueError("corrupt compressed file: codes run "
+                                     "past the data")
+                chunk = text[pos:pos + 7]
+                pos += 7
+                acc = (((acc & ((1 << nbits) - 1)) << 56) |
+                       (int.from_bytes(chunk, "big") <<
+                        (56 - 8 * len(chunk))))
+                nbits += 56
+            index = (acc >> (nbits - sub_bits)) & ((1 << sub_bits) - 1)
+            length = sub_lengths[index]
+            if length:
+                out.append(sub_symbols[index])
+                nbits -= length
+                break
+            nbits -= sub_bits
+            sub_bits, sub_symbols, sub_lengths = sub_symbols[index]
+    del out[size:]
+    return out
+
+
+def generate_uncompressed(tree, text, size, table_bits=DECODE_TABLE_BITS):
     """ Use Huffman tree to decompress size bytes from text.
 
     @param HuffmanNode tree: a HuffmanNode tree rooted at 'tree'
     @param bytes text: text to decompress
     @param int size: number of bytes to decompress from text.
+    @param int table_bits: bits indexed by each level of the decode table
     @rtype: bytes
+
+    >>> tree = HuffmanNode(None, HuffmanNode(0), \
+    HuffmanNode(None, HuffmanNode(1), HuffmanNode(2)))
+    >>> list(generate_uncompressed(tree, bytes([0b10111001, 0b10000000]), 5))
+    [1, 2, 1, 0, 2]
     """
-    codict = get_codes(tree)
-    newdict = {v: k for k, v in codict.items()}
-    out = ""
-    buffer = ""
-    for x in range(size):
-        buffer += str(text[x])
-        if buffer in newdict:
-            out+=newdict[buffer]
-            buffer = ""
-    return out.encode()
+    if tree.is_leaf():
+        return bytes([tree.symbol]) * size
+    table = build_multi_table(leaf_codes(tree), table_bits)
+    return bytes(multi_table_decode(table, text, size))
+
 
 def bytes_to_nodes(buf):
     """ Return a list of ReadNodes corresponding to the bytes in buf.
@@ -461,23 +2208,885 @@ def bytes_to_size(buf):
     return int.from_bytes(buf, "little")
 
 
-def uncompress(in_file, out_file):
-    """ Uncompress contents of in_file and store results in out_file.
+def decompress_legacy(f, num_nodes):
+    """ Return the text decompressed from the legacy layout in file f,
+    positioned just after the leading node count num_nodes.
+
+    @param file f: a binary file open for reading
+    @param int num_nodes: number of internal nodes in the stored tree
+    @rtype: bytes
+    """
+    node_lst = bytes_to_nodes(read_exact(f, num_nodes * 4))
+    for node in node_lst:
+        for node_type, data in ((node.l_type, node.l_data),
+                                (node.r_type, node.r_data)):
+            if node_type not in (0, 1) or node_type and data >= num_nodes:
+                raise ValueError("corrupt compressed file: bad tree node")
+    # use generate_tree_general or generate_tree_postorder here
+    tree = generate_tree_general(node_lst, num_nodes - 1)
+    size = bytes_to_size(read_exact(f, 4))
+    return generate_uncompressed(tree, f.read(), size)
+
+
+def read_exact(f, n):
+    """ Return exactly n bytes read from file f.
+
+    A large n, such as a corrupt size, is read BLOCK_SIZE bytes at a
+    time, so a short file fails without first allocating n bytes.
+
+    @param file f: a binary file open for reading
+    @param int n: number of bytes to read
+    @rtype: bytes
+
+    >>> read_exact(io.BytesIO(b"abc"), 2)
+    b'ab'
+    >>> read_exact(io.BytesIO(b"abc"), 1 << 64)
+    Traceback (most recent call last):
+    ...
+    ValueError: truncated compressed file
+    """
+    if n <= BLOCK_SIZE:
+        buf = f.read(n)
+    else:
+        parts = []
+        left = n
+        while left:
+            part = f.read(min(left, BLOCK_SIZE))
+            if not part:
+                break
+            parts.append(part)
+            left -= len(part)
+        buf = b"".join(parts)
+    if len(buf) != n:
+        raise ValueError("truncated compressed file")
+    return buf
+
+
+def wants_multi_table(lengths, size):
+    """ Return True iff decoding size bytes coded with code lengths
+    lengths repays building a multi-symbol table.
+
+    The code's expected length is taken as if each symbol had the
+    probability its length implies.
+
+    @param dict(int,int) lengths: code length of each symbol
+    @param int size: number of bytes to decode
+    @rtype: bool
+
+    >>> wants_multi_table({0: 1, 1: 2, 2: 2}, 1 << 20)
+    True
+    >>> wants_multi_table({symbol: 8 for symbol in range(256)}, 1 << 20)
+    False
+    """
+    expected = sum(length / (1 << length) for length in lengths.values())
+    return size >= MULTI_MIN_SIZE and 2 * expected <= MULTI_TABLE_BITS
+
+
+def decode_canonical(buf, size):
+    """ Return size bytes decoded from buf, which holds a code lengths
+    header followed by text encoded with the canonical code.
+
+    The decode table is built straight from the stored code lengths,
+    without constructing a HuffmanNode tree.
+
+    @param bytes buf: output of encode_canonical
+    @param int size: number of bytes to decompress
+    @rtype: bytes
+
+    >>> list(decode_canonical(bytes([2, 0, 2, 1, 1, 2, 2, 104]), 4))
+    [1, 2, 1, 0]
+    """
+    f = io.BytesIO(buf)
+    lengths = read_lengths(f)
+    if len(lengths) == 1:
+        return bytes(list(lengths)) * size
+    codes = canonical_codes(lengths)
+    text = memoryview(buf)[f.tell():]
+    if not wants_multi_table(lengths, size):
+        return bytes(table_decode(build_decode_table(codes), text, size))
+    table = build_multi_table(codes, MULTI_TABLE_BITS)
+    return bytes(multi_table_decode(table, text, size))
+
+
+def decompress_canonical(f):
+    """ Return the text decompressed from the FORMAT_CANONICAL layout in
+    file f, positioned just after the format byte.
+
+    @param file f: a binary file open for reading
+    @rtype: bytes
+
+    >>> data = compress_canonical(bytes([1, 2, 1, 0]))
+    >>> list(decompress_canonical(io.BytesIO(data[2:])))
+    [1, 2, 1, 0]
+    """
+    size = bytes_to_size(read_exact(f, 4))
+    if not size:
+        return b""
+    return decode_canonical(f.read(), size)
+
+
+def decompress_trained(f):
+    """ Return the text decompressed from the FORMAT_TRAINED layout in
+    file f, positioned just after the format byte.
+
+    @param file f: a binary file open for reading
+    @rtype: bytes
+
+    >>> key = register_tree(train_tree(b"abracadabra"))
+    >>> data = compress_trained(b"cadabra", key)
+    >>> len(data), decompress_trained(io.BytesIO(data[2:]))
+    (16, b'cadabra')
+    """
+    _, table = trained_tree(bytes_to_size(read_exact(f, 4)))
+    size = bytes_to_size(read_exact(f, 4))
+    return bytes(multi_table_decode(table, f.read(), size))
+
+
+def decompress_adaptive(f):
+    """ Yield the text decompressed from the FORMAT_ADAPTIVE layout in file
+    f, positioned just after the format byte, as it is decoded.
+
+    @param file f: a binary file open for reading
+    @rtype: Generator[bytes]
+
+    >>> data = b"".join(compress_adaptive(io.BytesIO(b"abracadabra")))
+    >>> b"".join(decompress_adaptive(io.BytesIO(data[2:])))
+    b'abracadabra'
+    """
+    read = getattr(f, "read1", f.read)
+    decoder = AdaptiveDecoder()
+    while not decoder.done:
+        chunk = read(ADAPTIVE_CHUNK_SIZE)
+        if not chunk:
+            raise ValueError("corrupt compressed file: truncated")
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+
+
+def lengths_to_decoder(lengths):
+    """ Return a decode table for the canonical code with lengths, or the
+    symbol itself if lengths has a single, zero-length code.
+
+    @param dict(int,int) lengths: mapping from symbols to code lengths
+    @rtype: int|(int, list, list[int])
+
+    >>> lengths_to_decoder({5: 0})
+    5
+    """
+    if len(lengths) == 1:
+        return next(iter(lengths))
+    return build_decode_table(canonical_codes(lengths))
+
+
+def table_decode_order1(tables, text, size):
+    """ Decompress size bytes from text, decoding each byte with the
+    table chosen by the byte before it, as written by pack_codes_order1.
+
+    @param list[int|(int, list, list[int])] tables: a decoder per context,
+        as returned by lengths_to_decoder
+    @param bytes text: text to decompress
+    @param int size: number of bytes to decompress from text
+    @rtype: bytearray
+    """
+    # contexts decoded in zero bits may repeat without reading text, so
+    # the size is only bounded when every context reads bits
+    if not any(type(table) is int for table in tables):
+        check_size(text, size)
+    out = bytearray(size)
+    acc = 0
+    nbits = 0
+    pos = 0
+    prev = 0
+    # one refill past the end is the padding of the last code
+    end = len(text) + 7
+    for i in range(size):
+        table = tables[prev]
+        if type(table) is int:
+            out[i] = prev = table
+            continue
+        if table is None:
+            raise ValueError(
+                "corrupt compressed file: no code for context {}".format(prev))
+        bits, symbols, lengths = table
+        while True:
+            if nbits < bits:
+                if pos >= end:
+                    raise ValueError("corrupt compressed file: codes run "
+                                     "past the data")
+                chunk = text[pos:pos + 7]
+                pos += 7
+                acc = (((acc & ((1 << nbits) - 1)) << 56) |
+                       (int.from_bytes(chunk, "big") <<
+                        (56 - 8 * len(chunk))))
+                nbits += 56
+            index = (acc >> (nbits - bits)) & ((1 << bits) - 1)
+            length = lengths[index]
+            if length:
+                out[i] = prev = symbols[index]
+                nbits -= length
+                break
+            nbits -= bits
+            bits, symbols, lengths = symbols[index]
+    return out
+
+
+def decode_order1(body, size):
+    """ Return the size bytes encoded in body by encode_order1.
+
+    @param bytes body: output of encode_order1
+    @param int size: number of bytes to decompress
+    @rtype: bytes
+
+    >>> block = b"abracadabra" * 100
+    >>> decode_order1(encode_order1(block), len(block)) == block
+    True
+    """
+    f = io.BytesIO(body)
+    has_shared = read_exact(f, 1)[0]
+    bitmap = read_exact(f, 32)
+    shared = lengths_to_decoder(read_lengths(f)) if has_shared else None
+    tables = [shared] * 256
+    for prev in range(256):
+        if bitmap[prev >> 3] & (1 << (prev & 7)):
+            tables[prev] = lengths_to_decoder(read_lengths(f))
+    return bytes(table_decode_order1(tables, memoryview(body)[f.tell():],
+                                     size))
+
+
+def stream_parts(body, size):
+    """ Return the first size bytes of the BLOCK_STREAMS body as a list of
+    (size, body) pairs, one for each stream they span, where each body
+    is the BLOCK_HUFFMAN body of that stream alone.
+
+    @param bytes body: output of encode_streams
+    @param int size: number of bytes wanted
+    @rtype: list[(int, bytes)]
+
+    >>> body = encode_streams(b"abracadabra", 4)
+    >>> [decode_canonical(b, n) for n, b in stream_parts(body, 10)]
+    [b'abr', b'aca', b'dab', b'r']
+    """
+    f = io.BytesIO(body)
+    read_lengths(f)
+    header = body[:f.tell()]
+    streams = read_exact(f, 1)[0]
+    part = bytes_to_size(read_exact(f, 8))
+    if streams * part < size:
+        raise ValueError("corrupt compressed file: streams too short")
+    payload_sizes = [bytes_to_size(read_exact(f, 8))
+                     for _ in range(streams - 1)]
+    start = f.tell()
+    parts = []
+    for i in range(streams):
+        if size <= 0:
+            break
+        end = start + payload_sizes[i] if i < streams - 1 else len(body)
+        parts.append((min(part, size), header + body[start:end]))
+        size -= part
+        start = end
+    return parts
+
+
+def decompress_block(block_type, size, body):
+    """ Return the first size bytes encoded in body by a block of
+    block_type.
+
+    @param int block_type: one of the BLOCK_* constants
+    @param int size: uncompressed size of the block
+    @param bytes body: the encoded block
+    @rtype: bytes
+    """
+    if block_type == BLOCK_HUFFMAN:
+        return decode_canonical(body, size)
+    if block_type == BLOCK_ORDER1:
+        return decode_order1(body, size)
+    if block_type == BLOCK_STORED:
+        if len(body) < size:
+            raise ValueError("corrupt compressed file: stored block too short")
+        return bytes(body[:size])
+    if block_type == BLOCK_STREAMS:
+        return b"".join(decode_canonical(part_body, part_size)
+                        for part_size, part_body in stream_parts(body, size))
+    raise ValueError("unknown block type {}".format(block_type))
+
+
+class FrameReader:
+    """ The parsing of the frames of the FORMAT_BLOCKS layout, with the
+    reading left to its caller: each call to feed takes exactly need
+    bytes, so file objects and asyncio streams share it.
+
+    The body size in each frame header locates the next frame, so blocks
+    are found without decoding them.
+
+    Attributes:
+    ===========
+    @param int need: number of bytes the next call to feed takes
+    @param bool done: whether the BLOCK_END frame has been read
+
+    >>> parser, frames = FrameReader(), []
+    >>> f = io.BytesIO(b"".join(compress_blocks(io.BytesIO(b"abra")))[2:])
+    >>> while not parser.done:
+    ...     frames.append(parser.feed(f.read(parser.need)))
+    >>> [frame for frame in frames if frame is not None]
+    [(2, 4, b'abra')]
+    """
+
+    def __init__(self):
+        """ Start before the first frame.
+
+        @param FrameReader self: this reader
+        @rtype: NoneType
+        """
+        self.need, self.done = 9, False
+        self._total = 0
+        self._header = self._body_size = None
+
+    def feed(self, buf):
+        """ Parse the next need bytes buf, returning (block_type, size,
+        body) if they complete a block frame and None otherwise.
+
+        @param FrameReader self: this reader
+        @param bytes buf: exactly need bytes of the stream
+        @rtype: (int, int, bytes)|NoneType
+        """
+        if self._header is None:
+            block_type, size = buf[0], bytes_to_size(buf[1:9])
+            if block_type == BLOCK_END:
+                if size != self._total:
+                    raise ValueError("corrupt compressed file: size mismatch")
+                self.need, self.done = 0, True
+                return None
+            self._header, self.need = (block_type, size), 8
+            return None
+        if self._body_size is None:
+            self._body_size = self.need = bytes_to_size(buf)
+            if self.need:
+                return None
+            buf = b""
+        block_type, size = self._header
+        self._header = self._body_size = None
+        self.need = 9
+        if block_type == BLOCK_INDEX:
+            return None
+        self._total += size
+        return block_type, size, buf
+
+
+def read_frames(f):
+    """ Yield (block_type, size, body) for each block frame of the
+    FORMAT_BLOCKS layout in file f, positioned just after the format byte.
+
+    @param file f: a binary file open for reading
+    @rtype: Generator[(int, int, bytes)]
+    """
+    parser = FrameReader()
+    while not parser.done:
+        frame = parser.feed(read_exact(f, parser.need))
+        if frame is not None:
+            yield frame
+
+
+def decompress_blocks(f, workers=1, stats=None):
+    """ Yield the uncompressed blocks of the FORMAT_BLOCKS layout in file
+    f, positioned just after the format byte.
+
+    @param file f: a binary file open for reading
+    @param int workers: number of processes decompressing blocks
+    @param Stats|NoneType stats: statistics to record the blocks and the
+        read and decode times in, if any
+    @rtype: Generator[bytes]
+
+    >>> data = b"".join(compress_blocks(io.BytesIO(b"abracadabra"), 4))
+    >>> b"".join(decompress_blocks(io.BytesIO(data[2:])))
+    b'abracadabra'
+    """
+    def frames():
+        """Yield each frame of f, counting it in stats, with BLOCK_STREAMS
+        frames split into a BLOCK_HUFFMAN frame per stream for workers to
+        share."""
+        for frame in timed_iter(read_frames(f), stats, "read"):
+            if stats is not None:
+                stats.add_block(*frame)
+            block_type, size, body = frame
+            if block_type == BLOCK_STREAMS and workers > 1:
+                for part_size, part_body in stream_parts(body, size):
+                    yield BLOCK_HUFFMAN, part_size, part_body
+            else:
+                yield frame
+
+    yield from timed_iter(map_blocks(decompress_block, frames(), workers),
+                          stats, "decode")
+    if stats is not None:
+        # decoding pulls the frames it decodes, so its time includes theirs
+        stats.add_time("decode", -stats.stages.get("read", 0.0))
+
+
+def uncompress_mmap(in_file, out_file, workers=1, stats=None):
+    """ Uncompress the FORMAT_BLOCKS file in_file into out_file, with both
+    files memory-mapped.
+
+    The total size stored at the end of in_file, once checked against
+    the block index, is used to size out_file before mapping it, and each
+    block is decoded straight into place.
 
     @param str in_file: input file to uncompress
-    @param str out_file: output file that will hold the uncompressed results
+    @param str out_file: output file that will hold the uncompressed
+        results
+    @param int workers: number of processes decompressing blocks
+    @param Stats|NoneType stats: statistics to record into, if any
     @rtype: NoneType
     """
-    with open(in_file, "rb") as f:
-        num_nodes = f.read(1)[0]
-        buf = f.read(num_nodes * 4)
-        node_lst = bytes_to_nodes(buf)
-        # use generate_tree_general or generate_tree_postorder here
-        tree = generate_tree_general(node_lst, num_nodes - 1)
-        size = bytes_to_size(f.read(4))
-        with open(out_file, "wb") as g:
-            text = f.read()
-            g.write(generate_uncompressed(tree, text, size))
+    with open(in_file, "rb") as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        total = read_total(m, *read_index(m))
+        m.seek(2)
+        if stats is not None:
+            stats.compressed_size = m.size()
+            stats.uncompressed_size = total
+        with open(out_file, "w+b") as g:
+            g.truncate(total)
+            if not total:
+                for _ in decompress_blocks(m, workers, stats):
+                    pass
+                return
+            with mmap.mmap(g.fileno(), total) as out:
+                pos = 0
+                for block in decompress_blocks(m, workers, stats):
+                    if pos + len(block) > total:
+                        raise ValueError("corrupt compressed file: blocks "
+                                         "exceed the total size")
+                    out[pos:pos + len(block)] = block
+                    pos += len(block)
+
+
+def uncompress(in_file, out_file, workers=1, use_mmap=None, profile=None):
+    """ Uncompress contents of in_file and store results in out_file,
+    returning statistics of the run.
+
+    @param str|file in_file: input file to uncompress
+    @param str|file out_file: output file that will hold the uncompressed
+        results
+    @param int workers: number of processes decompressing blocks
+    @param bool|NoneType use_mmap: memory-map both files; by default only
+        when in_file is at least MMAP_THRESHOLD bytes
+    @param ContextManager|NoneType profile: a profiler to run around the
+        call, such as a cProfile.Profile
+    @rtype: Stats
+    """
+    if use_mmap is None:
+        use_mmap = wants_mmap(in_file, out_file)
+    if use_mmap:
+        with open(in_file, "rb") as f:
+            use_mmap = f.read(2) == bytes([FORMAT_MAGIC, FORMAT_BLOCKS])
+    stats = Stats()
+    if use_mmap:
+        with instrumented(stats, profile):
+            uncompress_mmap(in_file, out_file, workers, stats)
+        return stats
+    with instrumented(stats, profile), open_file(in_file, "rb") as f, \
+            open_file(out_file, "wb") as g:
+        first = read_exact(f, 1)[0]
+        version = read_exact(f, 1)[0] if first == FORMAT_MAGIC else None
+        if version == FORMAT_BLOCKS:
+            blocks = decompress_blocks(f, workers, stats)
+        elif version == FORMAT_ADAPTIVE:
+            blocks = timed_iter(decompress_adaptive(f), stats, "decode")
+        else:
+            with stats.timed("decode"):
+                if version is None:
+                    blocks = [decompress_legacy(f, first)]
+                elif version == FORMAT_CANONICAL:
+                    blocks = [decompress_canonical(f)]
+                elif version == FORMAT_TRAINED:
+                    blocks = [decompress_trained(f)]
+                else:
+                    raise ValueError(
+                        "unknown format version {}".format(version))
+        for block in blocks:
+            with stats.timed("write"):
+                g.write(block)
+            stats.uncompressed_size += len(block)
+            stats.peak_buffer = max(stats.peak_buffer, len(block))
+        try:
+            stats.compressed_size = f.tell()
+        except (OSError, ValueError):
+            stats.compressed_size = None
+    return stats
+
+
+# ====================
+# Random access
+
+
+def read_index(buf):
+    """ Return the uncompressed offsets and file offsets of the block
+    frames in buf, a whole FORMAT_BLOCKS file, from its BLOCK_INDEX frame.
+
+    @param bytes|mmap buf: the compressed file
+    @rtype: (list[int], list[int])
+
+    >>> data = b"".join(compress_blocks(io.BytesIO(b"abracadabra"), 4))
+    >>> read_index(data)
+    ([0, 4, 8], [2, 23, 44])
+    """
+    if bytes(buf[:2]) != bytes([FORMAT_MAGIC, FORMAT_BLOCKS]):
+        raise ValueError("random access needs a FORMAT_BLOCKS file")
+    end = len(buf) - 9
+    count = bytes_to_size(buf[end - 8:end])
+    start = end - 8 - 16 * count
+    if start < 19 or buf[start - 17] != BLOCK_INDEX:
+        raise ValueError("compressed file has no block index")
+    entries = buf[start:end - 8]
+    positions = [bytes_to_size(entries[i:i + 8])
+                 for i in range(0, len(entries), 16)]
+    offsets = [bytes_to_size(entries[i + 8:i + 16])
+               for i in range(0, len(entries), 16)]
+    return positions, offsets
+
+
+def read_total(buf, positions, offsets):
+    """ Return the total uncompressed size stored at the end of buf, a
+    whole FORMAT_BLOCKS file, checked against its block index.
+
+    @param bytes|mmap buf: the compressed file
+    @param list[int] positions: uncompressed offsets from read_index
+    @param list[int] offsets: file offsets from read_index
+    @rtype: int
+
+    >>> data = b"".join(compress_blocks(io.BytesIO(b"abracadabra"), 4))
+    >>> read_total(data, *read_index(data))
+    11
+    >>> read_total(data[:-8] + size_to_bytes(12, 8), *read_index(data))
+    Traceback (most recent call last):
+    ...
+    ValueError: corrupt compressed file: total does not match the index
+    """
+    total = bytes_to_size(buf[-8:])
+    # the last block ends the text
+    end = (positions[-1] + bytes_to_size(buf[offsets[-1] + 1:
+                                             offsets[-1] + 9])
+           if positions else 0)
+    if total != end:
+        raise ValueError(
+            "corrupt compressed file: total does not match the index")
+    return total
+
+
+class BlockReader:
+    """ Random-access reader over a memory-mapped FORMAT_BLOCKS file.
+
+    Reads decode only the blocks overlapping the requested range, and stop
+    within the last one once enough bytes are decoded.  Reads share the
+    map without seeking, so one reader can serve many threads.
+
+    Attributes:
+    ===========
+    @param int size: total uncompressed size
+    """
+
+    def __init__(self, path):
+        """ Open the FORMAT_BLOCKS file at path for random access.
+
+        @param BlockReader self: this reader
+        @param str path: the compressed file
+        @rtype: NoneType
+        """
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._positions, self._offsets = read_index(self._map)
+            self.size = read_total(self._map, self._positions,
+                                   self._offsets)
+        except ValueError:
+            self._map.close()
+            raise
+
+    def read(self, start, length):
+        """ Return up to length uncompressed bytes from offset start.
+
+        @param BlockReader self: this reader
+        @param int start: uncompressed offset of the first byte
+        @param int length: number of bytes wanted
+        @rtype: bytes
+        """
+        if start < 0 or length < 0:
+            raise ValueError("negative offset or length")
+        end = min(start + length, self.size)
+        parts = []
+        i = bisect.bisect_right(self._positions, start) - 1
+        while start < end:
+            position, offset = self._positions[i], self._offsets[i]
+            header = self._map[offset:offset + 17]
+            size = min(bytes_to_size(header[1:9]), end - position)
+            body = self._map[offset + 17:
+                             offset + 17 + bytes_to_size(header[9:17])]
+            block = decompress_block(header[0], size, body)
+            parts.append(block[start - position:])
+            start = position + size
+            i += 1
+        return b"".join(parts)
+
+    def close(self):
+        """ Unmap the file.
+
+        @param BlockReader self: this reader
+        @rtype: NoneType
+        """
+        self._map.close()
+
+    def __enter__(self):
+        """ Return this reader for use in a with statement.
+
+        @param BlockReader self: this reader
+        @rtype: BlockReader
+        """
+        return self
+
+    def __exit__(self, *exc_info):
+        """ Unmap the file on leaving a with statement.
+
+        @param BlockReader self: this reader
+        @rtype: NoneType
+        """
+        self.close()
+
+
+def read_range(path, start, length):
+    """ Return up to length uncompressed bytes from offset start of the
+    FORMAT_BLOCKS file at path.
+
+    Use a BlockReader instead to serve many reads from one file.
+
+    @param str path: the compressed file
+    @param int start: uncompressed offset of the first byte
+    @param int length: number of bytes wanted
+    @rtype: bytes
+    """
+    with BlockReader(path) as reader:
+        return reader.read(start, length)
+
+
+# ====================
+# File objects
+
+
+class HuffmanWriter(io.BufferedIOBase):
+    """ A write-only file object that compresses what is written to it
+    into the FORMAT_BLOCKS layout, in the manner of gzip.GzipFile.
+
+    Whole blocks of a write are encoded in place, and only the bytes
+    short of a block are held until later writes fill it, so memory stays
+    bounded by block_size however large each write is.  The file is
+    complete once the writer is closed.
+
+    >>> f = io.BytesIO()
+    >>> with HuffmanWriter(f, 4) as writer:
+    ...     writer.write(b"abra") + writer.write(b"cadabra")
+    11
+    >>> HuffmanReader(io.BytesIO(f.getvalue())).read()
+    b'abracadabra'
+    """
+
+    def __init__(self, file, block_size=BLOCK_SIZE, order=0,
+                 max_code_length=None):
+        """ Start a compressed stream in file.
+
+        @param HuffmanWriter self: this writer
+        @param str|file file: a path or a binary file open for writing
+        @param int block_size: maximum number of bytes per block
+        @param int order: context order of the block codes, 0 or 1
+        @param int|NoneType max_code_length: maximum code length, if any
+        @rtype: NoneType
+        """
+        super().__init__()
+        self._owned = is_path(file)
+        self._file = open(file, "wb") if self._owned else file
+        self._block_size = block_size
+        self._order, self._max_code_length = order, max_code_length
+        self._pending = bytearray()
+        self._framer = FrameWriter()
+        self._file.write(self._framer.header())
+
+    def writable(self):
+        """ Return True: this is a write-only stream.
+
+        @param HuffmanWriter self: this writer
+        @rtype: bool
+        """
+        return True
+
+    def write(self, b):
+        """ Compress the bytes-like object b, returning its length.
+
+        @param HuffmanWriter self: this writer
+        @param bytes|bytearray|memoryview b: bytes to compress
+        @rtype: int
+        """
+        if self.closed:
+            raise ValueError("write to closed file")
+        with memoryview(b) as view, view.cast("B") as data:
+            n, start = len(data), 0
+            if self._pending:
+                # complete the held block first
+                start = min(n, self._block_size - len(self._pending))
+                self._pending += data[:start]
+                if len(self._pending) < self._block_size:
+                    return n
+                self._write_block(bytes(self._pending))
+                self._pending.clear()
+            # whole blocks are encoded in place; only the tail is held
+            while n - start >= self._block_size:
+                self._write_block(data[start:start + self._block_size])
+                start += self._block_size
+            self._pending += data[start:]
+        return n
+
+    def _write_block(self, block):
+        """ Encode block and write its frame.
+
+        @param HuffmanWriter self: this writer
+        @param bytes|memoryview block: a non-empty block
+        @rtype: NoneType
+        """
+        self._file.write(self._framer.frame(
+            compress_block(block, self._order, self._max_code_length)))
+
+    def close(self):
+        """ Encode any partial block, end the stream and close it.
+
+        A file object passed in is flushed but left open.
+
+        @param HuffmanWriter self: this writer
+        @rtype: NoneType
+        """
+        if self.closed:
+            return
+        try:
+            if self._pending:
+                self._write_block(bytes(self._pending))
+                self._pending.clear()
+            self._file.write(self._framer.trailer())
+            self._file.flush()
+        finally:
+            if self._owned:
+                self._file.close()
+            super().close()
+
+
+class HuffmanReader(io.BufferedIOBase):
+    """ A read-only file object that uncompresses a FORMAT_BLOCKS stream
+    as it is read.
+
+    Blocks are read and decoded one at a time as reads reach them, so
+    memory stays bounded by the largest block.
+    """
+
+    def __init__(self, file):
+        """ Open the compressed stream in file.
+
+        @param HuffmanReader self: this reader
+        @param str|file file: a path or a binary file open for reading
+        @rtype: NoneType
+        """
+        super().__init__()
+        self._owned = is_path(file)
+        self._file = open(file, "rb") if self._owned else file
+        if self._file.read(2) != bytes([FORMAT_MAGIC, FORMAT_BLOCKS]):
+            if self._owned:
+                self._file.close()
+            raise ValueError("HuffmanReader needs a FORMAT_BLOCKS stream")
+        self._frames = read_frames(self._file)
+        self._block = memoryview(b"")
+
+    def readable(self):
+        """ Return True: this is a read-only stream.
+
+        @param HuffmanReader self: this reader
+        @rtype: bool
+        """
+        return True
+
+    def _next_block(self):
+        """ Decode the next block into the buffer, returning False at the
+        end of the stream.
+
+        @param HuffmanReader self: this reader
+        @rtype: bool
+        """
+        for frame in self._frames:
+            self._block = memoryview(decompress_block(*frame))
+            return True
+        return False
+
+    def readinto(self, b):
+        """ Read uncompressed bytes into the writable buffer b until it
+        is full or the stream ends, returning the number read.
+
+        @param HuffmanReader self: this reader
+        @param bytearray|memoryview b: buffer to fill
+        @rtype: int
+        """
+        if self.closed:
+            raise ValueError("read from closed file")
+        with memoryview(b) as view, view.cast("B") as out:
+            n = 0
+            while n < len(out) and (self._block or self._next_block()):
+                chunk = self._block[:len(out) - n]
+                out[n:n + len(chunk)] = chunk
+                self._block = self._block[len(chunk):]
+                n += len(chunk)
+            return n
+
+    def read(self, size=-1):
+        """ Return up to size uncompressed bytes, or the rest of the
+        stream if size is negative or None.
+
+        @param HuffmanReader self: this reader
+        @param int|NoneType size: maximum number of bytes
+        @rtype: bytes
+        """
+        if size is None or size < 0:
+            if self.closed:
+                raise ValueError("read from closed file")
+            parts = [bytes(self._block)]
+            while self._next_block():
+                parts.append(bytes(self._block))
+            self._block = memoryview(b"")
+            return b"".join(parts)
+        buf = bytearray(size)
+        return bytes(buf[:self.readinto(buf)])
+
+    def read1(self, size=-1):
+        """ Return up to size uncompressed bytes, decoding at most one
+        more block.
+
+        @param HuffmanReader self: this reader
+        @param int|NoneType size: maximum number of bytes
+        @rtype: bytes
+        """
+        if self.closed:
+            raise ValueError("read from closed file")
+        if not self._block:
+            self._next_block()
+        if size is None or size < 0:
+            size = len(self._block)
+        chunk = bytes(self._block[:size])
+        self._block = self._block[len(chunk):]
+        return chunk
+
+    def close(self):
+        """ Close the stream; a file object passed in is left open.
+
+        @param HuffmanReader self: this reader
+        @rtype: NoneType
+        """
+        if self.closed:
+            return
+        self._block = memoryview(b"")
+        if self._owned:
+            self._file.close()
+        super().close()
 
 
 # ====================
@@ -500,25 +3109,216 @@ def improve_tree(tree, freq_dict):
     >>> avg_length(tree, freq)
     2.31
     """
-    # todo
+    # Sort the leaves by depth and the symbols by frequency, then hand the
+    # most frequent symbols to the shallowest leaves in one pass.
+    flat = isinstance(tree, FlatTree)
+    leaves = []
+    stack = [(tree.root if flat else tree, 0)]
+    while stack:
+        node, depth = stack.pop()
+        if (tree.is_leaf(node) if flat else node.is_leaf()):
+            leaves.append((depth, len(leaves), node))
+        elif flat:
+            stack.append((tree.right[node], depth + 1))
+            stack.append((tree.left[node], depth + 1))
+        else:
+            stack.append((node.right, depth + 1))
+            stack.append((node.left, depth + 1))
+    leaves.sort()
+    symbols = sorted((tree.symbol[node] if flat else node.symbol
+                      for _, _, node in leaves),
+                     key=lambda symbol: (-freq_dict.get(symbol, 0), symbol))
+    for (_, _, node), symbol in zip(leaves, symbols):
+        if flat:
+            tree.symbol[node] = symbol
+        else:
+            node.symbol = symbol
+    forget_codes(tree)
 
-if __name__ == "__main__":
-    # TODO: Uncomment these when you have implemented all the functions
-    # import doctest
-    # doctest.testmod()
 
-    import time
-    
-    mode = input("Press c to compress or u to uncompress: ")
+def freq_distance(freq1, freq2):
+    """ Return the total variation distance between the byte
+    distributions with frequencies freq1 and freq2, from 0 for equal
+    distributions to 1 for disjoint ones.
+
+    @param dict(int,int) freq1: a non-empty frequency dictionary
+    @param dict(int,int) freq2: a non-empty frequency dictionary
+    @rtype: float
+
+    >>> freq_distance({1: 2, 2: 2}, {1: 5, 2: 5})
+    0.0
+    >>> freq_distance({1: 1}, {2: 1})
+    1.0
+    """
+    total1 = sum(freq1.values())
+    total2 = sum(freq2.values())
+    return sum(abs(freq1.get(symbol, 0) / total1 -
+                   freq2.get(symbol, 0) / total2)
+               for symbol in set(freq1) | set(freq2)) / 2
+
+# ====================
+# Command line
+
+# Compression levels of the command line, as keyword arguments of compress:
+# 1 reuses trees across similar blocks, 3 codes bytes by their context.
+LEVELS = {1: {"reuse_tree": True}, 2: {}, 3: {"order": 1}}
+SUFFIX = ".huf"
+
+
+def output_path(mode, path):
+    """ Return the path the command line writes path to in mode "c" or
+    "u".
+
+    @param str mode: "c" to compress or "u" to uncompress
+    @param str path: input path
+    @rtype: str
+
+    >>> output_path("c", "book.txt"), output_path("u", "book.txt.huf")
+    ('book.txt.huf', 'book.txt')
+    >>> output_path("u", "book.txt")
+    'book.txt.orig'
+    """
     if mode == "c":
-        fname = input("File to compress: ")
-        start = time.time()
-        compress(fname, fname + ".huf")
-        print("compressed {} in {} seconds."
-              .format(fname, time.time() - start))
-    elif mode == "u":
-        fname = input("File to uncompress: ")
-        start = time.time()
-        uncompress(fname, fname + ".orig")
-        print("uncompressed {} in {} seconds."
-              .format(fname, time.time() - start))
+        return path + SUFFIX
+    if path.endswith(SUFFIX) and len(path) > len(SUFFIX):
+        return path[:-len(SUFFIX)]
+    return path + ".orig"
+
+
+def input_paths(paths, mode, recursive):
+    """ Yield the files named by paths, descending into directories if
+    recursive.  In directories only compressed files are uncompressed,
+    and they are skipped when compressing.  Without recursive,
+    directories are yielded as they are.
+
+    @param list[str] paths: files and directories
+    @param str mode: "c" to compress or "u" to uncompress
+    @param bool recursive: descend into directories
+    @rtype: Generator[str]
+    """
+    for path in paths:
+        if not recursive or not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith(SUFFIX) == (mode == "u"):
+                    yield os.path.join(root, name)
+
+
+def run_file(mode, path, force, keep, options):
+    """ Compress or uncompress the file at path next to it, returning
+    (path, Stats) or (path, error message).
+
+    @param str mode: "c" to compress or "u" to uncompress
+    @param str path: input path
+    @param bool force: overwrite an existing output file
+    @param bool keep: keep the input file
+    @param dict options: keyword arguments for compress or uncompress
+    @rtype: (str, Stats|str)
+    """
+    if os.path.isdir(path):
+        return path, "is a directory (use -r)"
+    out = output_path(mode, path)
+    if os.path.exists(out) and not force:
+        return path, "{} already exists (use -f)".format(out)
+    done = False
+    try:
+        if mode == "c":
+            stats = compress(path, out, **options)
+        else:
+            stats = uncompress(path, out, **options)
+        done = True
+    except (OSError, ValueError) as e:
+        return path, str(e)
+    finally:
+        # never leave a partial output behind, whatever stopped the run
+        if not done and os.path.exists(out):
+            os.remove(out)
+    if not keep:
+        os.remove(path)
+    return path, stats
+
+
+def main(argv=None):
+    """ Run the command line argv, returning the exit status: 1 if any file
+    failed, otherwise 0.
+
+    @param list[str]|NoneType argv: arguments; sys.argv[1:] if None
+    @rtype: int
+    """
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="python -m huffman",
+        description="Compress or uncompress files with Huffman codes.  "
+                    "With no files, or -, read stdin and write stdout.")
+    parser.add_argument("mode", choices=["c", "u"],
+                        help="c to compress, u to uncompress")
+    parser.add_argument("files", nargs="*", help="files or directories")
+    parser.add_argument("-r", "--recursive", action="store_true",
+                        help="process the files in directories")
+    parser.add_argument("-k", "--keep", action="store_true",
+                        help="keep the input files")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="overwrite existing output files")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes working on files, or on the blocks "
+                             "of a single file or stream")
+    parser.add_argument("--block-size", type=int, default=BLOCK_SIZE,
+                        help="bytes per block (default %(default)s)")
+    parser.add_argument("--level", type=int, choices=sorted(LEVELS),
+                        default=2,
+                        help="1 reuses code trees across similar blocks, 2 "
+                             "builds a tree for each block, 3 codes each "
+                             "byte after the byte before it, compressing "
+                             "most but slowest (default %(default)s)")
+    parser.add_argument("--streams", type=int, default=1,
+                        choices=range(1, 256), metavar="N",
+                        help="split each block into N bitstreams that can be "
+                             "decoded in parallel (default %(default)s)")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="compress in one pass with an adaptive tree, "
+                             "writing output as input arrives")
+    parser.add_argument("--stats", action="store_true",
+                        help="print sizes and timings to stderr")
+    args = parser.parse_intermixed_args(argv)
+
+    if args.mode == "c":
+        options = dict(LEVELS[args.level], block_size=args.block_size,
+                       adaptive=args.adaptive, streams=args.streams)
+    else:
+        options = {}
+    if not args.files or args.files == ["-"]:
+        run = compress if args.mode == "c" else uncompress
+        stats = run(sys.stdin.buffer, sys.stdout.buffer,
+                    workers=args.workers, **options)
+        sys.stdout.buffer.flush()
+        results = [("-", stats)]
+    else:
+        paths = list(input_paths(args.files, args.mode, args.recursive))
+        batch = args.workers > 1 and len(paths) > 1
+        options["workers"] = 1 if batch else args.workers
+        jobs = [(args.mode, path, args.force, args.keep, options)
+                for path in paths]
+        results = map_blocks(run_file, jobs, args.workers if batch else 1)
+
+    status = 0
+    for path, result in results:
+        if isinstance(result, str):
+            print("huffman: {}: {}".format(path, result), file=sys.stderr)
+            status = 1
+        elif args.stats:
+            print("{}: {} -> {} bytes, {} bits/byte, {:.3f} s ({})".format(
+                path, result.uncompressed_size, result.compressed_size,
+                "-" if result.bits_per_symbol is None
+                else "{:.3f}".format(result.bits_per_symbol),
+                result.total_time,
+                ", ".join("{} {:.3f} s".format(stage, seconds)
+                          for stage, seconds in result.stages.items())),
+                file=sys.stderr)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
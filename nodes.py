@@ -1,5 +1,7 @@
 """Classes for representing nodes"""
 
+from array import array
+
 
 class HuffmanNode:
     """ A node in a Huffman tree.
@@ -14,6 +16,8 @@ class HuffmanNode:
     @param int number: node number
     """
 
+    __slots__ = ("symbol", "left", "right", "number")
+
     def __init__(self, symbol=None, left=None, right=None):
         """ Create a new HuffmanNode with the given parameters.
 
@@ -42,8 +46,18 @@ class HuffmanNode:
         >>> a == b
         False
         """
-        return (type(self) == type(other) and self.symbol == other.symbol and
-                self.left == other.left and self.right == other.right)
+        pairs = [(self, other)]
+        while pairs:
+            a, b = pairs.pop()
+            if a is None or b is None:
+                if a is not b:
+                    return False
+            elif type(a) != type(b) or a.symbol != b.symbol:
+                return False
+            else:
+                pairs.append((a.left, b.left))
+                pairs.append((a.right, b.right))
+        return True
 
     def __lt__(self, other):
         """ Return True iff self is less than other.
@@ -76,6 +90,35 @@ class HuffmanNode:
         return not self.left and not self.right
 
 
+class AdaptiveNode(HuffmanNode):
+    """ A node in an adaptive Huffman tree, whose shape changes as symbols
+    are coded.
+
+    Attributes:
+    ===========
+    @param AdaptiveNode parent: parent node, or None at the root
+    @param int weight: number of symbols coded through this node
+    """
+
+    __slots__ = ("parent", "weight")
+
+    def __init__(self, symbol=None, left=None, right=None):
+        """ Create a new AdaptiveNode of weight 0 with no parent.
+
+        @param AdaptiveNode self: this AdaptiveNode
+        @param int|NoneType symbol: symbol to be stored in this node, if any
+        @param AdaptiveNode|NoneType left: a tree rooted at 'left', if any
+        @param AdaptiveNode|NoneType right: a tree rooted at 'right', if any
+        @rtype: NoneType
+
+        >>> AdaptiveNode(97).weight
+        0
+        """
+        super().__init__(symbol, left, right)
+        self.parent = None
+        self.weight = 0
+
+
 class ReadNode:
     """ A node as read from a compressed file.
     Each node consists of type and data information as described in the handout.
@@ -89,6 +132,8 @@ class ReadNode:
     @param int r_data: a symbol or the node number of a HuffmanNode's right
     """
 
+    __slots__ = ("l_type", "l_data", "r_type", "r_data")
+
     def __init__(self, l_type, l_data, r_type, r_data):
         """ Create a new ReadNode with the given parameters.
 
@@ -111,6 +156,178 @@ class ReadNode:
         return 'ReadNode({}, {}, {}, {})'.format(
             self.l_type, self.l_data, self.r_type, self.r_data)
 
+
+class FlatTree:
+    """ A Huffman tree stored as parallel arrays indexed by node.
+    Children are always added before their parent, so every node's index
+    is greater than the indices of the nodes below it.
+
+    Attributes:
+    ===========
+    @param array parent: index of each node's parent, -1 for the root
+    @param array left: index of each node's left child, -1 for a leaf
+    @param array right: index of each node's right child, -1 for a leaf
+    @param array symbol: symbol at each leaf, -1 for an internal node
+    @param int root: index of the root, -1 for an empty tree
+    """
+
+    __slots__ = ("parent", "left", "right", "symbol", "root")
+
+    def __init__(self):
+        """ Create a new, empty FlatTree.
+
+        @param FlatTree self: this FlatTree
+        @rtype: NoneType
+        """
+        self.parent = array("h")
+        self.left = array("h")
+        self.right = array("h")
+        self.symbol = array("h")
+        self.root = -1
+
+    def __len__(self):
+        """ Return the number of nodes in self.
+
+        @param FlatTree self: this FlatTree
+        @rtype: int
+        """
+        return len(self.symbol)
+
+    def __repr__(self):
+        """ Return a string representation of self.
+
+        @param FlatTree self: this FlatTree
+        @rtype: str
+        """
+        return 'FlatTree({!r})'.format(self.to_node())
+
+    def add_leaf(self, symbol):
+        """ Add a leaf holding symbol and return its index.
+
+        @param FlatTree self: this FlatTree
+        @param int symbol: symbol stored at the leaf
+        @rtype: int
+
+        >>> t = FlatTree()
+        >>> t.add_leaf(7)
+        0
+        """
+        self.parent.append(-1)
+        self.left.append(-1)
+        self.right.append(-1)
+        self.symbol.append(symbol)
+        return len(self.symbol) - 1
+
+    def add_node(self, left, right):
+        """ Add an internal node over the nodes at indices left and right
+        and return its index.
+
+        @param FlatTree self: this FlatTree
+        @param int left: index of the left child
+        @param int right: index of the right child
+        @rtype: int
+
+        >>> t = FlatTree()
+        >>> t.add_node(t.add_leaf(3), t.add_leaf(2))
+        2
+        >>> list(t.parent)
+        [2, 2, -1]
+        """
+        index = len(self.symbol)
+        self.parent.append(-1)
+        self.left.append(left)
+        self.right.append(right)
+        self.symbol.append(-1)
+        self.parent[left] = self.parent[right] = index
+        return index
+
+    def is_leaf(self, index):
+        """ Return True iff the node at index is a leaf.
+
+        @param FlatTree self: this FlatTree
+        @param int index: index of a node
+        @rtype: bool
+        """
+        return self.left[index] < 0
+
+    def postorder(self):
+        """ Return the indices of the internal nodes of self in postorder.
+
+        @param FlatTree self: this FlatTree
+        @rtype: list[int]
+
+        >>> left = HuffmanNode(None, HuffmanNode(3), HuffmanNode(2))
+        >>> t = FlatTree.from_node(HuffmanNode(None, HuffmanNode(5), left))
+        >>> [list(t.symbol)[t.left[i]] for i in t.postorder()]
+        [3, 5]
+        """
+        order = []
+        stack = [self.root] if self.root >= 0 else []
+        while stack:
+            index = stack.pop()
+            if self.left[index] >= 0:
+                order.append(index)
+                stack.append(self.left[index])
+                stack.append(self.right[index])
+        order.reverse()
+        return order
+
+    @classmethod
+    def from_node(cls, tree):
+        """ Return a FlatTree with the same shape and symbols as tree.
+
+        @param type cls: FlatTree
+        @param HuffmanNode|NoneType tree: a tree rooted at 'tree'
+        @rtype: FlatTree
+
+        >>> t = FlatTree.from_node(HuffmanNode(None, HuffmanNode(3), \
+        HuffmanNode(2)))
+        >>> list(t.symbol), t.root
+        ([3, 2, -1], 2)
+        """
+        flat = cls()
+        if tree is None:
+            return flat
+        stack = [(tree, False)]
+        done = []
+        while stack:
+            node, visited = stack.pop()
+            if node.is_leaf():
+                done.append(flat.add_leaf(node.symbol))
+            elif visited:
+                right = done.pop()
+                done.append(flat.add_node(done.pop(), right))
+            else:
+                stack.append((node, True))
+                stack.append((node.right, False))
+                stack.append((node.left, False))
+        flat.root = done.pop()
+        return flat
+
+    def to_node(self):
+        """ Return the root of a HuffmanNode tree equivalent to self.
+
+        @param FlatTree self: this FlatTree
+        @rtype: HuffmanNode|NoneType
+
+        >>> t = FlatTree()
+        >>> t.root = t.add_node(t.add_leaf(3), t.add_leaf(2))
+        >>> t.to_node()
+        HuffmanNode(None, HuffmanNode(3, None, None), \
+HuffmanNode(2, None, None))
+        """
+        if self.root < 0:
+            return None
+        nodes = []
+        for index in range(len(self.symbol)):
+            if self.left[index] < 0:
+                nodes.append(HuffmanNode(self.symbol[index]))
+            else:
+                nodes.append(HuffmanNode(None, nodes[self.left[index]],
+                                         nodes[self.right[index]]))
+        return nodes[self.root]
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
@@ -4,20 +4,47 @@
 Property testing for functions in huffman.py.
 """
 
+import asyncio
+import cProfile
+import io
+import mmap
+import os
+import pstats
+import socket
+import tempfile
+import tracemalloc
 import unittest
-from random import shuffle
+from concurrent.futures import ThreadPoolExecutor
+from random import Random, shuffle
+from unittest import mock
+import huffman
 from huffman import byte_to_bits, bits_to_byte, get_bit, make_freq_dict
-from huffman import huffman_tree, get_codes, number_nodes
+from huffman import make_freq_table, load_numpy
+from huffman import huffman_tree, huffman_tree_sorted, get_codes, number_nodes
 from huffman import generate_compressed, generate_uncompressed
 from huffman import avg_length, tree_to_bytes, num_nodes_to_bytes
-from nodes import HuffmanNode
+from huffman import size_to_bytes, compress, uncompress
+from huffman import code_lengths, canonical_codes, compress_canonical
+from huffman import train_tree, save_tree, load_tree, limited_code_lengths
+from huffman import improve_tree, read_range, BlockReader
+from huffman import HuffmanReader, HuffmanWriter, main
+from huffman import leaf_codes, build_decode_table, table_decode
+from huffman import build_multi_table, multi_table_decode, pack_codes
+from huffman import pack_codes_order1, frame_block, lengths_to_bytes
+from huffman import bytes_to_nodes, generate_tree_general
+from huffman import generate_tree_postorder, flat_huffman_tree
+from aiohuffman import compress_stream, uncompress_stream
+from adaptive import AdaptiveEncoder, AdaptiveDecoder
+from nodes import HuffmanNode, FlatTree, ReadNode
 from hypothesis import given, assume, settings
-from hypothesis.strategies import binary, integers, dictionaries, text
+from hypothesis.strategies import binary, integers, dictionaries, text, lists
 
 settings.register_profile("norand", settings(derandomize=True,
                                              max_examples=200))
 settings.load_profile("norand")
 
+FREQ_BACKENDS = ["counter"] + (["numpy"] if load_numpy() else [])
+
 
 class TestByteUtilities(unittest.TestCase):
     """Property tests for byte functions"""
@@ -29,7 +56,7 @@ class TestByteUtilities(unittest.TestCase):
         self.assertTrue(set(byte_to_bits(b)).issubset({"0", "1"}))
         self.assertEqual(len(byte_to_bits(b)), 8)
         
-    @given(text(["0", "1"], 0, 4, 8))
+    @given(text(["0", "1"], min_size=0, max_size=8))
     def test_bits_to_byte(self, s):
         """bits_to_byte produces byte"""
 
@@ -49,16 +76,42 @@ class TestByteUtilities(unittest.TestCase):
 class TestCompressionCode(unittest.TestCase):
     """Property tests for Huffman functions"""
 
-    @given(binary(0, 100, 1000))
+    @given(binary(min_size=0, max_size=1000))
     def test_make_freq_dict(self, byte_list):
         """make_freq_dict returns dictionary whose values
-        sum to the number of bytes consumed"""
+        sum to the number of bytes consumed, for every backend"""
+
+        for backend in FREQ_BACKENDS:
+            b, d = byte_list, make_freq_dict(byte_list, backend)
+            self.assertTrue(isinstance(d, dict))
+            self.assertEqual(sum(d.values()), len(b))
+            self.assertEqual(d, make_freq_dict(memoryview(b), backend))
+
+    def test_make_freq_table_mmap(self):
+        """make_freq_table counts a memory-mapped file in place"""
 
-        b, d = byte_list, make_freq_dict(byte_list)
-        self.assertTrue(isinstance(d, dict))
-        self.assertEqual(sum(d.values()), len(b))
+        with open("book.txt", "rb") as f:
+            expected = make_freq_table(f.read())
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                for backend in FREQ_BACKENDS:
+                    self.assertEqual(expected, make_freq_table(m, backend))
 
-    @given(dictionaries(integers(0, 255), integers(1, 1000), dict, 2, 256, 256))
+    @unittest.skipUnless(load_numpy(), "numpy is not installed")
+    @given(binary(max_size=2000), integers(1, 64), integers(0, 2 ** 32),
+           integers(1, 300))
+    def test_pack_codes_numpy(self, b, max_length, seed, chunk):
+        """the numpy encoder packs any codes of up to 64 bits exactly as
+        the pure-Python one, across chunk boundaries"""
+
+        rng = Random(seed)
+        lengths = [rng.randint(1, max_length) for _ in range(256)]
+        values = [rng.getrandbits(length) for length in lengths]
+        with mock.patch.object(huffman, "NUMPY_PACK_CHUNK", chunk):
+            self.assertEqual(pack_codes(b, values, lengths, "python"),
+                             pack_codes(b, values, lengths, "numpy"))
+
+    @given(dictionaries(integers(0, 255), integers(1, 1000), dict_class=dict,
+                        min_size=2, max_size=256))
     def test_huffman_tree(self, d):
         """huffman_tree returns a non-leaf HuffmanNode"""
 
@@ -66,7 +119,21 @@ class TestCompressionCode(unittest.TestCase):
         self.assertTrue(isinstance(t, HuffmanNode))
         self.assertTrue(not t.is_leaf())
 
-    @given(dictionaries(integers(0, 255), integers(1, 1000), dict, 2, 256, 256))
+    @given(dictionaries(integers(0, 255), integers(1, 1000), dict_class=dict,
+                        min_size=2, max_size=256))
+    def test_huffman_tree_deterministic(self, d):
+        """huffman_tree gives the same tree for any ordering of the
+        frequency table, and huffman_tree_sorted agrees with it"""
+
+        t = huffman_tree(d)
+        d2 = list(d.items())
+        shuffle(d2)
+        self.assertEqual(t, huffman_tree(dict(d2)))
+        items = sorted(d.items(), key=lambda item: (item[1], item[0]))
+        self.assertEqual(t, huffman_tree_sorted(items))
+
+    @given(dictionaries(integers(0, 255), integers(1, 1000), dict_class=dict,
+                        min_size=2, max_size=256))
     def test_get_codes(self, d):
         """the sum of len(code) * freq_dict[code] is optimal, so it
         must be invariant under permutation of the dictionary"""
@@ -82,7 +149,21 @@ class TestCompressionCode(unittest.TestCase):
         self.assertEqual(sum([d[k] * len(c1[k]) for k in d]), 
                          sum([d2[k] * len(c2[k]) for k in d2]))
         
-    @given(dictionaries(integers(0, 255), integers(1, 1000), dict, 2, 256, 256))
+    @given(dictionaries(integers(0, 255), integers(1, 1000), dict_class=dict,
+                        min_size=2, max_size=256),
+           dictionaries(integers(0, 255), integers(1, 1000), dict_class=dict,
+                        min_size=2, max_size=256))
+    def test_get_codes_independent(self, d1, d2):
+        """get_codes returns exactly the symbols of its own tree, however
+        many other trees were coded before"""
+
+        t1, t2 = huffman_tree(d1), huffman_tree(d2)
+        self.assertEqual(set(d1), set(get_codes(t1)))
+        self.assertEqual(set(d2), set(get_codes(t2)))
+        self.assertEqual(get_codes(t1), get_codes(huffman_tree(d1)))
+
+    @given(dictionaries(integers(0, 255), integers(1, 1000), dict_class=dict,
+                        min_size=2, max_size=256))
     def test_number_nodes(self, d):
         """if the root is an interior node, it must be numbered
         two less than the number of symbols"""
@@ -96,7 +177,8 @@ class TestCompressionCode(unittest.TestCase):
         number_nodes(t)
         self.assertEqual(count, t.number + 2)
 
-    @given(dictionaries(integers(0, 255), integers(1, 1000), dict, 2, 256, 256))
+    @given(dictionaries(integers(0, 255), integers(1, 1000), dict_class=dict,
+                        min_size=2, max_size=256))
     def test_avg_length(self, d):
         """avg_length should return a float in the
         interval [0, 8]"""
@@ -106,7 +188,7 @@ class TestCompressionCode(unittest.TestCase):
         self.assertTrue(isinstance(f, float))
         self.assertTrue(0 <= f <= 8.0)
 
-    @given(binary(2, 100, 1000))
+    @given(binary(min_size=2, max_size=1000))
     def test_generate_compressed(self, b):
         """generate_compressed should return a bytes
         object that is no longer than the input bytes, and
@@ -129,8 +211,53 @@ class TestCompressionCode(unittest.TestCase):
         c = get_codes(t)
         compressed2 = generate_compressed(b, c)
         self.assertEqual(len(compressed2), len(compressed))
-        
-    @given(binary(2, 100, 1000))
+
+    @given(binary(min_size=1, max_size=1000))
+    def test_generate_compressed_bit_string(self, b):
+        """generate_compressed is byte-for-byte identical to encoding
+        through a '0'/'1' string and bits_to_byte"""
+
+        d = make_freq_dict(b)
+        c = get_codes(huffman_tree(d))
+        bits = "".join([c[i] for i in b])
+        bits += "0" * (-len(bits) % 8)
+        expected = bytes([bits_to_byte(bits[i:i + 8])
+                          for i in range(0, len(bits), 8)])
+        self.assertEqual(expected, generate_compressed(b, c))
+
+    def test_generate_compressed_long_codes(self):
+        """generate_compressed packs codes longer than the 32-bit flush"""
+
+        fib = [1, 1]
+        while len(fib) < 40:
+            fib.append(fib[-1] + fib[-2])
+        c = get_codes(huffman_tree(dict(enumerate(fib))))
+        self.assertEqual(39, max(len(code) for code in c.values()))
+        b = bytes(range(40)) * 3
+        bits = "".join([c[i] for i in b])
+        bits += "0" * (-len(bits) % 8)
+        expected = bytes([bits_to_byte(bits[i:i + 8])
+                          for i in range(0, len(bits), 8)])
+        self.assertEqual(expected, generate_compressed(b, c))
+
+    @given(binary(max_size=300), integers(0, 2 ** 32))
+    def test_pack_codes_order1_long_codes(self, b, seed):
+        """pack_codes_order1 packs codes of up to 64 bits exactly as a
+        '0'/'1' string would"""
+
+        b = bytes([c & 7 for c in b])
+        rng = Random(seed)
+        lengths = [[rng.randint(1, 64) for _ in range(8)] for _ in range(8)]
+        values = [[rng.getrandbits(length) for length in row]
+                  for row in lengths]
+        bits = "".join(["{:0{}b}".format(values[p][c], lengths[p][c])
+                        for p, c in zip(b"\0" + b[:-1], b)])
+        bits += "0" * (-len(bits) % 8)
+        expected = bytes([bits_to_byte(bits[i:i + 8])
+                          for i in range(0, len(bits), 8)])
+        self.assertEqual(expected, pack_codes_order1(b, values, lengths))
+
+    @given(binary(min_size=2, max_size=1000))
     def test_tree_to_bytes(self, b):
         """tree_to_bytes generates a bytes representation of
         a post-order traversal of a trees internal nodes"""
@@ -150,7 +277,7 @@ class TestCompressionCode(unittest.TestCase):
         leaf_count = dictionary_length
         self.assertEqual(4 * (leaf_count - 1), len(output_bytes))
 
-    @given(binary(2, 100, 1000))
+    @given(binary(min_size=2, max_size=1000))
     def test_num_nodes_to_bytes(self, b):
         """num_nodes_to_bytes returns a bytes object that
         has length 1 (since the number of internal nodes cannot
@@ -166,10 +293,215 @@ class TestCompressionCode(unittest.TestCase):
         self.assertEqual(len(n), 1)
 
 
+class TestFlatTree(unittest.TestCase):
+    """Property tests for the flat tree representation"""
+
+    @given(dictionaries(integers(0, 255), integers(1, 1000), dict_class=dict,
+                        min_size=1, max_size=256))
+    def test_flat_round_trip(self, d):
+        """converting to and from FlatTree preserves the tree"""
+
+        t = huffman_tree(d)
+        self.assertEqual(t, FlatTree.from_node(t).to_node())
+        self.assertEqual(t, flat_huffman_tree(d).to_node())
+
+    @given(dictionaries(integers(0, 255), integers(1, 1000), dict_class=dict,
+                        min_size=2, max_size=256))
+    def test_generate_tree(self, d):
+        """both tree readers rebuild the tree written by tree_to_bytes"""
+
+        t = huffman_tree(d)
+        number_nodes(t)
+        node_lst = bytes_to_nodes(tree_to_bytes(t))
+        self.assertEqual(t, generate_tree_general(node_lst, t.number))
+        self.assertEqual(t, generate_tree_postorder(node_lst, t.number))
+        self.assertEqual(tree_to_bytes(t), tree_to_bytes(flat_huffman_tree(d)))
+
+    def test_cyclic_tree(self):
+        """node lists with a cycle or a shared subtree raise ValueError
+        instead of growing without bound"""
+
+        for node_lst, root in [([ReadNode(1, 0, 1, 0)], 0),
+                               ([ReadNode(0, 1, 1, 2), ReadNode(0, 2, 0, 3),
+                                 ReadNode(1, 1, 1, 0)], 2),
+                               ([ReadNode(0, 1, 0, 2), ReadNode(1, 0, 1, 0)],
+                                1)]:
+            self.assertRaises(ValueError, generate_tree_general, node_lst,
+                              root)
+        huf = io.BytesIO(bytes.fromhex("01010001000500000078797a"))
+        self.assertRaises(ValueError, uncompress, huf, io.BytesIO())
+
+    def test_deep_tree(self):
+        """deep trees convert, compare and serialize without recursion"""
+
+        t = HuffmanNode(0)
+        for symbol in range(1, 2000):
+            t = HuffmanNode(None, HuffmanNode(symbol % 256), t)
+        flat = FlatTree.from_node(t)
+        self.assertEqual(t, flat.to_node())
+        self.assertEqual(1999, len(flat.postorder()))
+
+
+class TestCanonicalCodes(unittest.TestCase):
+    """Property tests for canonical codes"""
+
+    @given(dictionaries(integers(0, 255), integers(1, 1000), dict_class=dict,
+                        min_size=2, max_size=256))
+    def test_canonical_codes(self, d):
+        """canonical codes keep each symbol's code length and form a
+        prefix code"""
+
+        lengths = code_lengths(huffman_tree(d))
+        triples = canonical_codes(lengths)
+        self.assertEqual(lengths, {s: l for s, _, l in triples})
+        codes = [format(c, "0{}b".format(l)) for _, c, l in triples]
+        for i, c1 in enumerate(codes):
+            for c2 in codes[i + 1:]:
+                self.assertFalse(c2.startswith(c1))
+
+
+class TestImproveTree(unittest.TestCase):
+    """Property tests for improve_tree"""
+
+    @given(dictionaries(integers(0, 255), integers(1, 1000), dict_class=dict,
+                        min_size=2, max_size=256),
+           dictionaries(integers(0, 255), integers(0, 1000), dict_class=dict,
+                        min_size=0, max_size=256))
+    def test_improve_tree(self, d1, d2):
+        """improve_tree never makes avg_length worse, keeps the tree's
+        shape and symbols, and agrees between tree representations"""
+
+        freq = {s: d2.get(s, 1) for s in d1}
+        assume(sum(freq.values()) > 0)
+        t = huffman_tree(d1)
+        depths = sorted(len(c) for c in get_codes(t).values())
+        before = avg_length(t, freq)
+        flat = FlatTree.from_node(t)
+        improve_tree(t, freq)
+        self.assertLessEqual(avg_length(t, freq), before)
+        self.assertEqual(depths, sorted(len(c) for c in get_codes(t).values()))
+        self.assertEqual(set(d1), set(get_codes(t)))
+        improve_tree(flat, freq)
+        self.assertEqual(t, flat.to_node())
+
+    @given(binary(min_size=0, max_size=1000), integers(1, 300))
+    def test_reuse_tree_round_trip(self, b, block_size):
+        """uncompress inverts compress with tree reuse across blocks"""
+
+        huf, out = io.BytesIO(), io.BytesIO()
+        compress(io.BytesIO(b), huf, block_size, reuse_tree=True)
+        huf.seek(0)
+        uncompress(huf, out)
+        self.assertEqual(b, out.getvalue())
+
+
+class TestLimitedCodes(unittest.TestCase):
+    """Property tests for length-limited codes"""
+
+    @given(dictionaries(integers(0, 255), integers(1, 100000),
+                        dict_class=dict, min_size=2, max_size=256),
+           integers(8, 16))
+    def test_limited_code_lengths(self, d, limit):
+        """limited codes respect the limit, form a complete prefix code,
+        and cost no less than, or the same as, the unlimited code"""
+
+        lengths = limited_code_lengths(d, limit)
+        self.assertLessEqual(max(lengths.values()), limit)
+        self.assertEqual(1, sum([2 ** -l for l in lengths.values()]))
+        t = huffman_tree(d)
+        cost = sum([d[s] * lengths[s] for s in d])
+        optimal = sum([d[s] * len(c) for s, c in get_codes(t).items()])
+        self.assertGreaterEqual(cost, optimal)
+        if max(len(c) for c in get_codes(t).values()) <= limit:
+            self.assertEqual(cost, optimal)
+        self.assertAlmostEqual(cost / sum(d.values()),
+                               avg_length(huffman_tree(d, limit), d))
+
+    def test_limited_fibonacci(self):
+        """Fibonacci frequencies, whose Huffman code is as deep as
+        possible, are cut down to the limit"""
+
+        fib = [1, 1]
+        while len(fib) < 30:
+            fib.append(fib[-1] + fib[-2])
+        d = dict(enumerate(fib))
+        self.assertEqual(29, max(len(c) for c in get_codes(huffman_tree(d))
+                                 .values()))
+        for limit in range(5, 29):
+            t = huffman_tree(d, limit)
+            self.assertEqual(limit, max(len(c) for c in get_codes(t)
+                                        .values()))
+
+    @given(binary(min_size=0, max_size=1000), integers(8, 12))
+    def test_limited_round_trip(self, b, limit):
+        """uncompress inverts compress with limited code lengths"""
+
+        huf, out = io.BytesIO(), io.BytesIO()
+        compress(io.BytesIO(b), huf, max_code_length=limit)
+        huf.seek(0)
+        uncompress(huf, out)
+        self.assertEqual(b, out.getvalue())
+
+
+class TestAdaptive(unittest.TestCase):
+    """Property tests for adaptive Huffman coding"""
+
+    @given(binary(max_size=1000))
+    def test_sibling_property(self, b):
+        """after every symbol, the implicit numbering orders nodes by
+        weight, pairs siblings, and keeps each weight the sum of its
+        children's"""
+
+        encoder = AdaptiveEncoder()
+        tree = encoder.tree
+        for symbol in b:
+            encoder.encode(bytes([symbol]))
+            nodes = [node for node in tree.nodes if node is not None]
+            for i, node in enumerate(nodes):
+                self.assertIs(node, tree.nodes[node.number])
+                if node.left is not None:
+                    self.assertEqual(node.weight,
+                                     node.left.weight + node.right.weight)
+                if i + 1 < len(nodes):
+                    self.assertLessEqual(node.weight, nodes[i + 1].weight)
+                if i % 2:
+                    self.assertIs(nodes[i - 1].parent, node.parent)
+
+    @given(binary(max_size=1000), integers(0, 1000))
+    def test_incremental(self, b, cut):
+        """decoding the stream in two arbitrary pieces gives back the
+        input, ignoring bytes after the end"""
+
+        encoder = AdaptiveEncoder()
+        data = encoder.encode(b[:cut]) + encoder.encode(b[cut:])
+        data += encoder.finish()
+        decoder = AdaptiveDecoder()
+        text = decoder.decode(data[:cut]) + decoder.decode(data[cut:] +
+                                                           b"junk")
+        self.assertTrue(decoder.done)
+        self.assertEqual(b, text)
+
+
 class TestRoundTrip(unittest.TestCase):
     """Property test for round trip"""
 
-    @given(binary(1, 100, 1000))
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.orig = os.path.join(self.dir.name, "orig")
+        self.huf = os.path.join(self.dir.name, "orig.huf")
+        self.out = os.path.join(self.dir.name, "orig.huf.orig")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def uncompressed(self):
+        """Return the text uncompress writes for self.huf"""
+
+        uncompress(self.huf, self.out)
+        with open(self.out, "rb") as f:
+            return f.read()
+
+    @given(binary(min_size=1, max_size=1000))
     def test_round_trip(self, b):
         """test inverting generate_compressed and generate_uncompressed"""
 
@@ -182,5 +514,586 @@ class TestRoundTrip(unittest.TestCase):
         uncompressed = generate_uncompressed(tree, compressed, len(orig_text))
         assert orig_text == uncompressed
 
+    @given(binary(min_size=1, max_size=1000), integers(1, 12))
+    def test_round_trip_table_bits(self, b, table_bits):
+        """generate_uncompressed inverts generate_compressed for any
+        decode table width, including codes that need subtables"""
+
+        freq = make_freq_dict(b)
+        assume(len(freq) > 1)
+        tree = huffman_tree(freq)
+        codes = get_codes(tree)
+        compressed = generate_compressed(b, codes)
+        self.assertEqual(b, generate_uncompressed(tree, compressed, len(b),
+                                                  table_bits))
+
+    @given(binary(min_size=1, max_size=1000), integers(1, 12),
+           integers(1, 4))
+    def test_multi_table_decode(self, b, table_bits, multi_symbols):
+        """multi-symbol decoding agrees with single-symbol decoding for
+        any table width and symbols per entry"""
+
+        freq = make_freq_dict(b)
+        assume(len(freq) > 1)
+        tree = huffman_tree(freq)
+        compressed = generate_compressed(b, get_codes(tree))
+        codes = leaf_codes(tree)
+        with mock.patch.object(huffman, "MULTI_SYMBOLS", multi_symbols):
+            table = build_multi_table(codes, table_bits)
+        self.assertEqual(
+            table_decode(build_decode_table(codes, table_bits), compressed,
+                         len(b)),
+            multi_table_decode(table, compressed, len(b)))
+
+    def test_multi_table_blocks(self):
+        """blocks long enough for multi-symbol tables round-trip"""
+
+        with open("book.txt", "rb") as f:
+            b = f.read(300000)
+        huf, out = io.BytesIO(), io.BytesIO()
+        compress(io.BytesIO(b), huf, huffman.MULTI_MIN_SIZE * 2)
+        huf.seek(0)
+        uncompress(huf, out)
+        self.assertEqual(b, out.getvalue())
+
+    @given(binary(min_size=0, max_size=1000))
+    def test_compress_round_trip(self, b):
+        """uncompress inverts compress"""
+
+        with open(self.orig, "wb") as f:
+            f.write(b)
+        compress(self.orig, self.huf)
+        self.assertEqual(b, self.uncompressed())
+
+    @given(binary(min_size=0, max_size=1000), integers(1, 300))
+    def test_block_round_trip(self, b, block_size):
+        """uncompress inverts compress across many blocks, on file
+        objects"""
+
+        huf, out = io.BytesIO(), io.BytesIO()
+        compress(io.BytesIO(b), huf, block_size)
+        huf.seek(0)
+        uncompress(huf, out)
+        self.assertEqual(b, out.getvalue())
+
+    @given(binary(min_size=0, max_size=1000), integers(1, 300))
+    def test_mmap_round_trip(self, b, block_size):
+        """memory-mapped compress and uncompress give the same files as
+        the buffered paths"""
+
+        with open(self.orig, "wb") as f:
+            f.write(b)
+        compress(self.orig, self.huf, block_size, use_mmap=True)
+        buffered = io.BytesIO()
+        compress(self.orig, buffered, block_size, use_mmap=False)
+        with open(self.huf, "rb") as f:
+            self.assertEqual(buffered.getvalue(), f.read())
+        uncompress(self.huf, self.out, use_mmap=True)
+        with open(self.out, "rb") as f:
+            self.assertEqual(b, f.read())
+
+    def test_mmap_total_corrupt(self):
+        """a memory-mapped uncompress checks the stored total against the
+        block index before sizing the output, and random access does too"""
+
+        with open(self.orig, "wb") as f:
+            f.write(b"abracadabra" * 100)
+        compress(self.orig, self.huf, 256)
+        with open(self.huf, "rb") as f:
+            data = f.read()
+        for total in [1099, 1 << 50]:
+            with open(self.huf, "wb") as f:
+                f.write(data[:-8] + size_to_bytes(total, 8))
+            self.assertRaises(ValueError, uncompress, self.huf, self.out,
+                              use_mmap=True)
+            self.assertFalse(os.path.exists(self.out))
+            self.assertRaises(ValueError, BlockReader, self.huf)
+
+    @given(binary(min_size=0, max_size=4096))
+    def test_trained_round_trip(self, b):
+        """small messages round-trip through a saved and reloaded trained
+        tree with a ten-byte header"""
+
+        with open("book.txt", "rb") as f:
+            lengths = train_tree(f.read(100000))
+        path = os.path.join(self.dir.name, "book.tree")
+        key = save_tree(lengths, path)
+        self.assertEqual(key, load_tree(path))
+        with open(self.orig, "wb") as f:
+            f.write(b)
+        compress(self.orig, self.huf, tree_id=key)
+        longest = max(lengths.values())
+        self.assertLessEqual(os.path.getsize(self.huf),
+                             10 + (longest * len(b) + 7) // 8)
+        self.assertEqual(b, self.uncompressed())
+
+    def test_trained_id_collision(self):
+        """registering different code lengths under an id already in use
+        raises ValueError instead of reusing the first table, while the
+        same lengths register again"""
+
+        first, second = train_tree(b"abracadabra"), train_tree(b"zzzzzy")
+        with mock.patch.dict(huffman._trained_trees), \
+                mock.patch.object(huffman, "trained_tree_id",
+                                  lambda lengths: 7):
+            self.assertEqual(7, huffman.register_tree(first))
+            self.assertEqual(7, huffman.register_tree(dict(first)))
+            self.assertRaises(ValueError, huffman.register_tree, second)
+            self.assertEqual(b"abracadabra", huffman.decompress_trained(
+                io.BytesIO(huffman.compress_trained(b"abracadabra",
+                                                    7)[2:])))
+
+    def test_parallel_round_trip(self):
+        """compressing and uncompressing with a process pool gives the
+        same bytes as doing it serially"""
+
+        with open("book.txt", "rb") as f:
+            b = f.read(100000)
+        serial, parallel, out = io.BytesIO(), io.BytesIO(), io.BytesIO()
+        compress(io.BytesIO(b), serial, 4096)
+        compress(io.BytesIO(b), parallel, 4096, workers=2)
+        self.assertEqual(serial.getvalue(), parallel.getvalue())
+        parallel.seek(0)
+        uncompress(parallel, out, workers=2)
+        self.assertEqual(b, out.getvalue())
+
+    @given(binary(min_size=0, max_size=1000), integers(1, 300),
+           integers(1, 20))
+    def test_order1_round_trip(self, b, block_size, min_context):
+        """uncompress inverts order-1 compress, with contexts both owning
+        and sharing codes"""
+
+        huf, out = io.BytesIO(), io.BytesIO()
+        with mock.patch.object(huffman, "ORDER1_MIN_CONTEXT", min_context):
+            compress(io.BytesIO(b), huf, block_size, order=1)
+        huf.seek(0)
+        uncompress(huf, out)
+        self.assertEqual(b, out.getvalue())
+
+    def test_order1_ratio(self):
+        """order-1 coding compresses text better than order-0"""
+
+        with open("book.txt", "rb") as f:
+            b = f.read(200000)
+        order0, order1 = io.BytesIO(), io.BytesIO()
+        compress(io.BytesIO(b), order0)
+        compress(io.BytesIO(b), order1, order=1)
+        self.assertLess(len(order1.getvalue()), len(order0.getvalue()))
+
+    @given(binary(min_size=0, max_size=1000), integers(1, 300),
+           integers(1, 8))
+    def test_streams_round_trip(self, b, block_size, streams):
+        """uncompress inverts compress with blocks split into streams"""
+
+        huf, out = io.BytesIO(), io.BytesIO()
+        compress(io.BytesIO(b), huf, block_size, streams=streams)
+        huf.seek(0)
+        uncompress(huf, out)
+        self.assertEqual(b, out.getvalue())
+
+    def test_streams_parallel(self):
+        """streams of one block decoded by a process pool join up to the
+        block"""
+
+        with open("book.txt", "rb") as f:
+            b = f.read(100000)
+        huf, out = io.BytesIO(), io.BytesIO()
+        compress(io.BytesIO(b), huf, len(b), streams=4)
+        huf.seek(0)
+        stats = uncompress(huf, out, workers=2)
+        self.assertEqual(1, stats.blocks)
+        self.assertEqual(b, out.getvalue())
+
+    @given(binary(min_size=0, max_size=1000), integers(1, 300),
+           integers(0, 1100), integers(0, 1100), integers(0, 1),
+           integers(1, 4))
+    def test_read_range(self, b, block_size, start, length, order, streams):
+        """read_range returns the same bytes as slicing the original"""
+
+        with open(self.orig, "wb") as f:
+            f.write(b)
+        compress(self.orig, self.huf, block_size, order=order,
+                 streams=streams)
+        self.assertEqual(b[start:start + length],
+                         read_range(self.huf, start, length))
+
+    def test_block_reader_threads(self):
+        """one BlockReader serves concurrent reads from many threads"""
+
+        with open("book.txt", "rb") as f:
+            b = f.read(100000)
+        with open(self.orig, "wb") as f:
+            f.write(b)
+        compress(self.orig, self.huf, 4096)
+        ranges = [(start, 5000) for start in range(0, len(b), 777)]
+        with BlockReader(self.huf) as reader, \
+                ThreadPoolExecutor(4) as pool:
+            parts = pool.map(lambda r: reader.read(*r), ranges)
+            for (start, length), part in zip(ranges, parts):
+                self.assertEqual(b[start:start + length], part)
+
+    @given(lists(binary(max_size=200), max_size=10), integers(1, 300))
+    def test_writer(self, chunks, block_size):
+        """uncompress reads what a HuffmanWriter wrote, chunk by chunk"""
+
+        with HuffmanWriter(self.huf, block_size) as writer:
+            for chunk in chunks:
+                self.assertEqual(len(chunk), writer.write(chunk))
+        self.assertEqual(b"".join(chunks), self.uncompressed())
+
+    def test_writer_large_write(self):
+        """one large write is encoded block by block, in memory bounded
+        by the block size rather than the size of the write"""
+
+        with open("book.txt", "rb") as f:
+            b = f.read()
+        block_size = 1 << 14
+        large = b * 8
+        tracemalloc.start()
+        try:
+            with open(os.devnull, "wb") as sink, \
+                    HuffmanWriter(sink, block_size) as writer:
+                writer.write(b"x")
+                writer.write(large)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, 128 * block_size)
+        with HuffmanWriter(self.huf, block_size) as writer:
+            writer.write(b"x")
+            writer.write(b)
+        self.assertEqual(b"x" + b, self.uncompressed())
+
+    @given(binary(min_size=0, max_size=1000), integers(1, 300),
+           lists(integers(0, 300), min_size=1, max_size=20))
+    def test_reader(self, b, block_size, sizes):
+        """reads and readinto calls of any size on a HuffmanReader
+        return the original bytes in order"""
+
+        huf = io.BytesIO()
+        compress(io.BytesIO(b), huf, block_size)
+        huf.seek(0)
+        parts = []
+        with HuffmanReader(huf) as reader:
+            for i, size in enumerate(sizes):
+                if i % 2:
+                    buf = bytearray(size)
+                    parts.append(bytes(buf[:reader.readinto(buf)]))
+                else:
+                    parts.append(reader.read(size))
+            parts.append(reader.read())
+            self.assertEqual(b"", reader.read(1))
+        self.assertEqual(b, b"".join(parts))
+
+    @given(binary(min_size=0, max_size=1000), integers(1, 300),
+           integers(0, 1))
+    def test_stats(self, b, block_size, use_mmap):
+        """compress and uncompress report the sizes and block counts of
+        what they read and wrote"""
+
+        with open(self.orig, "wb") as f:
+            f.write(b)
+        stats = compress(self.orig, self.huf, block_size,
+                         use_mmap=bool(use_mmap))
+        blocks = (len(b) + block_size - 1) // block_size
+        self.assertEqual(len(b), stats.uncompressed_size)
+        self.assertEqual(os.path.getsize(self.huf), stats.compressed_size)
+        self.assertEqual(blocks, stats.blocks)
+        self.assertGreaterEqual(stats.peak_buffer, min(len(b), block_size))
+        ustats = uncompress(self.huf, self.out, use_mmap=bool(use_mmap))
+        self.assertEqual(len(b), ustats.uncompressed_size)
+        self.assertEqual(stats.compressed_size, ustats.compressed_size)
+        self.assertEqual(blocks, ustats.blocks)
+        self.assertEqual(stats.tree_nodes, ustats.tree_nodes)
+        self.assertGreaterEqual(ustats.total_time,
+                                sum(ustats.stages.values()) - 1e-6)
+
+    def test_stats_profile(self):
+        """a profiler passed to compress sees the encoding, and tracing
+        allocations records a peak"""
+
+        with open("book.txt", "rb") as f:
+            b = f.read(100000)
+        profile = cProfile.Profile()
+        tracemalloc.start()
+        try:
+            stats = compress(io.BytesIO(b), io.BytesIO(), 4096,
+                             profile=profile)
+        finally:
+            tracemalloc.stop()
+        called = {func for _, _, func in pstats.Stats(profile).stats}
+        self.assertIn("pack_codes", called)
+        self.assertGreater(stats.peak_traced, 4096)
+        self.assertEqual(set(stats.stages), {"read", "encode", "write"})
+
+    @given(binary(min_size=0, max_size=1000), integers(1, 300),
+           integers(0, 1))
+    def test_stored_bound(self, b, block_size, order):
+        """no block's frame is larger than storing it"""
+
+        huf = io.BytesIO()
+        stats = compress(io.BytesIO(b), huf, block_size, order=order)
+        frames = 17 * stats.blocks
+        index = 17 + 16 * stats.blocks + 8
+        self.assertLessEqual(len(huf.getvalue()),
+                             2 + len(b) + frames + index + 9)
+
+    def test_stored_random(self):
+        """random bytes are stored without coding and read back"""
+
+        b = Random(0).randbytes(100000)
+        huf, out = io.BytesIO(), io.BytesIO()
+        stats = compress(io.BytesIO(b), huf, 4096)
+        self.assertEqual(0, stats.tree_nodes)
+        huf.seek(0)
+        uncompress(huf, out)
+        self.assertEqual(b, out.getvalue())
+
+    @given(binary(min_size=0, max_size=10000))
+    def test_adaptive_round_trip(self, b):
+        """uncompress inverts adaptive compress"""
+
+        huf, out = io.BytesIO(), io.BytesIO()
+        compress(io.BytesIO(b), huf, adaptive=True)
+        huf.seek(0)
+        uncompress(huf, out)
+        self.assertEqual(b, out.getvalue())
+
+    @given(binary(min_size=0, max_size=1000))
+    def test_uncompress_canonical(self, b):
+        """uncompress reads the single-payload canonical layout"""
+
+        with open(self.huf, "wb") as f:
+            f.write(compress_canonical(b))
+        self.assertEqual(b, self.uncompressed())
+
+    @given(binary(min_size=1, max_size=1000))
+    def test_uncompress_legacy(self, b):
+        """uncompress still reads the postorder tree layout"""
+
+        freq = make_freq_dict(b)
+        assume(len(freq) > 1)
+        tree = huffman_tree(freq)
+        number_nodes(tree)
+        with open(self.huf, "wb") as f:
+            f.write(num_nodes_to_bytes(tree) + tree_to_bytes(tree) +
+                    size_to_bytes(len(b)) +
+                    generate_compressed(b, get_codes(tree)))
+        self.assertEqual(b, self.uncompressed())
+
+    def test_uncompress_legacy_corrupt(self):
+        """truncated files and malformed nodes in the legacy layout raise
+        ValueError"""
+
+        for corrupt in [bytes([2, 0, 97, 0]), bytes([1, 0, 97, 0, 98]),
+                        bytes([1, 2, 97, 0, 98, 1, 0, 0, 0, 0]),
+                        bytes([1, 1, 1, 0, 98, 1, 0, 0, 0, 0]),
+                        b"plain text is not an archive"]:
+            with open(self.huf, "wb") as f:
+                f.write(corrupt)
+            self.assertRaises(ValueError, self.uncompressed)
+
+    def test_uncompress_header_corrupt(self):
+        """truncated, over-full and incomplete code length headers raise
+        ValueError in canonical, block and order-1 bodies"""
+
+        headers = [bytes([2, 97]),
+                   lengths_to_bytes({97: 1, 98: 1, 99: 1}),
+                   lengths_to_bytes({97: 1, 98: 2}),
+                   lengths_to_bytes({97: 1}),
+                   bytes([1, 97, 1, 97, 1])]
+        canonical = bytes([huffman.FORMAT_MAGIC, huffman.FORMAT_CANONICAL])
+        blocks = bytes([huffman.FORMAT_MAGIC, huffman.FORMAT_BLOCKS])
+        corrupt = [canonical, canonical + bytes([5, 0])]
+        for header in headers:
+            corrupt.append(canonical + size_to_bytes(5) + header + b"\xff")
+            for block_type, body in [
+                    (huffman.BLOCK_HUFFMAN, header + b"\xff"),
+                    (huffman.BLOCK_ORDER1, bytes([1]) + bytes(32) + header +
+                     b"\xff")]:
+                corrupt.append(blocks + frame_block(block_type, 5, body) +
+                               bytes([huffman.BLOCK_END]) +
+                               size_to_bytes(5, 8))
+        # an order-1 body with no code for the first context
+        corrupt.append(blocks + frame_block(huffman.BLOCK_ORDER1, 5,
+                                            bytes(33) + b"\xff") +
+                       bytes([huffman.BLOCK_END]) + size_to_bytes(5, 8))
+        for data in corrupt:
+            with open(self.huf, "wb") as f:
+                f.write(data)
+            self.assertRaises(ValueError, self.uncompressed)
+
+
+    def test_uncompress_size_corrupt(self):
+        """a frame size larger than its codes can hold, or codes that run
+        past the end of their body, raise ValueError without decoding
+        zero bits forever"""
+
+        with open(self.orig, "wb") as f:
+            f.write(b"abracadabra" * 100)
+        for kwargs in [{}, {"order": 1}, {"streams": 2}]:
+            compress(self.orig, self.huf, **kwargs)
+            with open(self.huf, "rb") as f:
+                data = bytearray(f.read())
+            for i, value in [(3, 0x40), (8, 0xff), (10, 0x10)]:
+                corrupt = bytearray(data)
+                corrupt[i] ^= value
+                with open(self.huf, "wb") as f:
+                    f.write(corrupt)
+                self.assertRaises(ValueError, self.uncompressed)
+
+
+async def socket_streams():
+    """Return the two ends of a loopback socket pair as (reader, writer)
+    connections; bytes written to the second arrive at the first"""
+
+    a, b = socket.socketpair()
+    return (await asyncio.open_connection(sock=a),
+            await asyncio.open_connection(sock=b))
+
+
+async def stream_compressed(b, block_size):
+    """Return b compressed by compress_stream through a socket"""
+
+    source = asyncio.StreamReader()
+    source.feed_data(b)
+    source.feed_eof()
+    (reader, unused), (_, writer) = await socket_streams()
+
+    async def compressing():
+        await compress_stream(source, writer, block_size)
+        writer.close()
+
+    result = await asyncio.gather(compressing(), reader.read())
+    unused.close()
+    return result[1]
+
+
+async def stream_round_trip(b, block_size):
+    """Return b compressed by compress_stream and uncompressed by
+    uncompress_stream, through sockets between each stage"""
+
+    source = asyncio.StreamReader()
+    source.feed_data(b)
+    source.feed_eof()
+    (huf_reader, huf_unused), (_, huf_writer) = await socket_streams()
+    (out_reader, out_unused), (_, out_writer) = await socket_streams()
+
+    async def compressing():
+        await compress_stream(source, huf_writer, block_size)
+        huf_writer.close()
+
+    async def uncompressing():
+        await uncompress_stream(huf_reader, out_writer)
+        out_writer.close()
+
+    result = await asyncio.gather(compressing(), uncompressing(),
+                                  out_reader.read())
+    huf_unused.close()
+    out_unused.close()
+    return result[2]
+
+
+class TestAsyncStreams(unittest.TestCase):
+    """Property tests for the asyncio streaming API"""
+
+    @settings(max_examples=50)
+    @given(binary(min_size=0, max_size=1000), integers(1, 300))
+    def test_stream_round_trip(self, b, block_size):
+        """uncompress_stream inverts compress_stream over sockets"""
+
+        self.assertEqual(b, asyncio.run(stream_round_trip(b, block_size)))
+
+    def test_stream_interoperates(self):
+        """compress_stream writes what compress writes"""
+
+        with open("book.txt", "rb") as f:
+            b = f.read(100000)
+
+        expected = io.BytesIO()
+        compress(io.BytesIO(b), expected, 4096)
+        self.assertEqual(expected.getvalue(),
+                         asyncio.run(stream_compressed(b, 4096)))
+
+
+class TestCommandLine(unittest.TestCase):
+    """Tests for the command line"""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.files = {os.path.join(self.dir.name, "a.txt"): b"abracadabra",
+                      os.path.join(self.dir.name, "sub", "b.bin"): b"",
+                      os.path.join(self.dir.name, "sub", "c"): bytes(
+                          range(256)) * 3}
+        for path, b in self.files.items():
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(b)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_recursive_round_trip(self):
+        """compressing and uncompressing a directory tree restores every
+        file, in a worker pool and with inputs kept or removed"""
+
+        self.assertEqual(0, main(["c", "-r", self.dir.name, "--workers",
+                                  "2", "--level", "3"]))
+        for path in self.files:
+            self.assertFalse(os.path.exists(path))
+            self.assertTrue(os.path.exists(path + ".huf"))
+        self.assertEqual(0, main(["u", "-rk", self.dir.name]))
+        for path, b in self.files.items():
+            self.assertTrue(os.path.exists(path + ".huf"))
+            with open(path, "rb") as f:
+                self.assertEqual(b, f.read())
+
+    def test_existing_output(self):
+        """an existing output file is kept unless forced, and the run
+        fails"""
+
+        path = next(iter(self.files))
+        with open(path + ".huf", "wb") as f:
+            f.write(b"keep")
+        with mock.patch("sys.stderr", io.StringIO()) as err:
+            self.assertEqual(1, main(["c", path]))
+        self.assertIn("already exists", err.getvalue())
+        with open(path + ".huf", "rb") as f:
+            self.assertEqual(b"keep", f.read())
+        self.assertEqual(0, main(["c", "-f", path]))
+        self.assertEqual(0, main(["u", path + ".huf"]))
+        with open(path, "rb") as f:
+            self.assertEqual(self.files[path], f.read())
+
+    def test_not_an_archive(self):
+        """uncompressing a file that is not an archive reports it, leaves
+        no partial output and goes on with the other files, in a worker
+        pool too; an unexpected error propagates, still removing the
+        partial output"""
+
+        plain = os.path.join(self.dir.name, "plain.txt")
+        with open(plain, "wb") as f:
+            f.write(b"plain text is not an archive")
+        path = next(iter(self.files))
+        self.assertEqual(0, main(["c", path]))
+        for workers in ["1", "2"]:
+            with mock.patch("sys.stderr", io.StringIO()) as err:
+                self.assertEqual(1, main(["u", "-k", "-f", "--workers",
+                                          workers, plain, path + ".huf"]))
+            self.assertIn(plain, err.getvalue())
+            self.assertFalse(os.path.exists(plain + ".orig"))
+            with open(path, "rb") as f:
+                self.assertEqual(self.files[path], f.read())
+
+        def failing(in_file, out_file, **options):
+            with open(out_file, "wb") as f:
+                f.write(b"partial")
+            raise IndexError("index out of range")
+
+        with mock.patch.object(huffman, "uncompress", failing):
+            self.assertRaises(IndexError, main, ["u", "-k", plain])
+        self.assertFalse(os.path.exists(plain + ".orig"))
+
+
 if __name__ == "__main__":
     unittest.main()